@@ -13,8 +13,18 @@ Code downloaded from: http://github.com/rzajac/gcounter
 # Python imports
 import re
 import copy
-import unicodedata
+import time
+import math
+import bisect
+import zlib
+import base64
 import random
+import hashlib
+import logging
+import datetime
+import threading
+import unicodedata
+import collections
 
 # GAE imports
 from google.appengine.api import memcache, datastore_errors
@@ -26,6 +36,203 @@ BadValueError = datastore_errors.BadValueError
 
 DEBUG = False
 
+# Maximum number of memoized slugs
+SLUG_CACHE_SIZE = 10000
+
+# Number of counter shards cached in the instance memory: how many counters
+# and for how long (seconds). Other instances see the change made by
+# Counter.increase_shards() after at most SHARD_CONFIG_LOCAL_TIME seconds.
+SHARD_CONFIG_CACHE_SIZE = 10000
+SHARD_CONFIG_LOCAL_TIME = 60
+
+# Number of counter shards cached in memcache: for how long (seconds) and
+# with what key prefix.
+SHARD_CONFIG_MEMCACHE_TIME = 3600
+SHARD_CONFIG_KEY_PREFIX = 'gcounter:num_shards:'
+
+# Write-behind mode. When enabled counter changes are accumulated in
+# memcache and written to the Datastore by Counter.flush_buffers() which
+# should be run periodically (see gcounter_tasks.py).
+WRITE_BEHIND = False
+
+# Memcache key prefix for write-behind buffers, registration markers,
+# buffer index and flush statistics.
+WRITE_BEHIND_KEY_PREFIX = 'gcounter:wb:'
+
+# Number of memcache entries the buffer index is spread over
+WRITE_BEHIND_INDEX_BUCKETS = 16
+
+# Registration markers expire after this many seconds so counters
+# dropped from evicted index buckets get registered again on next change.
+WRITE_BEHIND_MARKER_TIME = 600
+
+# Buffers hold WRITE_BEHIND_BASE + accumulated delta because memcache
+# values can't go below 0.
+WRITE_BEHIND_BASE = 2 ** 62
+
+# Aggregation of stored CounterActions (see Counter.aggregate_stored_actions):
+# how many records are fetched at once, how many seconds one task may run
+# and if processed records are deleted instead of marked as processed.
+AGGREGATION_BATCH_SIZE = 500
+AGGREGATION_TIME_BUDGET = 60
+AGGREGATION_DELETE_PROCESSED = False
+
+# Records are leased for this many seconds while their actions are applied.
+# Leases of records not finalized in time (the task died) expire and the
+# records are aggregated again, so it must be longer than any task runs.
+AGGREGATION_LEASE_TIME = 1800
+
+# Aggregation task URL and queue
+AGGREGATION_URL = '/admin/scr/aggregate-counters'
+AGGREGATION_QUEUE = 'default'
+
+# Number of parallel aggregation workers. Counters are assigned to workers
+# by hash of their names so workers never change the same counter. Must
+# not be greater than 24 (see Counter.partition_stored_actions) and must
+# not be decreased while there are not processed records.
+AGGREGATION_PARTITIONS = 1
+
+# Memcache key prefix for per counter contention telemetry: number of
+# writes, transaction retries and failed transactions.
+CONTENTION_KEY_PREFIX = 'gcounter:contention:'
+
+# Telemetry is collected in time slots of CONTENTION_WINDOW seconds. Only
+# the current and the previous slot are read, so older writes never count.
+CONTENTION_WINDOW = 600
+
+# Counters with retries are registered for autoscaling. Registration
+# markers expire after this many seconds.
+CONTENTION_MARKER_TIME = 600
+
+# Counter.autoscale_shards() multiplies the number of shards by
+# AUTOSCALE_FACTOR (never above AUTOSCALE_MAX_SHARDS) for counters with at
+# least AUTOSCALE_MIN_WRITES writes and contention rate (retries and
+# failures per write) of at least AUTOSCALE_THRESHOLD.
+AUTOSCALE_THRESHOLD = 0.1
+AUTOSCALE_MIN_WRITES = 20
+AUTOSCALE_FACTOR = 2
+AUTOSCALE_MAX_SHARDS = 200
+
+# Shard consolidation (see Counter.consolidate_cold_shards): counters with
+# more than CONSOLIDATION_NUM_SHARDS shards and at most
+# CONSOLIDATION_MAX_WRITES writes in the telemetry window are
+# consolidated to CONSOLIDATION_NUM_SHARDS shards. Configs are processed
+# CONSOLIDATION_BATCH_SIZE at a time.
+CONSOLIDATION_NUM_SHARDS = 5
+CONSOLIDATION_MAX_WRITES = 10
+CONSOLIDATION_BATCH_SIZE = 100
+
+# Seconds between lowering the number of shards and folding values of not
+# used shards. Must be greater than SHARD_CONFIG_LOCAL_TIME so all the
+# instances stop writing to not used shards.
+CONSOLIDATION_GRACE_TIME = 2 * SHARD_CONFIG_LOCAL_TIME
+
+# Consolidation task URL and queue
+CONSOLIDATION_URL = '/admin/scr/consolidate-shards'
+CONSOLIDATION_QUEUE = 'default'
+
+# How counter shards are stored (see ShardScheme):
+#   'name' - shard IDs are built from the counter name
+#   'hash' - shard IDs are built from fixed length hash of the counter name
+#   'v2'   - like 'hash' but stored in kinds without indexed properties
+SHARD_SCHEME = 'name'
+
+# The scheme counters are migrated from (see Counter.migrate_shards). While
+# it's set counters are read from both schemes.
+SHARD_SCHEME_PREVIOUS = None
+
+# Shard migration: number of shard configs processed at once, task URL and queue
+SHARD_MIGRATION_BATCH_SIZE = 100
+SHARD_MIGRATION_URL = '/admin/scr/migrate-shards'
+SHARD_MIGRATION_QUEUE = 'default'
+
+# Separator of counter name levels used by the prefix index of counter
+# names (see Counter.get_children). Slugified values never contain it.
+COUNTER_NAME_SEPARATOR = ':'
+
+# Time bucketed counters (see TrackedProperty time_bucket argument). Names of
+# bucket counters are 'counter@granularity:stamp', for example
+# 'users@day:20131018'. Time is in UTC.
+TIME_BUCKET_SEPARATOR = '@'
+TIME_BUCKET_FORMATS = {'hour': '%Y%m%d%H', 'day': '%Y%m%d', 'month': '%Y%m'}
+
+# Number of shards of new bucket counters
+TIME_BUCKET_NUM_SHARDS = 5
+
+# Fine buckets are compacted into coarse ones (see Counter.rollup_time_buckets)
+# TIME_BUCKET_ROLLUP_DELAY seconds after their period ends.
+TIME_BUCKET_ROLLUP = {'hour': 'day'}
+TIME_BUCKET_ROLLUP_DELAY = 3600
+
+# Counter.get_series() reads not compacted fine buckets of periods which
+# ended less than TIME_BUCKET_UNROLLED_TIME seconds ago.
+TIME_BUCKET_UNROLLED_TIME = 86400
+
+# Rollup: number of buckets compacted at once, task URL and queue
+TIME_BUCKET_ROLLUP_BATCH_SIZE = 100
+TIME_BUCKET_ROLLUP_URL = '/admin/scr/rollup-time-buckets'
+TIME_BUCKET_ROLLUP_QUEUE = 'default'
+
+# Rolling window counters (see RollingCounter): default length of time slot
+# in seconds, number of slots in the ring and number of shards per slot.
+ROLLING_SLOT_TIME = 60
+ROLLING_SLOTS = 60
+ROLLING_NUM_SHARDS = 5
+
+# Window counts are cached in memcache for ROLLING_CACHE_TIME seconds
+ROLLING_CACHE_TIME = 10
+ROLLING_KEY_PREFIX = 'gcounter:rolling:'
+
+# HyperLogLog distinct counters (see HyperLogLogProperty): prefix of
+# counter action names, default precision (sketch has 2 ** precision
+# registers and standard error 1.04 / sqrt(2 ** precision)) and number of
+# shards. Every shard is a full sketch so a counter takes up to
+# HLL_NUM_SHARDS * 2 ** precision bytes. Never lower HLL_NUM_SHARDS.
+HLL_ACTION_PREFIX = 'hll|'
+HLL_PRECISION = 12
+HLL_NUM_SHARDS = 5
+
+# Distinct counts are cached in memcache for HLL_CACHE_TIME seconds
+HLL_CACHE_TIME = 60
+HLL_KEY_PREFIX = 'gcounter:hll:'
+
+# Heavy hitters of complex counter families: template -> number of
+# tracked counters per shard. Properties with top_k set register their
+# templates here. The first write of a process stores them as
+# TopCounterFamily entities so processes which don't import the models
+# (like gcounter_tasks) update the summaries too. Stored families are
+# reloaded every TOP_K_FAMILIES_CACHE_TIME seconds. Counter names are
+# spread over TOP_K_NUM_SHARDS summaries by hash so never change it for
+# families that already have summaries.
+TOP_K_FAMILIES = {}
+TOP_K_FAMILIES_CACHE_TIME = 60
+TOP_K_NUM_SHARDS = 5
+
+# Count-min sketch counter families (see CountMinProperty): prefix of
+# counter action names, prefix of the counters keeping family totals,
+# default sketch width and depth, number of cells stored in one entity and
+# number of shards of every block. Estimates exceed true counts by at most
+# e / width of the family total with probability 1 - e ** -depth.
+# COUNT_MIN_FAMILIES maps templates to (width, depth) and is filled by
+# the properties. Never lower CMS_NUM_SHARDS.
+CMS_ACTION_PREFIX = 'cms|'
+CMS_TOTAL_PREFIX = 'cms-total|'
+CMS_WIDTH = 2048
+CMS_DEPTH = 4
+CMS_BLOCK_SIZE = 256
+CMS_NUM_SHARDS = 5
+COUNT_MIN_FAMILIES = {}
+
+# Indexing of counters created before the prefix index existed (see
+# Counter.index_counter_names): batch size, task URL and queue.
+NAME_INDEX_BATCH_SIZE = 500
+NAME_INDEX_URL = '/admin/scr/index-counter-names'
+NAME_INDEX_QUEUE = 'default'
+
+# Patterns used by TextTools.slugify
+_slugify_strip_re = re.compile(r'[^\w\s-]')
+_slugify_hyphenate_re = re.compile(r'[-\s]+')
+
 
 class NotSupportedError(Exception):
     pass
@@ -39,6 +246,78 @@ class ModelTrackingNotSaved(Exception):
     pass
 
 
+class TrackingSchema(object):
+    """Compiled description of model properties used for change tracking.
+
+        Built once per model class (see Model._get_tracking_schema) and
+        shared by all the instances. Treat it as read only.
+
+        Attributes:
+            prop_def - dictionary with property definitions
+            prop_names - frozenset with all property names
+            tracked_names - tuple with names of tracked properties
+            rev_deps - reverse dependencies (property name -> tuple of
+                       names of properties depending on it)
+            snapshot - tuple of (name, property, is repeated) tuples describing
+                       properties captured in baseline snapshots: tracked
+                       properties and properties they depend on
+            lazy_baseline - True if baseline capture can be deferred till
+                            the first write. It can't for models with tracked
+                            computed properties because their values may
+                            change without writes to the tracked properties.
+    """
+
+    __slots__ = ('prop_def', 'prop_names', 'tracked_names', 'rev_deps', 'snapshot', 'lazy_baseline')
+
+    def __init__(self, model_class):
+        prop_def = {}
+        rev_deps = {}
+
+        for name, prop in model_class._properties.items():
+
+            if isinstance(prop, TrackedProperty):
+                tracked = True
+                deps = tuple(prop._dependencies)
+                beh = prop._counter_behaviour
+            else:
+                tracked = False
+                deps = ()
+                beh = None
+
+            prop_def[name] = {
+                'def': prop._default,
+                'req': prop._required,
+                'rep': prop._repeated,
+                'tra': tracked,
+                'dep': deps,
+                'beh': beh}
+
+            if beh is not None and beh.startswith('CP'):
+                prop_def[name]['def'] = None
+
+            # Build reverse dependencies dictionary
+            for dep in deps:
+                if dep not in rev_deps:
+                    rev_deps[dep] = [name]
+                elif name not in rev_deps[dep]:
+                    rev_deps[dep].append(name)
+
+        self.prop_def = prop_def
+        self.prop_names = frozenset(prop_def.keys())
+        self.tracked_names = tuple(name for name in prop_def if prop_def[name]['tra'])
+        self.rev_deps = dict((dep, tuple(names)) for dep, names in rev_deps.items())
+
+        snapshot_names = set(self.tracked_names)
+        for name in self.tracked_names:
+            snapshot_names.update(dep for dep in prop_def[name]['dep'] if dep in prop_def)
+
+        self.lazy_baseline = not any(prop_def[name]['beh'].startswith('CP') for name in self.tracked_names)
+
+        properties = model_class._properties
+        self.snapshot = tuple((name, properties[name], properties[name]._repeated)
+                              for name in sorted(snapshot_names))
+
+
 class Model(ndb.Model):
     """Base class for models that want to support property change tracking
         and global counters.
@@ -46,21 +325,22 @@ class Model(ndb.Model):
         NOTE: All methods beginning with underscore are considered private
     """
 
+    # Dictionary counter actions are added to after put instead of
+    # keeping them in the entity (see put_multi_with_actions).
+    _actions_sink = None
+
     def __init__(self, *args, **kwds):
 
         if DEBUG:
             print '__init__', args, kwds
 
-        # See: http://docs.python.org/2/reference/datamodel.html#object.__setattr__
-        self.__dict__['_prop_names'] = []
-
         super(Model, self).__init__(*args, **kwds)
 
-        # Get property descriptors
-        self._set_prop_descriptors()
-
-        # Initial values
-        self._init_values = copy.deepcopy(self.to_dict())
+        # Initial values. Captured on the first write to one of the model
+        # properties (see _capture_baseline) so entities that are only read
+        # never pay for it.
+        self._init_values = None
+        self._baseline_pending = True
 
         # True if entity is not persisted in the Datastore
         self._is_new = True
@@ -77,12 +357,14 @@ class Model(ndb.Model):
             # Test if any of the passed keywords set instance properties
             prop_set = self._prop_names & init_keys
             if prop_set:
+                self._capture_baseline()
                 for prop in prop_set:
 
                     # Property values passed by constructor
                     # Doing this we simulate as they would be set
                     # by setters
-                    self._init_values[prop] = self._prop_def[prop]['def']
+                    if prop in self._init_values:
+                        self._init_values[prop] = self._prop_def[prop]['def']
 
                     if self._prop_def[prop]['def'] != kwds[prop]:
                         # If default value is changed during initialization
@@ -90,6 +372,9 @@ class Model(ndb.Model):
                         self._is_dirty = True
                         break
 
+        if not self._get_tracking_schema().lazy_baseline:
+            self._capture_baseline()
+
     def __set__(self, instance, value):
         if DEBUG:
             print 'm __set__ ' + str(instance) + ' ' + str(value)
@@ -109,9 +394,14 @@ class Model(ndb.Model):
 
         # Set as dirty only when name referrers to one of the model properties and
         # its value is different from the current value.
-        # We skip properties that start with '_'.
-        if not name.startswith('_') and name in self._prop_names and getattr(self, name) != value:
-            self.__dict__['_is_dirty'] = True
+        # We skip properties that start with '_' and all the properties set
+        # before the instance is fully initialized (__init__ takes care of them).
+        if not name.startswith('_') and '_is_dirty' in self.__dict__ and name in self._prop_names:
+            # Capture baseline before the first write
+            if self._baseline_pending:
+                self._capture_baseline()
+            if getattr(self, name) != value:
+                self.__dict__['_is_dirty'] = True
 
         super(Model, self).__setattr__(name, value)
 
@@ -155,13 +445,17 @@ class Model(ndb.Model):
         if key:
             # Get counter actions before we change
             # values of _is_new and _is_dirty
-            self._get_counter_actions()
+            if self._actions_sink is None:
+                self._get_counter_actions()
+            else:
+                self._collect_counter_actions(self._actions_sink)
+                self._counter_actions = {}
             # The entity is no longer new
             self._is_new = False
             # We just saved it so it's not dirty
             self._is_dirty = False
             # Reset initial values to the ones we have right now
-            self._init_values = copy.deepcopy(self.to_dict())
+            self._reset_baseline()
 
     @property
     def is_new(self):
@@ -181,53 +475,81 @@ class Model(ndb.Model):
         ret = ndb.Model.put(self, **ctx_options)
         return ret
 
+    @ndb.tasklet
+    def put_actions_async(self, **ctx_options):
+        """Puts model into the Datastore asynchronously
+
+            Returns: future resolving to the dictionary of counter actions
+        """
+        yield self.put_async(**ctx_options)
+        raise ndb.Return(self.get_counter_actions())
+
     def _ensure_saved_and_not_dirty(self):
         """Throws an exception if model is dirty or not saved in the Datastore"""
         if self.is_new or self._is_dirty:
             raise ModelTrackingNotSaved('You have to put the model in the Datastore before you can get counter actions.')
 
-    def _set_prop_descriptors(self):
-        """Create dictionaries describing model properties
-
-            Sets:
-                self._prop_def - dictionary with property definitions
-                self._prop_names - set with all property names
-                self._rev_deps - reverse dependencies
+    @classmethod
+    def _get_tracking_schema(cls):
+        """Get compiled tracking schema for this model class
 
+            The schema is built on first use and shared by all instances
+            of the class. Subclasses get their own schema.
         """
-        self._prop_def = {}
-        self._rev_deps = {}
+        schema = cls.__dict__.get('_tracking_schema')
+        if schema is None:
+            schema = TrackingSchema(cls)
+            cls._tracking_schema = schema
+        return schema
 
-        for name, prop in self.__class__._properties.items():
+    @property
+    def _prop_def(self):
+        """Dictionary with property definitions"""
+        return self._get_tracking_schema().prop_def
 
-            if isinstance(prop, TrackedProperty):
-                tracked = True
-                deps = prop._dependencies
-                beh = prop._counter_behaviour
-            else:
-                tracked = False
-                deps = []
-                beh = None
+    @property
+    def _rev_deps(self):
+        """Reverse dependencies"""
+        return self._get_tracking_schema().rev_deps
 
-            self._prop_def[name] = {
-                'def': prop._default,
-                'req': prop._required,
-                'rep': prop._repeated,
-                'tra': tracked,
-                'dep': deps,
-                'beh': beh}
+    @property
+    def _prop_names(self):
+        """Set with all property names"""
+        return self._get_tracking_schema().prop_names
 
-            if beh is not None and prop._counter_behaviour.startswith('CP'):
-                self._prop_def[name]['def'] = None
+    def _snapshot_values(self):
+        """Capture values of tracked properties and their dependencies
 
-            # Build reverse dependencies dictionary
-            for dep in deps:
-                if dep not in self._rev_deps:
-                    self._rev_deps[dep] = [name]
-                elif name not in self._rev_deps[dep]:
-                    self._rev_deps[dep].append(name)
+            Scalar values are kept as they are and repeated values are frozen
+            into tuples so changing the list in place does not change the
+            snapshot. Nothing else is copied.
 
-        self._prop_names = set(self._prop_def.keys())
+            Returns: dictionary property name -> value
+        """
+        values = {}
+        for name, prop, repeated in self._get_tracking_schema().snapshot:
+            value = prop._get_value(self)
+            if repeated and value is not None:
+                value = tuple(value)
+            values[name] = value
+        return values
+
+    def _capture_baseline(self):
+        """Capture initial values if the capture is still pending"""
+        if self._baseline_pending:
+            # Must be set before taking the snapshot because reading
+            # repeated tracked properties calls this method.
+            self._baseline_pending = False
+            self._init_values = self._snapshot_values()
+
+    def _reset_baseline(self):
+        """Make current property values the initial values"""
+        if self._get_tracking_schema().lazy_baseline:
+            self._init_values = None
+            self._baseline_pending = True
+        else:
+            self._baseline_pending = False
+            self._init_values = self._snapshot_values()
 
     def _get_counter_actions(self):
         """Get counter actions"""
@@ -238,11 +560,30 @@ class Model(ndb.Model):
         else:
             self._counter_actions = {}
 
+    def _collect_counter_actions(self, actions):
+        """Add counter actions to actions dictionary
+
+            Deltas are added to the ones already in the dictionary.
+            Counters with delta equal to 0 are not removed.
+        """
+        updated_properties = self._get_updated_properties()
+        if updated_properties:
+            for property_actions in self._get_actions(updated_properties):
+                for counter_name, delta in property_actions.items():
+                    actions[counter_name] = actions.get(counter_name, 0) + delta
+
     def _get_updated_properties(self):
         """Get watched properties that have changed since last time the entity
             was put to the Datastore.
         """
-        new_values = self.to_dict()
+        if self._baseline_pending:
+            # Nothing was written since the entity was created, retrieved
+            # from the Datastore or put. Only new entities may need actions.
+            if not self._is_new:
+                return {}
+            self._capture_baseline()
+
+        new_values = self._snapshot_values()
 
         # print '\n-----------------'
         # print 'GET UPDATED PROPERTIES'
@@ -256,10 +597,7 @@ class Model(ndb.Model):
         # Dictionary of updated properties
         updated_properties = {}
 
-        for name in self._prop_names:
-            # Skip properties that are not watched
-            if not self._prop_def[name]['tra']:
-                continue
+        for name in self._get_tracking_schema().tracked_names:
 
             # print 'Prop name: ', name
 
@@ -309,16 +647,18 @@ class Model(ndb.Model):
 
                         if dep_name in self._init_values:
                             old_dep = self._init_values[dep_name]
+                            new_dep = new_values[dep_name]
                             deps = self._prop_def[dep_name]['dep']
                             dep_def = self._prop_def[dep_name]['def']
                         else:
                             old_dep = getattr(self, dep_name)
+                            new_dep = old_dep
                             deps = []
                             dep_def = self.__class__._properties[dep_name]._default
 
                         updated_properties[dep_name] = {
                             'old': old_dep,
-                            'new': getattr(self, dep_name),
+                            'new': new_dep,
                             'dep': deps,
                             'def': dep_def}
 
@@ -347,7 +687,7 @@ class Model(ndb.Model):
                         'old': getattr(self, dep_name)}
 
             # Get action based on property type
-            action = prop._get_counter_actions(data, self.is_new, deps)
+            action = prop._add_time_buckets(prop._get_counter_actions(data, self.is_new, deps))
 
             if action:
                 counter_actions.append(action)
@@ -373,12 +713,51 @@ class TrackedProperty(object):
         NOTE: All methods beginning with underscore are considered private
     """
 
+    # Granularity of time bucket counters or None
+    _time_bucket = None
+
     def __init__(self):
         self._counter_type = None
         self._counter_name = None
+        self._counter_template = None
         self._repeated = False
         self._counter_behaviour = None
 
+    def _set_counter_name(self, counter_name):
+        """Set counter name and compile it"""
+        self._counter_name = counter_name
+        self._counter_template = CounterNameTemplate(counter_name)
+        self._counter_type = self._get_counter_type()
+
+    def _set_time_bucket(self, time_bucket):
+        """Set granularity of time bucket counters"""
+        if time_bucket is not None and time_bucket not in TIME_BUCKET_FORMATS:
+            raise ModelTrackingError('Unknown time bucket %s.' % time_bucket)
+        self._time_bucket = time_bucket
+
+    def _set_top_k(self, top_k):
+        """Track heavy hitters of the complex counter family"""
+        if top_k is None:
+            return
+        if self._counter_type != 'cc' or len(self._counter_template.fields) != 1:
+            raise ModelTrackingError('Only complex counters with one %s can track top counters.')
+        if top_k < 1:
+            raise ModelTrackingError('Number of top counters must be positive.')
+        TOP_K_FAMILIES[self._counter_name] = max(top_k, TOP_K_FAMILIES.get(self._counter_name, 0))
+
+    def _add_time_buckets(self, actions, when=None):
+        """Add changes of time bucket counters to counter actions"""
+        if self._time_bucket is None or not actions:
+            return actions
+
+        when = when or datetime.datetime.utcnow()
+
+        bucketed = dict(actions)
+        for name, delta in actions.items():
+            Counter.add_delta(bucketed, TimeBucket.name(name, self._time_bucket, when), delta)
+
+        return bucketed
+
     def is_simple_counter(self):
         return self._counter_type == 'sc'
 
@@ -404,8 +783,7 @@ class TrackedProperty(object):
     def _dependencies(self):
         """Get list of property names this property is dependent on"""
 
-        deps = re.findall(r'<([a-z_0-9]+)>', self._counter_name, re.I)
-        return list(set(deps))
+        return list(self._counter_template.dependencies)
 
     def _get_counter_actions_int(self, change, is_new, **kwds):
         """Get global counter actions for gcounter.IntegerProperty properties"""
@@ -433,6 +811,21 @@ class TrackedProperty(object):
 
         return actions
 
+    def _get_counter_actions_sum(self, change, is_new, **kwds):
+        """Get global counter actions for gcounter.SumProperty properties"""
+
+        old_value = change['old'] or 0
+        new_value = change['new'] or 0
+
+        # New entity adds its whole value to the sum
+        if is_new:
+            old_value = 0
+
+        if new_value == old_value:
+            return {}
+
+        return Counter.add_delta({}, self._counter_name, new_value - old_value)
+
     def _get_counter_actions_boolean(self, change, is_new, **kwds):
 
         old_value = change['old']
@@ -464,30 +857,25 @@ class TrackedProperty(object):
             Note: For dependent counter the value is expected to be a list
         """
 
-        if value in [None, '', []]:
+        if value in [None, '', [], ()]:
             return None
 
         if self._counter_type == 'sc':
             return self._counter_name
-        elif self._counter_type == 'cc':
-            return self._counter_name % TextTools.slugify(value)
-        elif self._counter_type == 'dc':
-            counter_name = self._counter_name
-
-            for dep_name, dep_value in deps.items():
-                marker = '<' + dep_name + '>'
-
-                if dep_value is None:
-                    dep_value = ''
+        elif self._counter_type in ('cc', 'dc'):
+            value_slug = None
+            values = []
+
+            for field in self._counter_template.fields:
+                if field is None:
+                    if value_slug is None:
+                        value_slug = TextTools.slugify(value)
+                    values.append(value_slug)
                 else:
-                    dep_value = TextTools.slugify(dep_value)
-
-                counter_name = counter_name.replace(marker, dep_value)
+                    dep_value = deps.get(field)
+                    values.append(u'' if dep_value is None else TextTools.slugify(dep_value))
 
-            if '%s' in counter_name:
-                counter_name = counter_name % TextTools.slugify(value)
-
-            return counter_name
+            return self._counter_template.render(tuple(values))
         else:
             raise NotSupportedError
 
@@ -562,10 +950,10 @@ class TrackedProperty(object):
 
 class IntegerProperty(ndb.IntegerProperty, TrackedProperty):
 
-    def __init__(self, counter_name, **kwds):
+    def __init__(self, counter_name, time_bucket=None, **kwds):
         super(IntegerProperty, self).__init__(**kwds)
-        self._counter_name = counter_name
-        self._counter_type = self._get_counter_type()
+        self._set_counter_name(counter_name)
+        self._set_time_bucket(time_bucket)
         self._counter_behaviour = 'IntegerProperty'
         IntegerProperty._validate_counter(self)
 
@@ -580,12 +968,97 @@ class IntegerProperty(ndb.IntegerProperty, TrackedProperty):
         return self._get_counter_actions_int(change, is_new)
 
 
+class SumProperty(IntegerProperty):
+    """Integer property keeping sum of values of all the entities
+
+        Changes emit the difference between the new and the old value, new
+        entities emit the whole value. None is treated as 0.
+    """
+
+    def __init__(self, counter_name, time_bucket=None, **kwds):
+        super(SumProperty, self).__init__(counter_name, time_bucket, **kwds)
+        self._counter_behaviour = 'SumProperty'
+
+    def _get_counter_actions(self, change, is_new, deps=None):
+        return self._get_counter_actions_sum(change, is_new)
+
+
+class HistogramProperty(ndb.IntegerProperty, TrackedProperty):
+    """Integer property counting entities in buckets of values
+
+        The counter name must have one %s placeholder which is replaced
+        with the bucket label (see HistogramProperty.bucket_label). Moving
+        value to another bucket emits -1 for the old and +1 for the new
+        bucket counter. None is not counted in any bucket.
+    """
+
+    def __init__(self, counter_name, boundaries, time_bucket=None, **kwds):
+        super(HistogramProperty, self).__init__(**kwds)
+        self._set_counter_name(counter_name)
+        self._set_time_bucket(time_bucket)
+        self._counter_behaviour = 'HistogramProperty'
+        self._boundaries = tuple(boundaries)
+        HistogramProperty._validate_counter(self)
+
+    @staticmethod
+    def _validate_counter(inst):
+        if inst._repeated:
+            raise ModelTrackingError('Tracked HistogramProperty cannot be repeated property.')
+        if inst._counter_type != 'cc' or len(inst._counter_template.fields) != 1:
+            raise ModelTrackingError('Tracked HistogramProperty must be complex counter type with one %s.')
+        if not inst._boundaries or list(inst._boundaries) != sorted(set(inst._boundaries)):
+            raise ModelTrackingError('Tracked HistogramProperty boundaries must be increasing.')
+
+    @staticmethod
+    def bucket_label(boundaries, value):
+        """Get label of the bucket the value belongs to
+
+            Buckets start at the boundaries and end before the next one.
+            Bucket of values lower than the first boundary is labeled
+            'lt<first boundary>' and the other ones with their lower
+            boundary.
+
+            Arguments:
+                boundaries - increasing bucket boundaries
+                value - the value
+        """
+        idx = bisect.bisect_right(boundaries, value)
+        if idx == 0:
+            return 'lt%d' % boundaries[0]
+        return '%d' % boundaries[idx - 1]
+
+    @staticmethod
+    def bucket_labels(boundaries):
+        """Get labels of all the buckets in order"""
+        return ['lt%d' % boundaries[0]] + ['%d' % boundary for boundary in boundaries]
+
+    def _get_bucket_counter(self, value):
+        if value is None:
+            return None
+        return self._counter_template.render((HistogramProperty.bucket_label(self._boundaries, value),))
+
+    def _get_counter_actions(self, change, is_new, deps=None):
+        old_counter = None if is_new else self._get_bucket_counter(change['old'])
+        new_counter = self._get_bucket_counter(change['new'])
+
+        actions = {}
+        if old_counter == new_counter:
+            return actions
+
+        if old_counter is not None:
+            Counter.add_delta(actions, old_counter, -1)
+        if new_counter is not None:
+            Counter.add_delta(actions, new_counter, 1)
+
+        return actions
+
+
 class BooleanProperty(ndb.BooleanProperty, TrackedProperty):
 
-    def __init__(self, counter_name, **kwds):
+    def __init__(self, counter_name, time_bucket=None, **kwds):
         super(BooleanProperty, self).__init__(**kwds)
-        self._counter_name = counter_name
-        self._counter_type = self._get_counter_type()
+        self._set_counter_name(counter_name)
+        self._set_time_bucket(time_bucket)
         self._counter_behaviour = 'BooleanProperty'
         BooleanProperty._validate_counter(self)
 
@@ -602,10 +1075,11 @@ class BooleanProperty(ndb.BooleanProperty, TrackedProperty):
 
 class StringProperty(ndb.StringProperty, TrackedProperty):
 
-    def __init__(self, counter_name, **kwds):
+    def __init__(self, counter_name, time_bucket=None, top_k=None, **kwds):
         super(StringProperty, self).__init__(**kwds)
-        self._counter_name = counter_name
-        self._counter_type = self._get_counter_type()
+        self._set_counter_name(counter_name)
+        self._set_time_bucket(time_bucket)
+        self._set_top_k(top_k)
         self._counter_behaviour = 'StringProperty'
         StringProperty._validate_counter(self)
 
@@ -614,6 +1088,13 @@ class StringProperty(ndb.StringProperty, TrackedProperty):
         if inst._counter_type == 'dc' and inst._repeated:
             raise ModelTrackingError('You cannot have repeated and dependent counter property in the same time.')
 
+    def _get_value(self, entity):
+        # Repeated values can be changed in place without calling setters
+        # so the baseline has to be captured before the list is handed out.
+        if self._repeated and entity.__dict__.get('_baseline_pending'):
+            entity._capture_baseline()
+        return super(StringProperty, self)._get_value(entity)
+
     def _validate(self, value):
         super(StringProperty, self)._validate(value)
         if value == '':
@@ -623,12 +1104,86 @@ class StringProperty(ndb.StringProperty, TrackedProperty):
         return self._get_counter_actions_string(change, is_new, deps)
 
 
+class HyperLogLogProperty(StringProperty):
+    """String property counting distinct values of all the entities
+
+        Values are slugified and added to HyperLogLog sketch of the counter
+        (see Counter.get_distinct_count). Values can't be removed from the
+        sketch so only added values emit counter actions.
+    """
+
+    def __init__(self, counter_name, precision=None, **kwds):
+        if kwds.get('time_bucket') is not None:
+            raise ModelTrackingError('Tracked HyperLogLogProperty cannot have time buckets.')
+
+        super(HyperLogLogProperty, self).__init__(counter_name, **kwds)
+        self._counter_behaviour = 'HyperLogLogProperty'
+        self._precision = precision or HLL_PRECISION
+        HyperLogLogProperty._validate_counter(self)
+
+    @staticmethod
+    def _validate_counter(inst):
+        if inst._counter_type != 'sc':
+            raise ModelTrackingError('Tracked HyperLogLogProperty must be simple counter type.')
+        if not 4 <= inst._precision <= 16:
+            raise ModelTrackingError('Tracked HyperLogLogProperty precision must be between 4 and 16.')
+
+    def _get_counter_actions(self, change, is_new, deps=None):
+        new_values = change['new'] if self._repeated else [change['new']]
+        old_values = change['old'] if self._repeated else [change['old']]
+
+        actions = {}
+        for value in new_values or []:
+            if value in [None, ''] or (not is_new and value in (old_values or [])):
+                continue
+            name = HyperLogLogSketch.action_name(self._counter_name, self._precision, TextTools.slugify(value))
+            actions[name] = 1
+
+        return actions
+
+
+class CountMinProperty(StringProperty):
+    """Complex counter property counting values in count-min sketch
+
+        Instead of one counter per value all the values of the family
+        share a fixed size sketch (see Counter.get_estimates) so storage
+        does not grow with the number of distinct values.
+    """
+
+    def __init__(self, counter_name, width=None, depth=None, **kwds):
+        if kwds.get('time_bucket') is not None or kwds.get('top_k') is not None:
+            raise ModelTrackingError('Tracked CountMinProperty cannot have time buckets or top counters.')
+
+        super(CountMinProperty, self).__init__(counter_name, **kwds)
+        self._counter_behaviour = 'CountMinProperty'
+        self._width = width or CMS_WIDTH
+        self._depth = depth or CMS_DEPTH
+        CountMinProperty._validate_counter(self)
+
+        dimensions = COUNT_MIN_FAMILIES.setdefault(counter_name, (self._width, self._depth))
+        if dimensions != (self._width, self._depth):
+            raise ModelTrackingError('Count-min sketch %s is already %dx%d.' % ((counter_name,) + dimensions))
+
+    @staticmethod
+    def _validate_counter(inst):
+        if inst._counter_type != 'cc' or len(inst._counter_template.fields) != 1:
+            raise ModelTrackingError('Tracked CountMinProperty must be complex counter type with one %s.')
+        if inst._width < 1 or not 1 <= inst._depth <= 10:
+            raise ModelTrackingError('Tracked CountMinProperty width must be positive and depth between 1 and 10.')
+
+    def _get_counter(self, value, deps=None):
+        if value in [None, '', [], ()]:
+            return None
+        return CountMinSketch.action_name(self._counter_name, self._width, self._depth, TextTools.slugify(value))
+
+
 class ComputedProperty(ndb.ComputedProperty, TrackedProperty):
 
-    def __init__(self, func, counter_name, behaviour='StringProperty', name=None, indexed=None, repeated=None):
+    def __init__(self, func, counter_name, behaviour='StringProperty', name=None, indexed=None, repeated=None,
+                 time_bucket=None):
         super(ComputedProperty, self).__init__(func, name, indexed, repeated)
-        self._counter_name = counter_name
-        self._counter_type = self._get_counter_type()
+        self._set_counter_name(counter_name)
+        self._set_time_bucket(time_bucket)
         self._counter_behaviour = 'CP' + behaviour
 
     def _get_counter_actions(self, change, is_new, deps=None):
@@ -641,202 +1196,2754 @@ class ComputedProperty(ndb.ComputedProperty, TrackedProperty):
         elif self._counter_behaviour == 'CPIntegerProperty':
             IntegerProperty._validate_counter(self)
             return self._get_counter_actions_int(change, is_new)
+        elif self._counter_behaviour == 'CPSumProperty':
+            IntegerProperty._validate_counter(self)
+            return self._get_counter_actions_sum(change, is_new)
         else:
             raise NotImplementedError
 
 
-class TextTools(object):
-
-    @staticmethod
-    def slugify(value):
-        """
-        Normalizes string, converts to lowercase, removes non-ascii characters,
-        and converts spaces to hyphens.  For use in URLs and filenames
-
-        From Django's "django/template/defaultfilters.py".
-        """
-        _slugify_strip_re = re.compile(r'[^\w\s-]')
-        _slugify_hyphenate_re = re.compile(r'[-\s]+')
-
-        if not isinstance(value, unicode):
-            value = unicode(value)
-        value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
-        value = unicode(_slugify_strip_re.sub('', value).strip().lower())
-        return _slugify_hyphenate_re.sub('-', value)
-
+class CounterNameTemplate(object):
+    """Counter name compiled to a template
 
-class ListDiffer(object):
-    """Calculate the difference between two lists"""
+        Counter names may contain two kinds of placeholders:
 
-    def __init__(self, current_list, old_list):
-        self.intersect = None
-        self.current_list, self.old_list = current_list, old_list
-        self.set_current, self.set_old = set(current_list), set(old_list)
+            <name> - slugified value of the model property 'name'
+            %s     - slugified value of the tracked property
 
-    def added(self):
-        return self.set_current - self.set_old
+        Example: 'loc:<co>:<reg>:%s' has fields ('co', 'reg', None) where
+        None stands for the tracked property value.
+    """
 
-    def removed(self):
-        return self.set_old - self.set_current
+    _field_re = re.compile(r'<([a-z_0-9]+)>|%s', re.I)
 
-    def get_intersect(self):
-        if self.intersect is None:
-            self.intersect = self.set_current.intersection(self.set_old)
+    __slots__ = ('name', 'fields', 'dependencies', '_format')
 
-    def changed(self):
-        self.get_intersect()
-        return set(o for o in self.intersect if self.old_list[o] != self.current_list[o])
+    def __init__(self, name):
+        self.name = name
 
-    def unchanged(self):
-        self.get_intersect()
-        return set(o for o in self.intersect if self.old_list[o] == self.current_list[o])
+        # Percent signs are escaped only when the name is going to be formatted
+        formatted = '%s' in name
 
+        fields = []
+        parts = []
+        pos = 0
 
-class GeneralCounterShardConfig(ndb.Model):
-    """Tracks the number of shards for each named counter."""
+        for match in self._field_re.finditer(name):
+            literal = name[pos:match.start()]
+            parts.append(literal.replace('%%', '%').replace('%', '%%') if formatted else literal.replace('%', '%%'))
+            parts.append('%s')
+            fields.append(match.group(1))
+            pos = match.end()
 
-    name = ndb.StringProperty(required=True)
-    num_shards = ndb.IntegerProperty(default=20, indexed=False)
+        literal = name[pos:]
+        parts.append(literal.replace('%%', '%').replace('%', '%%') if formatted else literal.replace('%', '%%'))
 
+        self.fields = tuple(fields)
+        self.dependencies = tuple(sorted(set(field for field in fields if field is not None)))
+        self._format = ''.join(parts)
 
-class GeneralCounterShard(ndb.Model):
-    """Shards for each named counter"""
+    def render(self, values):
+        """Render counter name
 
-    name = ndb.StringProperty(required=True)
-    count = ndb.IntegerProperty(default=0, indexed=False)
+            Arguments:
+                values - tuple of slugified values, one for each field
+        """
+        return self._format % values
 
 
-class CounterActions(ndb.Model):
-    """Counter actions
+class LRUCache(object):
+    """Thread safe dictionary of limited size
 
-        Helper model to store multiple operations on counters as JSON object.
-        This is later used to aggregate many counter actions (add, subtract).
+        When full the least recently used entry is evicted.
+    """
 
-        It's used to save thousands of calls to Datastore by first aggregating
-        actions on the same counters and then making a call to edit a counter in
-        Datastore.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get value for the key and mark it as recently used"""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Set value for the key evicting the least recently used entry if needed"""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove key from the cache"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries and reset statistics"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Get cache statistics"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class BoundedCache(object):
+    """Dictionary of limited size for memoizing pure functions
+
+        Reads take no lock and don't reorder entries, so a hit costs one
+        dictionary lookup. When full the cache is cleared and the hot
+        entries come back with the next calls. Statistics are approximate
+        when many threads use the cache.
     """
 
-    actions = ndb.JsonProperty(required=True)
-    processed = ndb.BooleanProperty(default=False)
-    created = ndb.DateTimeProperty(auto_now_add=True)
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+
+    def get(self, key, default=None):
+        """Get value for the key"""
+        value = self._data.get(key, default)
+        if value is default:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Set value for the key clearing the cache if it's full"""
+        if len(self._data) >= self.maxsize:
+            self._data.clear()
+        self._data[key] = value
+
+    def clear(self):
+        """Remove all entries and reset statistics"""
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """Get cache statistics"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class MemcacheNameSet(object):
+    """Set of names kept in memcache
+
+        Names are spread over a number of memcache entries (buckets) which
+        are updated with compare-and-set so concurrent writers rarely
+        collide. Like everything in memcache the set may be evicted.
+    """
 
+    def __init__(self, key_prefix, buckets=16, retries=10):
+        self.key_prefix = key_prefix
+        self.buckets = buckets
+        self.retries = retries
 
-class Counter(object):
-    """Utility class for shard counters"""
+    def _bucket_key(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return '%s%d' % (self.key_prefix, zlib.crc32(name) % self.buckets)
 
-    @staticmethod
-    def get_count(name, force=False):
-        """Retrieve the value for a given sharded counter.
+    def add(self, name):
+        """Add name to the set
 
-        Arguments:
-          name - The name of the counter
-          force - Set to True to force counter retrieval from the Datastore
+            Returns: False if the set could not be updated
         """
-        total = memcache.get(name)
-        if total is None or force is True:
-            total = 0
-            for counter in GeneralCounterShard.query(GeneralCounterShard.name == name):
-                total += counter.count
-            memcache.add(name, total, 60)
-        return total
+        client = memcache.Client()
+        key = self._bucket_key(name)
 
-    @staticmethod
-    def incr(name):
-        """Increment the value for a given shard counter.
+        for _ in range(self.retries):
+            names = client.gets(key)
+            if names is None:
+                if client.add(key, [name]):
+                    return True
+            elif name in names:
+                return True
+            elif client.cas(key, names + [name]):
+                return True
 
-        Arguments:
-          name - The name of the counter
-        """
-        Counter.change_counter(name, 1)
+        return False
 
-    @staticmethod
-    def decr(name):
-        """Decrement the value for a given shard counter.
+    def remove_multi(self, names):
+        """Remove names from the set
 
-        Arguments:
-          name - The name of the counter
+            Returns: False if any of the buckets could not be updated
         """
-        Counter.change_counter(name, -1)
+        by_bucket = {}
+        for name in names:
+            by_bucket.setdefault(self._bucket_key(name), set()).add(name)
+
+        client = memcache.Client()
+        success = True
+
+        for key, bucket_names in by_bucket.items():
+            for _ in range(self.retries):
+                current = client.gets(key)
+                if current is None:
+                    break
+                if client.cas(key, [name for name in current if name not in bucket_names]):
+                    break
+            else:
+                success = False
 
-    @staticmethod
-    def change_counter(name, delta):
-        """Change counter value by delta
+        return success
 
-            Arguments:
-                name - the name of the counter
-                delta - the change delta. Ex.: -1, +1, +10...
-        """
-        config = GeneralCounterShardConfig.get_or_insert(name, name=name)
+    def get_all(self):
+        """Get all the names in the set"""
+        keys = ['%s%d' % (self.key_prefix, idx) for idx in range(self.buckets)]
+        names = set()
+        for bucket_names in memcache.get_multi(keys).values():
+            names.update(bucket_names)
+        return list(names)
 
-        @ndb.transactional
-        def txn():
-            index = random.randint(0, config.num_shards - 1)
-            shard_name = name + str(index)
-            counter = GeneralCounterShard.get_by_id(shard_name)
-            if counter is None:
-                counter = GeneralCounterShard(id=shard_name, name=name)
-            counter.count += delta
-            counter.put()
 
-        txn()
+class TextTools(object):
 
-        memcache.delete(name)
+    # Memoized slugs. Hits must be cheaper than the ASCII fast path of
+    # _slugify so the cache is not LRUCache (lock and reordering per hit).
+    slug_cache = BoundedCache(SLUG_CACHE_SIZE)
 
     @staticmethod
-    def increase_shards(name, num):
+    def slugify(value):
+        """
+        Normalizes string, converts to lowercase, removes non-ascii characters,
+        and converts spaces to hyphens.  For use in URLs and filenames
+
+        Results are memoized in TextTools.slug_cache.
+        """
+        if not isinstance(value, basestring):
+            value = unicode(value)
+
+        slug = TextTools.slug_cache.get(value)
+        if slug is None:
+            slug = TextTools._slugify(value)
+            TextTools.slug_cache.set(value, slug)
+
+        return slug
+
+    @staticmethod
+    def _slugify(value):
+        """Not memoized slugify
+
+        From Django's "django/template/defaultfilters.py".
+        """
+        if not isinstance(value, unicode):
+            value = unicode(value)
+
+        try:
+            # Fast path: normalization does not change ASCII strings
+            value = value.encode('ascii')
+        except UnicodeEncodeError:
+            value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
+
+        value = unicode(_slugify_strip_re.sub('', value).strip().lower())
+        return _slugify_hyphenate_re.sub('-', value)
+
+    @staticmethod
+    def slug_cache_info():
+        """Get slug cache statistics: hits, misses, size, maxsize and hit_rate"""
+        return TextTools.slug_cache.info()
+
+
+class HyperLogLogSketch(object):
+    """HyperLogLog sketch estimating number of distinct values
+
+        Values are hashed to 64 bits. First precision bits select one of
+        2 ** precision registers, which keeps the maximal position of the
+        first set bit of the rest of the hash. Sketches are merged by
+        taking maximum of every register.
+    """
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=None, registers=None):
+        self.precision = precision or HLL_PRECISION
+        if registers is None:
+            self.registers = bytearray(1 << self.precision)
+        else:
+            self.registers = bytearray(registers)
+
+    @staticmethod
+    def hash(value):
+        """Get 64 bit hash of the value"""
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return int(hashlib.sha1(value).hexdigest()[:16], 16)
+
+    @staticmethod
+    def action_name(counter_name, precision, value):
+        """Get name of counter action adding value to the sketch"""
+        return '%s%d|%s|%016x' % (HLL_ACTION_PREFIX, precision, counter_name, HyperLogLogSketch.hash(value))
+
+    @staticmethod
+    def parse_action_name(name):
+        """Parse counter action name
+
+            Returns: tuple (counter name, precision, hash)
+        """
+        precision, rest = name[len(HLL_ACTION_PREFIX):].split('|', 1)
+        counter_name, hashed = rest.rsplit('|', 1)
+        return counter_name, int(precision), int(hashed, 16)
+
+    def add_hash(self, hashed):
+        """Add hashed value to the sketch
+
+            Returns: True if the sketch changed
+        """
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def add(self, value):
+        """Add value to the sketch
+
+            Returns: True if the sketch changed
+        """
+        return self.add_hash(HyperLogLogSketch.hash(value))
+
+    def merge(self, other):
+        """Merge other sketch with the same precision into this one"""
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches with different precision')
+        self.registers = bytearray(max(pair) for pair in zip(self.registers, other.registers))
+
+    def estimate(self):
+        """Estimate number of distinct values added to the sketch"""
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+
+        # Linear counting for small cardinalities
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+
+        return int(round(estimate))
+
+    def error(self):
+        """Get standard error of the estimate"""
+        return 1.04 / math.sqrt(len(self.registers))
+
+
+class CountMinSketch(object):
+    """Helpers for count-min sketch counters
+
+        Sketch has depth rows of width cells. Every value changes one cell
+        in every row and its estimate is the minimum of these cells. Rows
+        are split into blocks of CMS_BLOCK_SIZE cells. Every block is
+        stored as CMS_NUM_SHARDS CountMinBlock entities summed on read.
+    """
+
+    @staticmethod
+    def action_name(template, width, depth, slug):
+        """Get name of counter action changing the value in the sketch"""
+        return '%s%d|%d|%s|%s' % (CMS_ACTION_PREFIX, width, depth, template, slug)
+
+    @staticmethod
+    def parse_action_name(name):
+        """Parse counter action name
+
+            Returns: tuple (template, width, depth, slug)
+        """
+        width, depth, rest = name[len(CMS_ACTION_PREFIX):].split('|', 2)
+        template, slug = rest.rsplit('|', 1)
+        return template, int(width), int(depth), slug
+
+    @staticmethod
+    def cell_action_name(template, row, column):
+        """Get name of counter action changing one cell of the sketch
+
+            Such actions keep changes of rows which failed to be written.
+        """
+        return '%scell|%d|%d|%s' % (CMS_ACTION_PREFIX, row, column, template)
+
+    @staticmethod
+    def parse_cell_action_name(name):
+        """Parse cell action name
+
+            Returns: tuple (template, row, column) or None if the name is
+                     not cell action name
+        """
+        if not name.startswith(CMS_ACTION_PREFIX + 'cell|'):
+            return None
+        row, column, template = name[len(CMS_ACTION_PREFIX) + 5:].split('|', 2)
+        return template, int(row), int(column)
+
+    @staticmethod
+    def total_name(template):
+        """Get name of the counter keeping total of all the values"""
+        return CMS_TOTAL_PREFIX + template
+
+    @staticmethod
+    def cells(width, depth, slug):
+        """Get cell of the value in every row
+
+            Row hashes are derived from two halves of one MD5 hash.
+
+            Returns: list of column indexes, one for each row
+        """
+        if isinstance(slug, unicode):
+            slug = slug.encode('utf-8')
+        digest = hashlib.md5(slug).hexdigest()
+        h1, h2 = int(digest[:16], 16), int(digest[16:], 16)
+        return [(h1 + row * h2) % width for row in range(depth)]
+
+    @staticmethod
+    def block_key(template, row, block, shard):
+        """Get key of the block shard"""
+        return ndb.Key(CountMinBlock, '%s|%d|%d|%d' % (template, row, block, shard))
+
+    @staticmethod
+    def error_bound(width, total):
+        """Get maximal overestimation of the count
+
+            Holds with probability 1 - e ** -depth.
+        """
+        return int(math.ceil(math.e / width * total))
+
+
+class TimeBucket(object):
+    """Helpers for time bucket counter names and periods"""
+
+    @staticmethod
+    def name(counter_name, granularity, when):
+        """Get name of the time bucket counter
+
+            Arguments:
+                counter_name - the name of the counter
+                granularity - 'hour', 'day' or 'month'
+                when - datetime in UTC
+        """
+        stamp = when.strftime(TIME_BUCKET_FORMATS[granularity])
+        return '%s%s%s:%s' % (counter_name, TIME_BUCKET_SEPARATOR, granularity, stamp)
+
+    @staticmethod
+    def parse(name):
+        """Parse name of the time bucket counter
+
+            Returns: tuple (counter name, granularity, period start) or None
+                     if the name is not a time bucket counter name
+        """
+        if TIME_BUCKET_SEPARATOR not in name:
+            return None
+
+        counter_name, bucket = name.rsplit(TIME_BUCKET_SEPARATOR, 1)
+        granularity, _, stamp = bucket.partition(':')
+        if granularity not in TIME_BUCKET_FORMATS:
+            return None
+
+        # Names like 'users@active' are ordinary counters
+        try:
+            period = datetime.datetime.strptime(stamp, TIME_BUCKET_FORMATS[granularity])
+        except ValueError:
+            return None
+        if period.strftime(TIME_BUCKET_FORMATS[granularity]) != stamp:
+            return None
+
+        return counter_name, granularity, period
+
+    @staticmethod
+    def truncate(when, granularity):
+        """Get start of the period the datetime is in"""
+        when = when.replace(minute=0, second=0, microsecond=0)
+        if granularity == 'hour':
+            return when
+        when = when.replace(hour=0)
+        if granularity == 'day':
+            return when
+        return when.replace(day=1)
+
+    @staticmethod
+    def next(start, granularity):
+        """Get start of the period following the period starting at start"""
+        if granularity == 'hour':
+            return start + datetime.timedelta(hours=1)
+        if granularity == 'day':
+            return start + datetime.timedelta(days=1)
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+
+    @staticmethod
+    def periods(start, end, granularity):
+        """Get starts of all the periods between start and end (inclusive)"""
+        periods = []
+        period = TimeBucket.truncate(start, granularity)
+        while period <= end:
+            periods.append(period)
+            period = TimeBucket.next(period, granularity)
+        return periods
+
+    @staticmethod
+    def finer(granularity):
+        """Get granularities compacted into the granularity directly or indirectly"""
+        finer = []
+        for fine, coarse in TIME_BUCKET_ROLLUP.items():
+            if coarse == granularity:
+                finer.append(fine)
+                finer.extend(TimeBucket.finer(fine))
+        return finer
+
+
+class ListDiffer(object):
+    """Calculate the difference between two lists"""
+
+    def __init__(self, current_list, old_list):
+        self.intersect = None
+        self.current_list, self.old_list = current_list, old_list
+        self.set_current, self.set_old = set(current_list), set(old_list)
+
+    def added(self):
+        return self.set_current - self.set_old
+
+    def removed(self):
+        return self.set_old - self.set_current
+
+    def get_intersect(self):
+        if self.intersect is None:
+            self.intersect = self.set_current.intersection(self.set_old)
+
+    def changed(self):
+        self.get_intersect()
+        return set(o for o in self.intersect if self.old_list[o] != self.current_list[o])
+
+    def unchanged(self):
+        self.get_intersect()
+        return set(o for o in self.intersect if self.old_list[o] == self.current_list[o])
+
+
+class GeneralCounterShardConfig(ndb.Model):
+    """Tracks the number of shards for each named counter.
+
+        Entity ID is the counter ID (see ShardScheme.counter_id).
+    """
+
+    name = ndb.StringProperty(required=True)
+    num_shards = ndb.IntegerProperty(default=20, indexed=False)
+
+    # While the counter is being consolidated: the number of shards before
+    # consolidation, which still have to be read, and when it started.
+    max_shards = ndb.IntegerProperty(default=None, indexed=False)
+    consolidated = ndb.FloatProperty(default=None, indexed=False)
+
+
+class GeneralCounterShard(ndb.Model):
+    """Shards for each named counter"""
+
+    # The counter ID (see ShardScheme.counter_id)
+    name = ndb.StringProperty(required=True)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class GeneralCounterShardConfigV2(GeneralCounterShardConfig):
+    """Tracks the number of shards for each named counter.
+
+        Addressed only by key so it has no indexed properties.
+    """
+
+    name = ndb.StringProperty(required=True, indexed=False)
+
+
+class GeneralCounterShardV2(ndb.Model):
+    """Shards for each named counter
+
+        Addressed only by key so it has no indexed properties.
+    """
+
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class ShardScheme(object):
+    """Storage scheme of counter shard configs and shards
+
+        The 'name' scheme uses the counter name as counter ID and shard IDs
+        are the name followed by the shard index, so they may collide for
+        names ending with digits. The 'hash' scheme uses fixed length hash
+        of the name as counter ID. The name is kept only in the shard config.
+        The 'v2' scheme is like the 'hash' one but shards don't store the
+        counter ID and none of the properties is indexed.
+    """
+
+    def __init__(self, config_model, shard_model, hashed):
+        self.config_model = config_model
+        self.shard_model = shard_model
+        self.hashed = hashed
+
+        # Shards which don't store counter ID must have hashed keys
+        self.named = 'name' in shard_model._properties
+        if not self.named and not hashed:
+            raise ValueError('Shards without counter ID must have hashed keys')
+
+    def counter_id(self, name):
+        """Get ID of the counter: the name or its hash"""
+        if not self.hashed:
+            return name
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return base64.urlsafe_b64encode(hashlib.sha1(name).digest()[:12])
+
+    def config_key(self, name):
+        """Get key of the counter shard config"""
+        return ndb.Key(self.config_model, self.counter_id(name))
+
+    def is_own_config(self, config):
+        """Check if the shard config is stored in this scheme"""
+        return config.key == self.config_key(config.name)
+
+    def shard_keys(self, name, indexes):
+        """Get keys of the counter shards with given indexes"""
+        counter_id = self.counter_id(name)
+        if self.hashed:
+            return [ndb.Key(self.shard_model, '%s:%d' % (counter_id, index)) for index in indexes]
+        return [ndb.Key(self.shard_model, counter_id + str(index)) for index in indexes]
+
+    def new_shard(self, key, name):
+        """Create counter shard entity"""
+        if not self.named:
+            return self.shard_model(key=key)
+        return self.shard_model(key=key, name=self.counter_id(name))
+
+    def owns(self, shard, name):
+        """Check if the shard belongs to the counter"""
+        return not self.named or shard.name == self.counter_id(name)
+
+
+SHARD_SCHEMES = {
+    'name': ShardScheme(GeneralCounterShardConfig, GeneralCounterShard, False),
+    'hash': ShardScheme(GeneralCounterShardConfig, GeneralCounterShard, True),
+    'v2': ShardScheme(GeneralCounterShardConfigV2, GeneralCounterShardV2, True),
+}
+
+
+class CounterNameIndex(ndb.Model):
+    """Prefix index of counter names
+
+        Entity ID is the counter name. Counter 'loc:us:ca' has parent
+        'loc:us' and ancestors 'loc' and 'loc:us'.
+    """
+
+    parent_name = ndb.StringProperty(required=True)
+    ancestors = ndb.StringProperty(repeated=True)
+
+    @classmethod
+    def build(cls, name):
+        """Build index entry for the counter name
+
+            Returns: index entity or None for names without levels
+        """
+        levels = name.split(COUNTER_NAME_SEPARATOR)
+        if len(levels) < 2 or TimeBucket.parse(name) is not None:
+            return None
+
+        ancestors = [COUNTER_NAME_SEPARATOR.join(levels[:idx]) for idx in range(1, len(levels))]
+        return cls(id=name, parent_name=ancestors[-1], ancestors=ancestors)
+
+
+class TimeBucketIndex(ndb.Model):
+    """Time bucket counters waiting for compaction into coarse buckets
+
+        Entity ID is the bucket counter name.
+    """
+
+    rollup_after = ndb.DateTimeProperty(required=True)
+
+    @classmethod
+    def build(cls, name):
+        """Build index entry for the counter name
+
+            Returns: index entity or None if the counter is not compacted
+        """
+        parsed = TimeBucket.parse(name)
+        if parsed is None or parsed[1] not in TIME_BUCKET_ROLLUP:
+            return None
+
+        end = TimeBucket.next(parsed[2], parsed[1])
+        return cls(id=name, rollup_after=end + datetime.timedelta(seconds=TIME_BUCKET_ROLLUP_DELAY))
+
+
+class RollingCounterShard(ndb.Model):
+    """Shard of rolling window counter time slot
+
+        Entity ID is 'name:slot:shard'. The count is valid only for the
+        epoch (time / slot time) the shard was last written in.
+    """
+
+    epoch = ndb.IntegerProperty(default=0, indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class HyperLogLogShard(ndb.Model):
+    """Shard of HyperLogLog sketch
+
+        Every shard holds all the registers of a sketch of the values
+        written to it. Shards are merged on read. Entity ID is
+        'counter_name:shard'.
+    """
+
+    precision = ndb.IntegerProperty(required=True, indexed=False)
+    registers = ndb.BlobProperty(required=True)
+
+
+class TopCounterFamily(ndb.Model):
+    """Complex counter family with tracked heavy hitters
+
+        Entity ID is the counter name template.
+    """
+
+    top_k = ndb.IntegerProperty(required=True, indexed=False)
+
+
+class TopCounterShard(ndb.Model):
+    """Shard of space-saving summary of the biggest counters of a family
+
+        Entity ID is 'template|shard'. Counter names, their counts and
+        maximal overestimation of the counts are kept in parallel lists.
+    """
+
+    names = ndb.StringProperty(repeated=True, indexed=False)
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+    errors = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    def change(self, name, delta, capacity):
+        """Apply counter change to the summary
+
+            Not tracked counter replaces the smallest one when the summary
+            is full and inherits its count as the error. Decrements of not
+            tracked counters are ignored.
+
+            Returns: True if the summary changed
+        """
+        if name in self.names:
+            idx = self.names.index(name)
+            self.counts[idx] += delta
+            if self.counts[idx] <= 0:
+                del self.names[idx], self.counts[idx], self.errors[idx]
+            return True
+
+        if delta <= 0:
+            return False
+
+        if len(self.names) < capacity:
+            self.names.append(name)
+            self.counts.append(delta)
+            self.errors.append(0)
+            return True
+
+        idx = self.counts.index(min(self.counts))
+        error = self.counts[idx]
+        self.names[idx] = name
+        self.counts[idx] = error + delta
+        self.errors[idx] = error
+        return True
+
+
+class CountMinFamily(ndb.Model):
+    """Dimensions of count-min sketch written at the first write
+
+        Entity ID is the counter name template.
+    """
+
+    width = ndb.IntegerProperty(required=True, indexed=False)
+    depth = ndb.IntegerProperty(required=True, indexed=False)
+
+
+class CountMinBlock(ndb.Model):
+    """Shard of block of cells of one row of count-min sketch
+
+        Entity ID is 'template|row|block|shard'. Cells after the last
+        written one are not stored.
+    """
+
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+
+
+class CounterActions(ndb.Model):
+    """Counter actions
+
+        Helper model to store multiple operations on counters as JSON object.
+        This is later used to aggregate many counter actions (add, subtract).
+
+        It's used to save thousands of calls to Datastore by first aggregating
+        actions on the same counters and then making a call to edit a counter in
+        Datastore.
+    """
+
+    actions = ndb.JsonProperty(required=True)
+    processed = ndb.BooleanProperty(default=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    # Aggregation partition or None if actions are not partitioned
+    partition = ndb.IntegerProperty(default=None)
+
+    # Lease of the aggregation applying the actions
+    lease = ndb.StringProperty(default=None, indexed=False)
+    leased_until = ndb.DateTimeProperty(default=None, indexed=False)
+
+    @classmethod
+    def store(cls, actions, partitions=None):
+        """Store counter actions split by aggregation partitions
+
+            Arguments:
+                actions - dictionary of counter actions
+                partitions - number of partitions, defaults to AGGREGATION_PARTITIONS
+
+            Returns: list of keys of stored records
+        """
+        return ndb.put_multi(cls.build(actions, partitions))
+
+    @classmethod
+    def build(cls, actions, partitions=None):
+        """Build counter actions records split by aggregation partitions
+
+            Returns: list of not saved records
+        """
+        parts = Counter.partition_actions(actions, partitions or AGGREGATION_PARTITIONS)
+        return [cls(actions=part, partition=partition) for partition, part in parts.items()]
+
+
+class Counter(object):
+    """Utility class for shard counters"""
+
+    # Number of shards cached in the instance memory: name -> (num_shards, expires)
+    _num_shards_cache = LRUCache(SHARD_CONFIG_CACHE_SIZE)
+
+    # Names of counters with write-behind buffers waiting for flush
+    _buffer_index = MemcacheNameSet(WRITE_BEHIND_KEY_PREFIX + 'index:', WRITE_BEHIND_INDEX_BUCKETS)
+
+    # Names of counters with transaction retries since the last autoscaling
+    _contention_index = MemcacheNameSet(CONTENTION_KEY_PREFIX + 'index:')
+
+    @staticmethod
+    def get_count(name, force=False):
+        """Retrieve the value for a given sharded counter.
+
+        Arguments:
+          name - The name of the counter
+          force - Set to True to force counter retrieval from the Datastore
+        """
+        return Counter.get_counts([name], force)[name]
+
+    @staticmethod
+    def get_counts(names, force=False):
+        """Retrieve the values for many sharded counters.
+
+        Cached values are fetched with one memcache call and all the shards
+        of not cached counters with one Datastore call.
+
+        Arguments:
+          names - The names of the counters
+          force - Set to True to force counters retrieval from the Datastore
+
+        Returns: dictionary counter name -> value
+        """
+        return Counter.get_counts_async(names, force).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def get_counts_async(names, force=False):
+        """Asynchronous version of get_counts"""
+        names = list(set(names))
+        scheme = Counter._scheme()
+        cache_keys = dict((scheme.counter_id(name), name) for name in names)
+
+        cached = {} if force is True else memcache.get_multi(cache_keys.keys())
+        totals = dict((cache_keys[key], value) for key, value in cached.items())
+        missing = [name for name in names if name not in totals]
+
+        if missing:
+            # Instance memory is skipped because it may not know yet
+            # about shards added by other instances.
+            ranges = yield Counter._get_shard_ranges_async(missing, use_local_cache=False, create=False)
+
+            keys = []
+            owners = []
+            for name in missing:
+                for each in Counter._read_schemes():
+                    shard_keys = each.shard_keys(name, range(max(ranges[name])))
+                    keys.extend(shard_keys)
+                    owners.extend([(each, name)] * len(shard_keys))
+
+            shards = yield ndb.get_multi_async(keys)
+
+            counted = dict((name, 0) for name in missing)
+            for shard, (each, name) in zip(shards, owners):
+                # Shard IDs of counters with names ending with digits may
+                # collide so the owner has to be checked.
+                if shard is not None and each.owns(shard, name):
+                    counted[name] += shard.count
+
+            memcache.add_multi(dict((scheme.counter_id(name), value) for name, value in counted.items()), time=60)
+            totals.update(counted)
+
+        raise ndb.Return(totals)
+
+    @staticmethod
+    def _scheme():
+        """Get the scheme counters are stored in"""
+        return SHARD_SCHEMES[SHARD_SCHEME]
+
+    @staticmethod
+    def _previous_scheme():
+        """Get the scheme counters are migrated from or None"""
+        return SHARD_SCHEMES[SHARD_SCHEME_PREVIOUS] if SHARD_SCHEME_PREVIOUS else None
+
+    @staticmethod
+    def _read_schemes():
+        """Get schemes counters are read from"""
+        previous = Counter._previous_scheme()
+        return [Counter._scheme()] if previous is None else [Counter._scheme(), previous]
+
+    @staticmethod
+    def incr(name):
+        """Increment the value for a given shard counter.
+
+        Arguments:
+          name - The name of the counter
+        """
+        Counter.change_counter(name, 1)
+
+    @staticmethod
+    def decr(name):
+        """Decrement the value for a given shard counter.
+
+        Arguments:
+          name - The name of the counter
+        """
+        Counter.change_counter(name, -1)
+
+    @staticmethod
+    def change_counter(name, delta):
+        """Change counter value by delta
+
+            Arguments:
+                name - the name of the counter
+                delta - the change delta. Ex.: -1, +1, +10...
+        """
+        if name.startswith((HLL_ACTION_PREFIX, CMS_ACTION_PREFIX)):
+            Counter._write_sketch_actions_async({name: delta}).get_result()
+            return
+
+        if WRITE_BEHIND:
+            Counter._buffer_actions_async({name: delta}).get_result()
+            return
+
+        num_shards = Counter._get_num_shards_async([name]).get_result()
+
+        attempts = {}
+        try:
+            Counter._change_shard_async(name, delta, num_shards[name], attempts).get_result()
+        finally:
+            Counter._record_contention(attempts)
+
+        memcache.delete(Counter._scheme().counter_id(name))
+
+        Counter._update_top_counters_async({name: delta}).get_result()
+
+    @staticmethod
+    def apply_actions(actions):
+        """Apply counter actions
+
+            All the shard configs are fetched at once, shards are changed
+            in parallel transactions and cached counter values are removed
+            from memcache with one call.
+
+            Arguments:
+                actions - dictionary of counter actions: counter name -> delta
+        """
+        Counter.apply_actions_async(actions).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def apply_actions_async(actions):
+        """Asynchronous version of apply_actions"""
+        yield Counter._apply_actions_async(actions)
+
+    @staticmethod
+    @ndb.tasklet
+    def _apply_actions_async(actions, written=None):
+        """Apply counter actions and report which of them were applied
+
+            Arguments:
+                actions - dictionary of counter actions: counter name -> delta
+                written - optional set receiving names of applied (written or
+                          buffered) actions, also when applying other ones failed
+        """
+        actions, sketches = Counter._split_sketch_actions(actions)
+
+        if WRITE_BEHIND:
+            yield Counter._buffer_actions_async(actions, written), Counter._write_sketch_actions_async(sketches, written)
+        else:
+            yield Counter._write_actions_async(actions, written), Counter._write_sketch_actions_async(sketches, written)
+
+    @staticmethod
+    def _split_sketch_actions(actions):
+        """Split actions of HyperLogLog and count-min sketch counters from the other ones
+
+            Sketch actions are never written as regular counters nor buffered.
+
+            Returns: tuple (counter actions, sketch actions)
+        """
+        sketches = dict((name, delta) for name, delta in actions.items()
+                        if name.startswith((HLL_ACTION_PREFIX, CMS_ACTION_PREFIX)))
+        if not sketches:
+            return actions, sketches
+
+        return dict((name, delta) for name, delta in actions.items() if name not in sketches), sketches
+
+    @staticmethod
+    @ndb.tasklet
+    def _write_sketch_actions_async(actions, written=None):
+        """Write actions of HyperLogLog and count-min sketch counters
+
+            Arguments:
+                actions - dictionary of sketch counter actions
+                written - optional set receiving names of written actions
+        """
+        hll = dict((name, delta) for name, delta in actions.items() if name.startswith(HLL_ACTION_PREFIX))
+        count_min = dict((name, delta) for name, delta in actions.items() if name not in hll)
+
+        futures = [(hll, Counter._write_sketches_async(hll)), (count_min, Counter._write_count_min_async(count_min))]
+        try:
+            yield [future for names, future in futures]
+        finally:
+            if written is not None:
+                for names, future in futures:
+                    if future.done() and future.get_exception() is None:
+                        written.update(names)
+
+    @staticmethod
+    @ndb.tasklet
+    def _write_actions_async(actions, written=None):
+        """Write counter actions to the Datastore
+
+            Shards are changed in parallel transactions. When some of them
+            fail the other ones are already committed, so the first error
+            is raised only after the written counters are reported, their
+            cached values removed and their summaries updated.
+
+            Arguments:
+                actions - dictionary of counter actions
+                written - optional set receiving names of written counters
+        """
+        names = [name for name, delta in actions.items() if delta != 0]
+        if not names:
+            return
+
+        num_shards = yield Counter._get_num_shards_async(names)
+
+        attempts = {}
+        futures = [(name, Counter._change_shard_async(name, actions[name], num_shards[name], attempts)) for name in names]
+        try:
+            # Waits for all the transactions before raising the first error
+            yield [future for name, future in futures]
+        except Exception:
+            # Raised below after the written counters are handled
+            pass
+        finally:
+            Counter._record_contention(attempts)
+
+        names = [name for name, future in futures if future.get_exception() is None]
+        if written is not None:
+            written.update(names)
+
+        if names:
+            memcache.delete_multi([Counter._scheme().counter_id(name) for name in names])
+            yield Counter._update_top_counters_async(dict((name, actions[name]) for name in names))
+
+        for name, future in futures:
+            future.check_success()
+
+    @staticmethod
+    @ndb.tasklet
+    def _buffer_actions_async(actions, written=None):
+        """Add counter actions to write-behind buffers
+
+            Actions that can't be buffered because memcache is not available
+            are written to the Datastore.
+
+            Arguments:
+                actions - dictionary of counter actions
+                written - optional set receiving names of buffered or written counters
+        """
+        deltas, sketches = Counter._split_sketch_actions(dict((name, delta) for name, delta in actions.items() if delta != 0))
+        if sketches:
+            yield Counter._write_sketch_actions_async(sketches, written)
+        if not deltas:
+            return
+
+        prefix = WRITE_BEHIND_KEY_PREFIX + 'buf:'
+        buffered = memcache.offset_multi(deltas, key_prefix=prefix, initial_value=WRITE_BEHIND_BASE)
+
+        not_buffered = dict((name, delta) for name, delta in deltas.items() if buffered.get(name) is None)
+        buffered = [name for name in deltas if name not in not_buffered]
+
+        Counter._register_buffers(buffered)
+        if written is not None:
+            written.update(buffered)
+
+        if not_buffered:
+            yield Counter._write_actions_async(not_buffered, written)
+
+    @staticmethod
+    def _register_buffers(names, registered=None):
+        """Register buffers of the counters for the next flush
+
+            Arguments:
+                names - the names of the counters
+                registered - registration time, defaults to now
+        """
+        if not names:
+            return
+
+        prefix = WRITE_BEHIND_KEY_PREFIX + 'marker:'
+        markers = dict((name, registered or time.time()) for name in names)
+
+        # Markers that already exist mean the counter is already registered
+        existing = set(memcache.add_multi(markers, key_prefix=prefix, time=WRITE_BEHIND_MARKER_TIME))
+
+        for name in names:
+            if name not in existing and not Counter._buffer_index.add(name):
+                # Let the next change try again
+                memcache.delete(prefix + name)
+
+    @staticmethod
+    def flush_buffers():
+        """Write deltas accumulated in write-behind buffers to the Datastore
+
+            Deltas are first subtracted from the buffers so changes made
+            during the flush are not lost. If writing to the Datastore fails
+            they are added back.
+
+            Buffers evicted from memcache before the flush can't be recovered.
+            They are reported in 'evicted' statistic.
+
+            Returns: flush statistics dictionary:
+                time - flush time
+                counters - number of flushed counters
+                delta - sum of absolute values of flushed deltas
+                lag - age in seconds of the oldest flushed change
+                evicted - number of registered counters with evicted buffers
+        """
+        now = time.time()
+        stats = {'time': now, 'counters': 0, 'delta': 0, 'lag': 0.0, 'evicted': 0}
+
+        buf_prefix = WRITE_BEHIND_KEY_PREFIX + 'buf:'
+        marker_prefix = WRITE_BEHIND_KEY_PREFIX + 'marker:'
+
+        names = Counter._buffer_index.get_all()
+
+        if names:
+            values = memcache.get_multi(names, key_prefix=buf_prefix)
+            markers = memcache.get_multi(names, key_prefix=marker_prefix)
+
+            deltas = {}
+            for name in names:
+                if name not in values:
+                    stats['evicted'] += 1
+                    continue
+                delta = int(values[name]) - WRITE_BEHIND_BASE
+                if delta != 0:
+                    deltas[name] = delta
+
+            if deltas:
+                memcache.offset_multi(dict((name, -delta) for name, delta in deltas.items()), key_prefix=buf_prefix)
+                written = set()
+                try:
+                    # Sketch actions may be buffered by older versions
+                    counters, sketches = Counter._split_sketch_actions(deltas)
+                    futures = [Counter._write_actions_async(counters, written),
+                               Counter._write_sketch_actions_async(sketches, written)]
+                    ndb.Future.wait_all(futures)
+                    for future in futures:
+                        future.check_success()
+                except Exception:
+                    # Deltas of counters written before the failure must not be written again
+                    not_written = dict((name, delta) for name, delta in deltas.items() if name not in written)
+                    memcache.offset_multi(not_written, key_prefix=buf_prefix, initial_value=WRITE_BEHIND_BASE)
+                    raise
+
+                registered = [markers[name] for name in deltas if name in markers]
+                if registered:
+                    stats['lag'] = now - min(registered)
+
+                stats['counters'] = len(deltas)
+                stats['delta'] = sum(abs(delta) for delta in deltas.values())
+
+            # Unregister before the markers are deleted. Changes made while
+            # the markers still exist are caught by the check below and later
+            # ones create new markers and index entries.
+            Counter._buffer_index.remove_multi(names)
+            memcache.delete_multi(names, key_prefix=marker_prefix)
+
+            # Register again buffers changed during the flush
+            values = memcache.get_multi(names, key_prefix=buf_prefix)
+            Counter._register_buffers([name for name, value in values.items() if int(value) != WRITE_BEHIND_BASE])
+
+        memcache.set(WRITE_BEHIND_KEY_PREFIX + 'stats', stats)
+        logging.info('gcounter flush: %(counters)d counters, delta %(delta)d, lag %(lag).1fs, evicted %(evicted)d' % stats)
+
+        return stats
+
+    @staticmethod
+    def get_flush_stats():
+        """Get statistics of the last write-behind flush or None"""
+        return memcache.get(WRITE_BEHIND_KEY_PREFIX + 'stats')
+
+    @staticmethod
+    @ndb.tasklet
+    def _get_num_shards_async(names, use_local_cache=True, create=True):
+        """Get number of shards for many counters
+
+            Looks in the instance memory, memcache and the Datastore.
+
+            Arguments:
+                names - the names of the counters
+                use_local_cache - set to False to skip the instance memory
+                create - create missing configs. When set to False
+                         counters without config have 0 shards.
+
+            Returns: future resolving to dictionary: counter name -> number of shards
+        """
+        ranges = yield Counter._get_shard_ranges_async(names, use_local_cache, create)
+        raise ndb.Return(dict((name, num_shards) for name, (num_shards, read_shards) in ranges.items()))
+
+    @staticmethod
+    @ndb.tasklet
+    def _get_shard_ranges_async(names, use_local_cache=True, create=True):
+        """Get number of shards to write to and to read from for many counters
+
+            Both numbers are the same except for counters being
+            consolidated (see Counter.consolidate_shards).
+
+            Arguments:
+                names - the names of the counters
+                use_local_cache - set to False to skip the instance memory
+                create - create missing configs. When set to False
+                         counters without config have 0 shards.
+
+            Returns: future resolving to dictionary:
+                     counter name -> (number of shards, number of shards to read)
+        """
+        ranges = {}
+        now = time.time()
+
+        if use_local_cache:
+            for name in names:
+                cached = Counter._num_shards_cache.get(name)
+                if cached is not None and cached[2] > now:
+                    ranges[name] = cached[:2]
+
+        missing = [name for name in names if name not in ranges]
+
+        if missing:
+            scheme = Counter._scheme()
+            cache_keys = dict((scheme.counter_id(name), name) for name in missing)
+            cached = memcache.get_multi(cache_keys.keys(), key_prefix=SHARD_CONFIG_KEY_PREFIX)
+            cached = dict((cache_keys[key], value) for key, value in cached.items())
+            not_cached = [name for name in missing if name not in cached]
+
+            if not_cached:
+                configs = yield Counter._get_configs_async(not_cached, create)
+                fetched = dict((name, Counter._shard_range_value(config)) for name, config in configs.items())
+                ranges.update((name, (0, 0)) for name in not_cached if name not in configs)
+                # Don't overwrite values set meanwhile by shard config changes
+                memcache.add_multi(dict((scheme.counter_id(name), value) for name, value in fetched.items()),
+                                   key_prefix=SHARD_CONFIG_KEY_PREFIX, time=SHARD_CONFIG_MEMCACHE_TIME)
+                cached.update(fetched)
+
+            for name, value in cached.items():
+                value = value if isinstance(value, tuple) else (value, value)
+                Counter._num_shards_cache.set(name, value + (now + SHARD_CONFIG_LOCAL_TIME,))
+                ranges[name] = value
+
+        raise ndb.Return(ranges)
+
+    @staticmethod
+    def _shard_range_value(config):
+        """Get cached representation of the config shard range
+
+            It's the number of shards or, while the counter is being
+            consolidated, tuple (number of shards, number of shards to read).
+        """
+        if config.max_shards is None or config.max_shards <= config.num_shards:
+            return config.num_shards
+        return config.num_shards, config.max_shards
+
+    @staticmethod
+    def _set_num_shards_cache(config):
+        """Set cached shard range of the config in the instance memory and memcache"""
+        value = Counter._shard_range_value(config)
+        local = value if isinstance(value, tuple) else (value, value)
+        Counter._num_shards_cache.set(config.name, local + (time.time() + SHARD_CONFIG_LOCAL_TIME,))
+        memcache.set(SHARD_CONFIG_KEY_PREFIX + config.key.id(), value, time=SHARD_CONFIG_MEMCACHE_TIME)
+
+    @staticmethod
+    def flush_local_cache():
+        """Remove all shard configs cached in the instance memory"""
+        Counter._num_shards_cache.clear()
+
+    @staticmethod
+    @ndb.tasklet
+    def _get_configs_async(names, create=True):
+        """Get shard configs for many counters
+
+            Arguments:
+                names - the names of the counters
+                create - create missing configs
+
+            Returns: future resolving to dictionary: counter name -> config
+        """
+        scheme = Counter._scheme()
+        previous = Counter._previous_scheme()
+
+        configs = yield ndb.get_multi_async([scheme.config_key(name) for name in names])
+
+        missing = [name for name, config in zip(names, configs) if config is None]
+
+        configs = dict((name, config) for name, config in zip(names, configs) if config is not None)
+
+        # Configs of counters not migrated yet
+        defaults = {}
+        if previous is not None and missing:
+            previous_configs = yield ndb.get_multi_async([previous.config_key(name) for name in missing])
+            for name, config in zip(missing, previous_configs):
+                if config is None:
+                    continue
+                if create:
+                    defaults[name] = {
+                        'num_shards': config.num_shards,
+                        'max_shards': config.max_shards,
+                        'consolidated': config.consolidated}
+                else:
+                    configs[name] = config
+            missing = [name for name in missing if name not in configs]
+
+        if create and missing:
+            for name in missing:
+                if name not in defaults and TimeBucket.parse(name) is not None:
+                    defaults[name] = {'num_shards': TIME_BUCKET_NUM_SHARDS}
+
+            inserted = yield [Counter._create_config_async(scheme, name, defaults.get(name, {})) for name in missing]
+            configs.update(zip(missing, inserted))
+
+        raise ndb.Return(configs)
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _create_config_async(scheme, name, defaults):
+        """Create shard config of the counter together with its index entries
+
+            Every shard config (also the ones copied by the migration) is
+            created here. The config, CounterNameIndex and TimeBucketIndex
+            entries are written in one cross group transaction, so a failed
+            write never leaves an existing counter out of the indexes.
+
+            Arguments:
+                scheme - shard scheme of the config
+                name - the name of the counter
+                defaults - dictionary of config property values
+
+            Returns: future resolving to the config, the existing one if it
+                was created meanwhile
+        """
+        key = scheme.config_key(name)
+        config = yield key.get_async()
+        if config is not None:
+            raise ndb.Return(config)
+
+        config = scheme.config_model(key=key, name=name, **defaults)
+        entries = [CounterNameIndex.build(name), TimeBucketIndex.build(name)]
+        yield ndb.put_multi_async([config] + [entry for entry in entries if entry is not None])
+
+        raise ndb.Return(config)
+
+    @staticmethod
+    @ndb.tasklet
+    def _change_shard_async(name, delta, num_shards, attempts=None):
+        """Change value of randomly chosen counter shard by delta
+
+            Every retry of the transaction picks the shard again.
+
+            Arguments:
+                name - the name of the counter
+                delta - the change delta
+                num_shards - the number of counter shards
+                attempts - optional dictionary receiving
+                           counter name -> (transaction attempts, failed)
+        """
+        tries = [0]
+        scheme = Counter._scheme()
+
+        @ndb.transactional_tasklet
+        def txn():
+            tries[0] += 1
+            index = random.randint(0, num_shards - 1)
+            key = scheme.shard_keys(name, [index])[0]
+            counter = yield key.get_async()
+            if counter is None:
+                counter = scheme.new_shard(key, name)
+            counter.count += delta
+            yield counter.put_async()
+
+        try:
+            yield txn()
+        except datastore_errors.TransactionFailedError:
+            if attempts is not None:
+                attempts[name] = (tries[0], True)
+            raise
+
+        if attempts is not None:
+            attempts[name] = (tries[0], False)
+
+    @staticmethod
+    def _record_contention(attempts):
+        """Record contention telemetry of counter writes
+
+            Arguments:
+                attempts - dictionary: counter name -> (transaction attempts, failed)
+        """
+        if not attempts:
+            return
+
+        slot = Counter._contention_slot()
+
+        offsets = {}
+        contended = []
+        for name, (tries, failed) in attempts.items():
+            offsets[Counter._contention_key(name, 'writes', slot)] = 1
+            if tries > 1:
+                offsets[Counter._contention_key(name, 'retries', slot)] = tries - 1
+            if failed:
+                offsets[Counter._contention_key(name, 'failures', slot)] = 1
+            if tries > 1 or failed:
+                contended.append(name)
+
+        memcache.offset_multi(offsets, key_prefix=CONTENTION_KEY_PREFIX, initial_value=0)
+
+        if contended:
+            prefix = CONTENTION_KEY_PREFIX + 'marker:'
+            markers = dict((name, 1) for name in contended)
+            existing = set(memcache.add_multi(markers, key_prefix=prefix, time=CONTENTION_MARKER_TIME))
+            for name in contended:
+                if name not in existing and not Counter._contention_index.add(name):
+                    memcache.delete(prefix + name)
+
+    @staticmethod
+    def _contention_slot():
+        """Get current telemetry time slot"""
+        return int(time.time()) // CONTENTION_WINDOW
+
+    @staticmethod
+    def _contention_key(name, field, slot):
+        """Get memcache key (without CONTENTION_KEY_PREFIX) of telemetry field"""
+        return '%s:%s:%d' % (name, field, slot)
+
+    @staticmethod
+    def get_contention(names=None):
+        """Get contention telemetry of the last CONTENTION_WINDOW to
+        2 * CONTENTION_WINDOW seconds collected since the last reset
+        by autoscaling or consolidation
+
+            Arguments:
+                names - the names of the counters, defaults to all the
+                        counters with transaction retries or failures
+
+            Returns: dictionary: counter name -> dictionary:
+                writes - number of counter writes
+                retries - number of transaction retries
+                failures - number of failed transactions
+                rate - (retries + failures) / writes
+        """
+        return Counter._read_contention(names)[0]
+
+    @staticmethod
+    def _read_contention(names=None):
+        """Get contention telemetry and memcache values it was computed from
+
+            Returns: tuple (telemetry as returned by get_contention,
+                dictionary: memcache key -> value)
+        """
+        if names is None:
+            names = Counter._contention_index.get_all()
+
+        slot = Counter._contention_slot()
+        fields = ('writes', 'retries', 'failures')
+        keys = [Counter._contention_key(name, field, idx)
+                for name in names for field in fields for idx in (slot - 1, slot)]
+        values = memcache.get_multi(keys, key_prefix=CONTENTION_KEY_PREFIX)
+        values = dict((key, int(value)) for key, value in values.items())
+
+        telemetry = {}
+        for name in names:
+            stats = dict((field, sum(values.get(Counter._contention_key(name, field, idx), 0)
+                                     for idx in (slot - 1, slot))) for field in fields)
+            contended = stats['retries'] + stats['failures']
+            stats['rate'] = float(contended) / stats['writes'] if stats['writes'] else float(contended)
+            telemetry[name] = stats
+
+        return telemetry, values
+
+    @staticmethod
+    def _reset_contention(values):
+        """Subtract telemetry values returned by _read_contention
+
+            Values are subtracted (not deleted) so writes made meanwhile
+            are not lost.
+        """
+        offsets = dict((key, -value) for key, value in values.items() if value)
+        if offsets:
+            memcache.offset_multi(offsets, key_prefix=CONTENTION_KEY_PREFIX)
+
+    @staticmethod
+    def autoscale_shards(threshold=None, min_writes=None, factor=None, max_shards=None):
+        """Increase the number of shards of contended counters
+
+            Uses telemetry returned by get_contention() and starts
+            collecting it again. Should be run periodically
+            (see gcounter_tasks.py).
+
+            Arguments:
+                threshold - minimal contention rate, defaults to AUTOSCALE_THRESHOLD
+                min_writes - minimal number of writes, defaults to AUTOSCALE_MIN_WRITES
+                factor - shards multiplier, defaults to AUTOSCALE_FACTOR
+                max_shards - maximal number of shards, defaults to AUTOSCALE_MAX_SHARDS
+
+            Returns: dictionary: counter name -> new number of shards
+        """
+        threshold = AUTOSCALE_THRESHOLD if threshold is None else threshold
+        min_writes = AUTOSCALE_MIN_WRITES if min_writes is None else min_writes
+        factor = factor or AUTOSCALE_FACTOR
+        max_shards = max_shards or AUTOSCALE_MAX_SHARDS
+
+        telemetry, values = Counter._read_contention()
+        if not telemetry:
+            return {}
+
+        names = telemetry.keys()
+        num_shards = Counter._get_num_shards_async(names, use_local_cache=False).get_result()
+
+        scaled = {}
+        for name, stats in telemetry.items():
+            if stats['writes'] < min_writes or stats['rate'] < threshold:
+                continue
+            num = min(max_shards, num_shards[name] * factor)
+            if num > num_shards[name]:
+                Counter.increase_shards(name, num)
+                scaled[name] = num
+
+        Counter._reset_contention(values)
+
+        memcache.delete_multi(names, key_prefix=CONTENTION_KEY_PREFIX + 'marker:')
+        Counter._contention_index.remove_multi(names)
+
+        for name, num in scaled.items():
+            logging.info('gcounter autoscale: %s to %d shards (contention rate %.2f)' % (name, num, telemetry[name]['rate']))
+
+        return scaled
+
+    @staticmethod
+    def increase_shards(name, num):
         """Increase the number of shards for a given shard counter.
         Will never decrease the number of shards.
 
-        Arguments:
-          name - The name of the counter
-          num - How many shards to use
+        Arguments:
+          name - The name of the counter
+          num - How many shards to use
+
+        """
+        Counter._get_configs_async([name]).get_result()
+        key = Counter._scheme().config_key(name)
+
+        @ndb.transactional
+        def txn():
+            config = key.get()
+            if config.num_shards < num:
+                config.num_shards = num
+                config.put()
+            return config
+
+        Counter._set_num_shards_cache(txn())
+
+    @staticmethod
+    def consolidate_shards(name, num):
+        """Consolidate counter shards into a smaller number of shards
+
+            Consolidation has two phases. First the number of shards is
+            lowered but all the previous shards are still read. Then, when
+            all the instances stopped writing to not used shards, their
+            values are folded into used ones by Counter.fold_shards().
+
+            Arguments:
+                name - the name of the counter
+                num - how many shards to use
+
+            Returns: True if the number of shards was lowered
+        """
+        if num < 1:
+            raise ValueError('Counter must have at least one shard')
+
+        key = Counter._scheme().config_key(name)
+
+        @ndb.transactional
+        def txn():
+            config = key.get()
+            if config is None or config.num_shards <= num:
+                return None
+            config.max_shards = max(config.num_shards, config.max_shards or 0)
+            config.num_shards = num
+            config.consolidated = time.time()
+            config.put()
+            return config
+
+        config = txn()
+        if config is None:
+            return False
+
+        Counter._set_num_shards_cache(config)
+        return True
+
+    @staticmethod
+    def fold_shards(name, grace_time=None):
+        """Fold values of shards not used after consolidation into used ones
+
+            Arguments:
+                name - the name of the counter
+                grace_time - seconds which must pass since the number of
+                             shards was lowered, defaults to CONSOLIDATION_GRACE_TIME
+
+            Returns: True if the consolidation is finished
+        """
+        grace_time = CONSOLIDATION_GRACE_TIME if grace_time is None else grace_time
+
+        scheme = Counter._scheme()
+        key = scheme.config_key(name)
+
+        config = key.get()
+        if config is None or config.max_shards is None:
+            return False
+        if config.consolidated + grace_time > time.time():
+            return False
+
+        num_shards = config.num_shards
+
+        Counter._fold_shards_async(name, range(num_shards, config.max_shards), num_shards, scheme, scheme).get_result()
+
+        @ndb.transactional
+        def txn():
+            config = key.get()
+            # Fold again on next run if the number of shards changed meanwhile
+            if config.num_shards != num_shards:
+                return None
+            config.max_shards = None
+            config.consolidated = None
+            config.put()
+            return config
+
+        config = txn()
+        if config is None:
+            return False
+
+        Counter._set_num_shards_cache(config)
+        return True
+
+    @staticmethod
+    @ndb.tasklet
+    def _fold_shards_async(name, indexes, num_shards, source, destination):
+        """Fold values of shards into the first num_shards shards
+
+            Shard with index i is folded into shard i % num_shards.
+
+            Arguments:
+                name - the name of the counter
+                indexes - indexes of folded shards
+                num_shards - the number of shards folded into
+                source - scheme of folded shards
+                destination - scheme of shards folded into
+
+            Returns: future resolving to number of folded shards
+        """
+        targets = {}
+        for index in indexes:
+            targets.setdefault(index % num_shards, []).append(index)
+
+        folded = yield [Counter._fold_into_shard_async(name, target, sources, source, destination)
+                        for target, sources in targets.items()]
+        raise ndb.Return(sum(folded))
+
+    @staticmethod
+    @ndb.tasklet
+    def _fold_into_shard_async(name, target, indexes, source, destination):
+        """Fold values of shards with given indexes into target shard"""
+        folded = 0
+        # Cross group transaction may use at most 25 entity groups
+        for idx in range(0, len(indexes), 24):
+            folded += yield Counter._fold_shards_txn_async(name, target, indexes[idx:idx + 24], source, destination)
+        raise ndb.Return(folded)
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _fold_shards_txn_async(name, target, indexes, source, destination):
+        """Move values of shards with given indexes to target shard and delete them"""
+        key = destination.shard_keys(name, [target])[0]
+        shards = yield ndb.get_multi_async([key] + source.shard_keys(name, indexes))
+
+        shard = shards[0]
+        folded = [each for each in shards[1:] if each is not None and source.owns(each, name)]
+        if not folded:
+            raise ndb.Return(0)
+
+        if shard is None:
+            shard = destination.new_shard(key, name)
+        shard.count += sum(each.count for each in folded)
+
+        yield shard.put_async(), ndb.delete_multi_async([each.key for each in folded])
+        raise ndb.Return(len(folded))
+
+    @staticmethod
+    def consolidate_cold_shards(cursor=None, batch_size=None, num=None, max_writes=None):
+        """Consolidate shards of cold counters
+
+            Processes one page of shard configs. Counters with more than num
+            shards and at most max_writes writes in the telemetry window
+            (see Counter.get_contention) are consolidated. Telemetry of the
+            processed counters is reset. Counters already being
+            consolidated have their shards folded.
+
+            Arguments:
+                cursor - query cursor to continue from
+                batch_size - number of configs to process, defaults to CONSOLIDATION_BATCH_SIZE
+                num - number of shards to keep, defaults to CONSOLIDATION_NUM_SHARDS
+                max_writes - maximal number of writes, defaults to CONSOLIDATION_MAX_WRITES
+
+            Returns: tuple (stats, cursor or None when there are no more configs)
+                stats - dictionary:
+                    configs - number of processed configs
+                    consolidated - number of counters with lowered number of shards
+                    folded - number of counters with finished consolidation
+        """
+        batch_size = batch_size or CONSOLIDATION_BATCH_SIZE
+        num = num or CONSOLIDATION_NUM_SHARDS
+        max_writes = CONSOLIDATION_MAX_WRITES if max_writes is None else max_writes
+
+        scheme = Counter._scheme()
+
+        configs, cursor, more = scheme.config_model.query().fetch_page(batch_size, start_cursor=cursor)
+        stats = {'configs': len(configs), 'consolidated': 0, 'folded': 0}
+
+        # Counters not migrated yet are consolidated after migration
+        configs = [config for config in configs if scheme.is_own_config(config)]
+        telemetry, values = Counter._read_contention([config.name for config in configs])
+
+        for config in configs:
+            name = config.name
+            if config.max_shards is not None:
+                if Counter.fold_shards(name):
+                    stats['folded'] += 1
+            elif config.num_shards > num and telemetry[name]['writes'] <= max_writes:
+                if Counter.consolidate_shards(name, num):
+                    stats['consolidated'] += 1
+
+        Counter._reset_contention(values)
+
+        logging.info('gcounter consolidation: %(configs)d configs, consolidated %(consolidated)d, folded %(folded)d' % stats)
+
+        return stats, cursor if more else None
+
+    @staticmethod
+    def add_delta(actions, counter_name, delta):
+        """Helper for adding delta to counter_name
+
+            Arguments:
+                actions - dictionary of counter actions
+                counter_name - the name of counter to change
+                delta - the amount to change counter
+        """
+
+        if counter_name is None:
+            return
+
+        if counter_name not in actions:
+            actions[counter_name] = 0
+
+        actions[counter_name] += delta
+
+        return actions
+
+    @staticmethod
+    def aggregate_counters(counter_actions, remove_zero=True):
+        """Aggregate array of counter action dictionaries to one dictionary"""
+
+        c_act_aggr = {}
+        for actions in counter_actions:
+            for action, delta in actions.items():
+                count = c_act_aggr.get(action, 0) + delta
+                if remove_zero and count == 0:
+                    c_act_aggr.pop(action, None)
+                else:
+                    c_act_aggr[action] = count
+
+        return c_act_aggr
+
+    @staticmethod
+    def partition_for(name, partitions):
+        """Get aggregation partition of the counter"""
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return (zlib.crc32(name) & 0xffffffff) % partitions
+
+    @staticmethod
+    def partition_actions(actions, partitions):
+        """Split counter actions by aggregation partitions
+
+            Returns: dictionary partition -> counter actions
+        """
+        parts = {}
+        for name, delta in actions.items():
+            parts.setdefault(Counter.partition_for(name, partitions), {})[name] = delta
+        return parts
+
+    @staticmethod
+    def partition_stored_actions(cursor=None, batch_size=None, time_budget=None, partitions=None):
+        """Split not partitioned CounterActions records by aggregation partitions
+
+            Each record is replaced by records with actions of one partition
+            in a cross group transaction.
+
+            Arguments:
+                cursor - query cursor to start from
+                batch_size - records per batch, defaults to AGGREGATION_BATCH_SIZE
+                time_budget - seconds after which no new batch is started,
+                              defaults to AGGREGATION_TIME_BUDGET
+                partitions - number of partitions, defaults to AGGREGATION_PARTITIONS
+
+            Returns: tuple (stats, cursor) the same way aggregate_stored_actions does
+        """
+        if batch_size is None:
+            batch_size = AGGREGATION_BATCH_SIZE
+        if time_budget is None:
+            time_budget = AGGREGATION_TIME_BUDGET
+        partitions = partitions or AGGREGATION_PARTITIONS
+
+        deadline = time.time() + time_budget
+
+        stats = {'records': 0, 'partitioned': 0}
+
+        # Records stored before partitions were added have no partition
+        # property at all and a "partition == None" filter never matches them
+        query = CounterActions.query(CounterActions.processed == False)
+
+        # At least one batch is always processed
+        more = True
+        while more:
+            records, cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+
+            futures = [Counter._split_actions_async(record.key, partitions)
+                       for record in records if record.partition is None]
+            created = [future.get_result() for future in futures]
+
+            stats['records'] += len([count for count in created if count is not None])
+            stats['partitioned'] += sum(count for count in created if count is not None)
+
+            if time.time() >= deadline:
+                break
+
+        return stats, cursor if more else None
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _split_actions_async(key, partitions):
+        """Replace CounterActions record with records for each partition
+
+            Returns: future resolving to number of created records or None
+                if the record has already been processed or partitioned
+        """
+        record = yield key.get_async()
+        if record is None or record.processed or record.partition is not None:
+            raise ndb.Return(None)
+
+        parts = Counter.partition_actions(record.actions, partitions)
+        yield ndb.put_multi_async([CounterActions(actions=part, partition=partition)
+                                   for partition, part in parts.items()])
+        yield key.delete_async()
+
+        raise ndb.Return(len(parts))
+
+    @staticmethod
+    def aggregate_stored_actions(cursor=None, batch_size=None, time_budget=None, partition=None):
+        """Aggregate and apply counter actions stored as CounterActions
+
+            Records are fetched in batches. Every batch is leased in
+            transactions (so no record is applied twice even when many
+            aggregations run in the same time), summed and applied with
+            Counter.apply_actions(). Only after the actions are applied the
+            records are marked as processed or deleted (see
+            AGGREGATION_DELETE_PROCESSED). If applying fails the leases are
+            released and the records are aggregated again by the next task.
+
+            Arguments:
+                cursor - query cursor to start from
+                batch_size - records per batch, defaults to AGGREGATION_BATCH_SIZE
+                time_budget - seconds after which no new batch is started,
+                              defaults to AGGREGATION_TIME_BUDGET
+                partition - aggregate only records of this partition,
+                            by default all the records are aggregated
+
+            Returns: tuple (stats, cursor) where stats is a dictionary with
+                number of processed records and changed counters and cursor
+                is the cursor to continue from or None if there are no more
+                records.
+        """
+        if batch_size is None:
+            batch_size = AGGREGATION_BATCH_SIZE
+        if time_budget is None:
+            time_budget = AGGREGATION_TIME_BUDGET
+
+        deadline = time.time() + time_budget
+
+        stats = {'records': 0, 'counters': 0}
+        query = CounterActions.query(CounterActions.processed == False)
+        if partition is not None:
+            query = query.filter(CounterActions.partition == partition)
+
+        # At least one batch is always processed
+        more = True
+        while more:
+            keys, cursor, more = query.fetch_page(batch_size, start_cursor=cursor, keys_only=True)
+
+            claimed, actions = Counter._apply_stored_actions(keys)
+
+            stats['records'] += len(claimed)
+            stats['counters'] += len(actions)
+
+            if time.time() >= deadline:
+                break
+
+        return stats, cursor if more else None
+
+    @staticmethod
+    def _apply_stored_actions(keys):
+        """Lease CounterActions records, apply their actions and finalize them
+
+            When applying some actions fails the other ones may be already
+            written, so the records are finalized and only the not applied
+            actions are stored again as new CounterActions records. The
+            leases are released only if those can't be stored.
+
+            Returns: tuple (leased records, applied actions)
+        """
+        lease = base64.urlsafe_b64encode(hashlib.sha1(str(random.random())).digest()[:12])
+
+        futures = [Counter._lease_actions_async(key, lease) for key in keys]
+        claimed = [future.get_result() for future in futures]
+        claimed = [record for record in claimed if record is not None]
+
+        actions = Counter.aggregate_counters(record.actions for record in claimed)
+        written = set()
+        try:
+            Counter._apply_actions_async(actions, written).get_result()
+        except Exception:
+            pending = dict((name, delta) for name, delta in actions.items() if name not in written)
+            try:
+                ndb.put_multi(CounterActions.build(pending))
+            except Exception:
+                ndb.Future.wait_all([Counter._release_actions_async(record.key, lease) for record in claimed])
+                raise
+            logging.exception('gcounter aggregation: %d actions stored again' % len(pending))
+            actions = dict((name, delta) for name, delta in actions.items() if name in written)
+
+        ndb.Future.wait_all([Counter._finalize_actions_async(record.key, lease) for record in claimed])
+
+        return claimed, actions
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def _lease_actions_async(key, lease):
+        """Lease CounterActions for AGGREGATION_LEASE_TIME seconds
+
+            Returns: future resolving to the record or None if it has
+                already been processed or is leased by other aggregation
+        """
+        now = datetime.datetime.utcnow()
+
+        record = yield key.get_async()
+        if record is None or record.processed or (record.leased_until is not None and record.leased_until > now):
+            raise ndb.Return(None)
+
+        record.lease = lease
+        record.leased_until = now + datetime.timedelta(seconds=AGGREGATION_LEASE_TIME)
+        yield record.put_async()
+
+        raise ndb.Return(record)
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def _finalize_actions_async(key, lease):
+        """Mark leased CounterActions as processed or delete it"""
+        record = yield key.get_async()
+        if record is None or record.processed or record.lease != lease:
+            return
+
+        if AGGREGATION_DELETE_PROCESSED:
+            yield key.delete_async()
+        else:
+            record.processed = True
+            record.lease = record.leased_until = None
+            yield record.put_async()
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def _release_actions_async(key, lease):
+        """Release the lease so the record is aggregated again"""
+        record = yield key.get_async()
+        if record is None or record.processed or record.lease != lease:
+            return
+
+        record.lease = record.leased_until = None
+        yield record.put_async()
+
+    @staticmethod
+    def get_children(prefix, limit=None):
+        """Get counters one level below the prefix and their values
+
+            Example: get_children('loc:us') returns values of 'loc:us:ca',
+            'loc:us:nv' and other regions but not of the cities in them.
+
+            Counters created moments ago may be missing because the index
+            is queried with eventually consistent query.
+
+            Arguments:
+                prefix - the name of the parent counter
+                limit - maximal number of counters
+
+            Returns: dictionary counter name -> value
+        """
+        return Counter.get_children_async(prefix, limit).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def get_children_async(prefix, limit=None):
+        """Asynchronous version of get_children"""
+        query = CounterNameIndex.query(CounterNameIndex.parent_name == prefix)
+        keys = yield query.fetch_async(limit, keys_only=True)
+        counts = yield Counter.get_counts_async([key.id() for key in keys])
+        raise ndb.Return(counts)
+
+    @staticmethod
+    def get_subtree(prefix, limit=None):
+        """Get all counters below the prefix and their values
+
+            Example: get_subtree('loc:us') returns values of all the regions
+            and cities in the US.
+
+            Arguments:
+                prefix - the name of the ancestor counter
+                limit - maximal number of counters
+
+            Returns: dictionary counter name -> value
+        """
+        return Counter.get_subtree_async(prefix, limit).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def get_subtree_async(prefix, limit=None):
+        """Asynchronous version of get_subtree"""
+        query = CounterNameIndex.query(CounterNameIndex.ancestors == prefix)
+        keys = yield query.fetch_async(limit, keys_only=True)
+        counts = yield Counter.get_counts_async([key.id() for key in keys])
+        raise ndb.Return(counts)
+
+    @staticmethod
+    def index_counter_names(cursor=None, batch_size=None):
+        """Add counters created before the prefix index existed to the index
+
+            Processes one page of shard configs.
 
+            Arguments:
+                cursor - query cursor to continue from
+                batch_size - number of configs to process, defaults to NAME_INDEX_BATCH_SIZE
+
+            Returns: tuple (stats, cursor or None when there are no more configs)
+                stats - dictionary:
+                    configs - number of processed configs
+                    indexed - number of indexed counter names
         """
-        config = GeneralCounterShardConfig.get_or_insert(name, name=name)
+        batch_size = batch_size or NAME_INDEX_BATCH_SIZE
 
-        @ndb.transactional
-        def txn():
-            if config.num_shards < num:
-                config.num_shards = num
-                config.put()
+        query = Counter._scheme().config_model.query()
+        configs, cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+
+        entries = [CounterNameIndex.build(config.name) for config in configs]
+        entries = [entry for entry in entries if entry is not None]
+        ndb.put_multi(entries)
 
-        txn()
+        return {'configs': len(configs), 'indexed': len(entries)}, cursor if more else None
 
     @staticmethod
-    def add_delta(actions, counter_name, delta):
-        """Helper for adding delta to counter_name
+    def migrate_shards(cursor=None, batch_size=None):
+        """Migrate counters from SHARD_SCHEME_PREVIOUS to SHARD_SCHEME
+
+            Processes one page of shard configs of the previous scheme. For
+            every not migrated counter the config is copied, shard values
+            are moved to the new scheme in transactions and the previous
+            config is deleted, so the migration may be safely repeated.
+
+            Start it after all the instances use the new scheme and keep
+            SHARD_SCHEME_PREVIOUS set until it's finished.
 
             Arguments:
-                actions - dictionary of counter actions
-                counter_name - the name of counter to change
-                delta - the amount to change counter
+                cursor - query cursor to continue from
+                batch_size - number of configs to process, defaults to SHARD_MIGRATION_BATCH_SIZE
+
+            Returns: tuple (stats, cursor or None when there are no more configs)
+                stats - dictionary:
+                    configs - number of processed configs
+                    counters - number of migrated counters
+                    shards - number of migrated shards
         """
+        previous = Counter._previous_scheme()
+        if previous is None:
+            raise NotSupportedError('SHARD_SCHEME_PREVIOUS is not set')
 
-        if counter_name is None:
+        batch_size = batch_size or SHARD_MIGRATION_BATCH_SIZE
+
+        configs, cursor, more = previous.config_model.query().fetch_page(batch_size, start_cursor=cursor)
+        stats = {'configs': len(configs), 'counters': 0, 'shards': 0}
+
+        for config in configs:
+            if previous.is_own_config(config):
+                stats['shards'] += Counter._migrate_counter(config)
+                stats['counters'] += 1
+
+        logging.info('gcounter migration: %(configs)d configs, %(counters)d counters, %(shards)d shards' % stats)
+
+        return stats, cursor if more else None
+
+    @staticmethod
+    def _migrate_counter(config):
+        """Migrate counter from the previous scheme
+
+            Arguments:
+                config - the shard config in the previous scheme
+
+            Returns: number of migrated shards
+        """
+        name = config.name
+
+        # Creates the config copy and its index entries
+        num_shards = Counter._get_configs_async([name]).get_result()[name].num_shards
+
+        indexes = range(max(config.num_shards, config.max_shards or 0))
+        folded = Counter._fold_shards_async(name, indexes, num_shards, Counter._previous_scheme(), Counter._scheme())
+
+        migrated = folded.get_result()
+        config.key.delete()
+
+        return migrated
+
+    @staticmethod
+    def get_series(name, start, end, granularity):
+        """Get values of time bucket counters
+
+            Values of not compacted finer buckets (see TIME_BUCKET_ROLLUP)
+            of recent periods are included. Buckets compacted into coarser
+            ones have value 0.
+
+            Arguments:
+                name - the name of the counter
+                start - datetime in UTC
+                end - datetime in UTC (inclusive)
+                granularity - 'hour', 'day' or 'month'
+
+            Returns: list of tuples (period start, value)
+        """
+        return Counter.get_series_async(name, start, end, granularity).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def get_series_async(name, start, end, granularity):
+        """Asynchronous version of get_series"""
+        periods = TimeBucket.periods(start, end, granularity)
+        names = dict((TimeBucket.name(name, granularity, period), period) for period in periods)
+
+        unrolled = datetime.datetime.utcnow() - datetime.timedelta(seconds=TIME_BUCKET_UNROLLED_TIME)
+
+        for period in periods:
+            period_end = TimeBucket.next(period, granularity)
+            if period_end <= unrolled:
+                continue
+            for fine in TimeBucket.finer(granularity):
+                for fine_period in TimeBucket.periods(max(period, TimeBucket.truncate(unrolled, fine)), period_end, fine):
+                    if fine_period < period_end:
+                        names[TimeBucket.name(name, fine, fine_period)] = period
+
+        counts = yield Counter.get_counts_async(names.keys())
+
+        values = dict((period, 0) for period in periods)
+        for bucket_name, period in names.items():
+            values[period] += counts[bucket_name]
+
+        raise ndb.Return([(period, values[period]) for period in periods])
+
+    @staticmethod
+    def rollup_time_buckets(batch_size=None, now=None):
+        """Compact fine time buckets into coarse ones
+
+            Every bucket is compacted in a transaction which deletes its
+            config, shards and index entry and stores its value as
+            CounterActions of the coarse bucket. The actions are applied
+            right away. If that fails the records stay pending and the
+            aggregation applies them (see Counter.aggregate_stored_actions).
+
+            Arguments:
+                batch_size - number of buckets to compact, defaults to TIME_BUCKET_ROLLUP_BATCH_SIZE
+                now - current datetime in UTC
+
+            Returns: tuple (stats, more)
+                stats - dictionary:
+                    buckets - number of compacted buckets
+                    delta - sum of absolute values of compacted buckets
+                more - True if there are more buckets to compact
+        """
+        if Counter._previous_scheme() is not None:
+            raise NotSupportedError('Time buckets are not compacted during shard migration')
+
+        batch_size = batch_size or TIME_BUCKET_ROLLUP_BATCH_SIZE
+        now = now or datetime.datetime.utcnow()
+
+        query = TimeBucketIndex.query(TimeBucketIndex.rollup_after <= now)
+        keys = query.fetch(batch_size + 1, keys_only=True)
+
+        stats = {'buckets': 0, 'delta': 0}
+
+        for key in keys[:batch_size]:
+            value = Counter._rollup_bucket(key.id())
+            if value is not None:
+                stats['buckets'] += 1
+                stats['delta'] += abs(value)
+
+        logging.info('gcounter rollup: %(buckets)d buckets, delta %(delta)d' % stats)
+
+        return stats, len(keys) > batch_size
+
+    @staticmethod
+    def _rollup_bucket(name):
+        """Compact fine time bucket into the coarse one
+
+            Returns: value of the bucket or None if it's already compacted
+        """
+        scheme = Counter._scheme()
+        counter_name, granularity, period = TimeBucket.parse(name)
+        coarse = TimeBucket.name(counter_name, TIME_BUCKET_ROLLUP[granularity], period)
+
+        config = scheme.config_key(name).get()
+        if config is not None:
+            # Cross group transaction may use at most 25 entity groups
+            num_shards = max(config.num_shards, config.max_shards or 0)
+            if num_shards > 20:
+                Counter._fold_shards_async(name, range(20, num_shards), 20, scheme, scheme).get_result()
+
+        value, keys = Counter._rollup_bucket_txn_async(name, coarse).get_result()
+
+        memcache.delete_multi([scheme.counter_id(name)])
+        memcache.delete_multi([scheme.counter_id(name)], key_prefix=SHARD_CONFIG_KEY_PREFIX)
+        Counter._num_shards_cache.delete(name)
+
+        try:
+            Counter._apply_stored_actions(keys)
+        except datastore_errors.Error:
+            # The value is safe in not processed CounterActions
+            logging.warning('gcounter rollup: %s left for the aggregation' % name)
+
+        return value
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _rollup_bucket_txn_async(name, coarse):
+        """Delete the bucket and store its value as action of the coarse bucket
+
+            Returns: future resolving to tuple (value, keys of stored actions)
+                     or (None, []) if the bucket is already compacted
+        """
+        scheme = Counter._scheme()
+        entry_key = ndb.Key(TimeBucketIndex, name)
+
+        entry, config = yield ndb.get_multi_async([entry_key, scheme.config_key(name)])
+        if entry is None:
+            raise ndb.Return(None, [])
+
+        deleted = [entry_key]
+        value = 0
+
+        if config is not None:
+            num_shards = min(max(config.num_shards, config.max_shards or 0), 20)
+            shards = yield ndb.get_multi_async(scheme.shard_keys(name, range(num_shards)))
+            shards = [shard for shard in shards if shard is not None and scheme.owns(shard, name)]
+
+            value = sum(shard.count for shard in shards)
+            deleted.append(config.key)
+            deleted.extend(shard.key for shard in shards)
+
+        records = CounterActions.build({coarse: value}) if value else []
+
+        deleted, keys = yield ndb.delete_multi_async(deleted), ndb.put_multi_async(records)
+        raise ndb.Return(value, keys)
+
+    @staticmethod
+    def get_histogram(counter_name, boundaries, force=False):
+        """Get counts of all the buckets of histogram counter with one call
+
+            Arguments:
+                counter_name - counter name of gcounter.HistogramProperty
+                boundaries - bucket boundaries of the property
+                force - Set to True to force counters retrieval from the Datastore
+
+            Returns: list of tuples (lower boundary, count) in bucket order,
+                     the lower boundary of the first bucket is None
+        """
+        return Counter.get_histogram_async(counter_name, boundaries, force).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def get_histogram_async(counter_name, boundaries, force=False):
+        """Asynchronous version of get_histogram"""
+        template = CounterNameTemplate(counter_name)
+        names = [template.render((label,)) for label in HistogramProperty.bucket_labels(boundaries)]
+
+        counts = yield Counter.get_counts_async(names, force)
+
+        lower = [None] + list(boundaries)
+        raise ndb.Return([(lower[idx], counts[name]) for idx, name in enumerate(names)])
+
+    @staticmethod
+    def get_window_count(name, window=None):
+        """Get value of rolling window counter (see RollingCounter)
+
+            Arguments:
+                name - the name of registered rolling window counter
+                window - window length in seconds
+        """
+        return RollingCounter.get(name).get_window_count(window)
+
+    @staticmethod
+    @ndb.tasklet
+    def _write_sketches_async(actions):
+        """Add values of HyperLogLog counter actions to the sketches"""
+        hashes = {}
+        for name, delta in actions.items():
+            # Values can't be removed from the sketch
+            if delta > 0:
+                counter_name, precision, hashed = HyperLogLogSketch.parse_action_name(name)
+                hashes.setdefault((counter_name, precision), []).append(hashed)
+
+        if not hashes:
             return
 
-        if counter_name not in actions:
-            actions[counter_name] = 0
+        yield [Counter._update_sketch_async(name, precision, values) for (name, precision), values in hashes.items()]
 
-        actions[counter_name] += delta
+        memcache.delete_multi([name for name, precision in hashes], key_prefix=HLL_KEY_PREFIX)
 
-        return actions
+    @staticmethod
+    @ndb.transactional_tasklet
+    def _update_sketch_async(name, precision, hashes):
+        """Add hashed values to randomly chosen shard of the sketch"""
+        key = ndb.Key(HyperLogLogShard, '%s:%d' % (name, random.randint(0, HLL_NUM_SHARDS - 1)))
+        shard = yield key.get_async()
+
+        if shard is None:
+            sketch = HyperLogLogSketch(precision)
+        elif shard.precision != precision:
+            raise ModelTrackingError('HyperLogLog counter %s has precision %d' % (name, shard.precision))
+        else:
+            sketch = HyperLogLogSketch(precision, shard.registers)
+
+        changed = [sketch.add_hash(hashed) for hashed in hashes]
+
+        # Most of the values are already in the sketch
+        if any(changed):
+            yield HyperLogLogShard(key=key, precision=precision, registers=str(sketch.registers)).put_async()
+
+    # Compiled patterns of heavy hitters families templates: template -> regexp
+    _top_k_patterns = {}
+
+    # Families loaded from the Datastore: (template -> top_k, expires) or None
+    _top_k_families = None
 
     @staticmethod
-    def aggregate_counters(counter_actions, remove_zero=True):
-        """Aggregate array of counter action dictionaries to one dictionary"""
+    @ndb.tasklet
+    def _get_top_k_families_async():
+        """Get heavy hitters families stored in the Datastore and declared in this process
 
-        c_act_aggr = {}
-        for actions in counter_actions:
-            for action, delta in actions.items():
-                count = c_act_aggr.get(action, 0) + delta
-                if remove_zero and count == 0:
-                    del c_act_aggr[action]
-                else:
-                    c_act_aggr[action] = count
+            Declared families which are not stored yet are stored.
 
-        return c_act_aggr
+            Returns: future resolving to dictionary template -> top_k
+        """
+        cached = Counter._top_k_families
+        if cached is not None and cached[1] > time.time():
+            raise ndb.Return(cached[0])
+
+        stored = yield TopCounterFamily.query().fetch_async()
+        families = dict((family.key.id(), family.top_k) for family in stored)
+
+        declared = [TopCounterFamily(id=template, top_k=max(top_k, families.get(template, 0)))
+                    for template, top_k in TOP_K_FAMILIES.items() if top_k > families.get(template, 0)]
+        if declared:
+            yield ndb.put_multi_async(declared)
+            families.update((family.key.id(), family.top_k) for family in declared)
+
+        Counter._top_k_families = (families, time.time() + TOP_K_FAMILIES_CACHE_TIME)
+        raise ndb.Return(families)
+
+    @staticmethod
+    def _top_k_family(name, families):
+        """Get template of the heavy hitters family the counter belongs to or None"""
+        for template in families:
+            pattern = Counter._top_k_patterns.get(template)
+            if pattern is None:
+                prefix, suffix = template.split('%s')
+                pattern = re.compile('^%s[^:@|]+%s$' % (re.escape(prefix), re.escape(suffix)))
+                Counter._top_k_patterns[template] = pattern
+            if pattern.match(name):
+                return template
+        return None
+
+    @staticmethod
+    def _top_k_key(template, name):
+        """Get key of the summary shard tracking the counter"""
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return ndb.Key(TopCounterShard, '%s|%d' % (template, (zlib.crc32(name) & 0xffffffff) % TOP_K_NUM_SHARDS))
+
+    @staticmethod
+    @ndb.tasklet
+    def _update_top_counters_async(actions):
+        """Apply counter actions to summaries of their families"""
+        families = yield Counter._get_top_k_families_async()
+        if not families:
+            return
+
+        changes = {}
+        for name, delta in actions.items():
+            template = Counter._top_k_family(name, families)
+            if template is not None:
+                key = Counter._top_k_key(template, name)
+                changes.setdefault(key, (families[template], []))[1].append((name, delta))
+
+        if not changes:
+            return
+
+        futures = [(key, Counter._update_top_counter_shard_async(key, deltas, capacity))
+                   for key, (capacity, deltas) in changes.items()]
+        for key, future in futures:
+            try:
+                yield future
+            except datastore_errors.TransactionFailedError:
+                # Counters are already written so the summary is best effort
+                logging.warning('gcounter top counters: failed to update %s' % key.id())
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def _update_top_counter_shard_async(key, deltas, capacity):
+        """Apply counter changes to one summary shard"""
+        shard = yield key.get_async()
+        if shard is None:
+            shard = TopCounterShard(key=key)
+
+        changed = [shard.change(name, delta, capacity) for name, delta in deltas]
+        if any(changed):
+            yield shard.put_async()
+
+    @staticmethod
+    def get_top(template, k=None, exact=False):
+        """Get the biggest counters of complex counter family
+
+            Counts come from space-saving summaries updated when counter
+            actions are written. They count only changes made since the
+            family got top_k: values counters had before are missing.
+            Counters which entered full summary inherit the count of the
+            counter they replaced so they may be overestimated.
+
+            Arguments:
+                template - counter name template, for example 'song_author:%s'
+                k - number of counters to return, all the tracked by default
+                exact - Set to True to replace summary counts with counter
+                        values (one more batched read)
+
+            Returns: list of tuples (counter name, count) sorted by count
+        """
+        return Counter.get_top_async(template, k, exact).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def get_top_async(template, k=None, exact=False):
+        """Asynchronous version of get_top"""
+        keys = [ndb.Key(TopCounterShard, '%s|%d' % (template, idx)) for idx in range(TOP_K_NUM_SHARDS)]
+        shards = yield ndb.get_multi_async(keys)
+
+        top = []
+        for shard in shards:
+            if shard is not None:
+                top.extend(zip(shard.names, shard.counts))
+
+        if exact and top:
+            counts = yield Counter.get_counts_async([name for name, count in top])
+            top = [(name, counts[name]) for name, count in top]
+
+        top.sort(key=lambda item: (-item[1], item[0]))
+        raise ndb.Return(top if k is None else top[:k])
+
+    # Dimensions of count-min sketch families: template -> (width, depth)
+    _count_min_families = {}
+
+    @staticmethod
+    @ndb.tasklet
+    def _write_count_min_async(actions):
+        """Add deltas of count-min sketch counter actions to the sketch cells
+
+            Every block is changed in its own transaction in a randomly
+            chosen shard. Changes of blocks which failed to be written are
+            stored as CounterActions with cell actions so they are not lost.
+        """
+        cells = {}
+        totals = {}
+        families = {}
+        for name, delta in actions.items():
+            if delta == 0:
+                continue
+            cell = CountMinSketch.parse_cell_action_name(name)
+            if cell is not None:
+                cells[cell] = cells.get(cell, 0) + delta
+                continue
+            template, width, depth, slug = CountMinSketch.parse_action_name(name)
+            families[template] = (width, depth)
+            Counter.add_delta(totals, CountMinSketch.total_name(template), delta)
+            for row, column in enumerate(CountMinSketch.cells(width, depth, slug)):
+                cells[(template, row, column)] = cells.get((template, row, column), 0) + delta
+
+        if not cells:
+            return
+
+        yield Counter._register_count_min_families_async(families)
+
+        blocks = {}
+        for (template, row, column), delta in cells.items():
+            block, offset = divmod(column, CMS_BLOCK_SIZE)
+            deltas = blocks.setdefault((template, row, block), {})
+            deltas[offset] = deltas.get(offset, 0) + delta
+
+        futures = []
+        for (template, row, block), deltas in blocks.items():
+            key = CountMinSketch.block_key(template, row, block, random.randint(0, CMS_NUM_SHARDS - 1))
+            futures.append((template, row, block, deltas, Counter._change_count_min_block_async(key, deltas)))
+
+        failed = {}
+        for template, row, block, deltas, future in futures:
+            try:
+                yield future
+            except datastore_errors.Error:
+                for offset, delta in deltas.items():
+                    failed[CountMinSketch.cell_action_name(template, row, block * CMS_BLOCK_SIZE + offset)] = delta
+
+        written = set()
+        try:
+            yield Counter._write_actions_async(totals, written)
+        except datastore_errors.Error:
+            failed.update((name, delta) for name, delta in totals.items() if name not in written)
+
+        if failed:
+            logging.warning('gcounter count-min: %d changes stored for the aggregation' % len(failed))
+            yield ndb.put_multi_async(CounterActions.build(failed))
+
+    @staticmethod
+    @ndb.tasklet
+    def _register_count_min_families_async(families):
+        """Store dimensions of count-min sketch families written the first time"""
+        missing = [template for template in families if template not in Counter._count_min_families]
+        stored = yield [CountMinFamily.get_or_insert_async(template, width=families[template][0], depth=families[template][1])
+                        for template in missing]
+
+        for template, family in zip(missing, stored):
+            Counter._count_min_families[template] = (family.width, family.depth)
+
+        for template, dimensions in families.items():
+            if Counter._count_min_families[template] != dimensions:
+                raise ModelTrackingError('Count-min sketch %s is already %dx%d.' % ((template,) + Counter._count_min_families[template]))
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def _change_count_min_block_async(key, deltas):
+        """Add deltas to cells of one block shard of count-min sketch"""
+        block = yield key.get_async()
+        if block is None:
+            block = CountMinBlock(key=key)
+
+        size = max(deltas) + 1
+        if len(block.counts) < size:
+            block.counts.extend([0] * (size - len(block.counts)))
+
+        for offset, delta in deltas.items():
+            block.counts[offset] += delta
+
+        yield block.put_async()
+
+    @staticmethod
+    def get_estimate(template, value):
+        """Get estimated count of the value of count-min sketch counter
+
+            Returns: tuple (estimate, maximal overestimation)
+        """
+        return Counter.get_estimates(template, [value])[value]
+
+    @staticmethod
+    def get_estimates(template, values):
+        """Get estimated counts of many values of count-min sketch counter
+
+            The estimate exceeds the true count by at most the returned
+            bound with probability 1 - e ** -depth. It's never lower than
+            the true count unless changes of some rows wait in
+            CounterActions for the aggregation. All the cells are fetched
+            with one Datastore call.
+
+            Arguments:
+                template - counter name template of gcounter.CountMinProperty
+                values - not slugified property values
+
+            Returns: dictionary value -> tuple (estimate, maximal overestimation)
+        """
+        return Counter.get_estimates_async(template, values).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def get_estimates_async(template, values):
+        """Asynchronous version of get_estimates"""
+        values = list(set(values))
+
+        # Dimensions are stored at the first write so nothing was written without them
+        dimensions = Counter._count_min_families.get(template)
+        if dimensions is None:
+            family = yield ndb.Key(CountMinFamily, template).get_async()
+            if family is None:
+                raise ndb.Return(dict((value, (0, 0)) for value in values))
+            dimensions = Counter._count_min_families[template] = (family.width, family.depth)
+        width, depth = dimensions
+
+        cells = [CountMinSketch.cells(width, depth, TextTools.slugify(value)) for value in values]
+
+        keys = list(set(CountMinSketch.block_key(template, row, column // CMS_BLOCK_SIZE, shard)
+                        for value_cells in cells for row, column in enumerate(value_cells)
+                        for shard in range(CMS_NUM_SHARDS)))
+        blocks, total = yield ndb.get_multi_async(keys), Counter.get_counts_async([CountMinSketch.total_name(template)])
+        blocks = dict(zip(keys, blocks))
+
+        bound = CountMinSketch.error_bound(width, max(total[CountMinSketch.total_name(template)], 0))
+
+        estimates = {}
+        for value, value_cells in zip(values, cells):
+            counts = []
+            for row, column in enumerate(value_cells):
+                block, offset = divmod(column, CMS_BLOCK_SIZE)
+                count = 0
+                for shard in range(CMS_NUM_SHARDS):
+                    entity = blocks[CountMinSketch.block_key(template, row, block, shard)]
+                    if entity is not None and offset < len(entity.counts):
+                        count += entity.counts[offset]
+                counts.append(count)
+            estimates[value] = (max(min(counts), 0), bound)
+
+        raise ndb.Return(estimates)
+
+    @staticmethod
+    def get_sketch(name):
+        """Get HyperLogLog sketch of the counter merged from all the shards
+
+            Returns: HyperLogLogSketch or None if nothing was added
+        """
+        return Counter.get_sketches_async([name]).get_result()[name]
+
+    @staticmethod
+    @ndb.tasklet
+    def get_sketches_async(names):
+        """Get HyperLogLog sketches of many counters with one Datastore call
+
+            Returns: future resolving to dictionary counter name -> sketch or None
+        """
+        keys = [ndb.Key(HyperLogLogShard, '%s:%d' % (name, idx)) for name in names for idx in range(HLL_NUM_SHARDS)]
+        shards = yield ndb.get_multi_async(keys)
+
+        sketches = dict((name, None) for name in names)
+        for idx, shard in enumerate(shards):
+            if shard is None:
+                continue
+            name = names[idx // HLL_NUM_SHARDS]
+            sketch = HyperLogLogSketch(shard.precision, shard.registers)
+            if sketches[name] is None:
+                sketches[name] = sketch
+            else:
+                sketches[name].merge(sketch)
+
+        raise ndb.Return(sketches)
+
+    @staticmethod
+    def get_distinct_count(name, force=False):
+        """Get estimated number of distinct values of HyperLogLog counter
+
+            Arguments:
+                name - the name of the counter
+                force - Set to True to skip memcache
+        """
+        return Counter.get_distinct_counts([name], force)[name]
+
+    @staticmethod
+    def get_distinct_counts(names, force=False):
+        """Get estimated numbers of distinct values of many HyperLogLog counters
+
+            Returns: dictionary counter name -> estimate
+        """
+        names = list(set(names))
+        counts = {} if force is True else memcache.get_multi(names, key_prefix=HLL_KEY_PREFIX)
+        missing = [name for name in names if name not in counts]
+
+        if missing:
+            sketches = Counter.get_sketches_async(missing).get_result()
+            estimated = dict((name, sketch.estimate() if sketch else 0) for name, sketch in sketches.items())
+            memcache.add_multi(estimated, key_prefix=HLL_KEY_PREFIX, time=HLL_CACHE_TIME)
+            counts.update(estimated)
+
+        return counts
 
     @staticmethod
     def get_model_counters(models):
@@ -847,3 +3954,162 @@ class Counter(object):
             ca = model.get_counter_actions()
             counter_actions.append(ca)
         return counter_actions
+
+
+class RollingCounter(object):
+    """Counter of changes made in the last N seconds
+
+        Changes are kept in a ring of time slots, every slot split into
+        shards. Slots are reused when the ring wraps around and zeroed
+        lazily on the first write in the new epoch, so reading the window
+        is one batched get of window / slot_time * num_shards shards no
+        matter how many changes there were.
+
+        Example:
+
+            active = RollingCounter('active_users', slot_time=60, slots=15)
+            active.incr()
+            active.get_window_count(15 * 60)
+
+        Counters are registered by name so they can be read with
+        RollingCounter.get(name).
+    """
+
+    # Registered counters: name -> RollingCounter
+    _counters = {}
+
+    def __init__(self, name, slot_time=None, slots=None, num_shards=None):
+        """Define rolling window counter
+
+            Arguments:
+                name - the name of the counter
+                slot_time - length of time slot in seconds, defaults to ROLLING_SLOT_TIME
+                slots - number of slots, defaults to ROLLING_SLOTS. The
+                        longest window is slot_time * slots seconds.
+                num_shards - number of shards per slot, defaults to ROLLING_NUM_SHARDS
+        """
+        self.name = name
+        self.slot_time = slot_time or ROLLING_SLOT_TIME
+        self.slots = slots or ROLLING_SLOTS
+        self.num_shards = num_shards or ROLLING_NUM_SHARDS
+
+        RollingCounter._counters[name] = self
+
+    @staticmethod
+    def get(name):
+        """Get registered rolling window counter"""
+        return RollingCounter._counters[name]
+
+    def _epoch(self, now=None):
+        return int((now or time.time()) // self.slot_time)
+
+    def _shard_key(self, epoch, shard):
+        return ndb.Key(RollingCounterShard, '%s:%d:%d' % (self.name, epoch % self.slots, shard))
+
+    def incr(self, now=None):
+        """Increment the counter"""
+        self.change_async(1, now).get_result()
+
+    def decr(self, now=None):
+        """Decrement the counter"""
+        self.change_async(-1, now).get_result()
+
+    @ndb.transactional_tasklet
+    def change_async(self, delta, now=None):
+        """Change the counter by delta
+
+            Arguments:
+                delta - the change delta. Ex.: -1, +1, +10...
+                now - time of the change, defaults to now
+        """
+        epoch = self._epoch(now)
+        key = self._shard_key(epoch, random.randint(0, self.num_shards - 1))
+
+        shard = yield key.get_async()
+        if shard is None:
+            shard = RollingCounterShard(key=key, epoch=epoch)
+        elif shard.epoch != epoch:
+            # The slot was used in the previous turn of the ring
+            shard.epoch = epoch
+            shard.count = 0
+
+        shard.count += delta
+        yield shard.put_async()
+
+    def get_window_count(self, window=None, now=None, force=False):
+        """Get sum of changes made in the window
+
+            The window is rounded up to whole slots and includes the
+            current, not finished slot.
+
+            Arguments:
+                window - window length in seconds, defaults to all the slots
+                now - the end of the window, defaults to now
+                force - set to True to skip memcache
+        """
+        return self.get_window_count_async(window, now, force).get_result()
+
+    @ndb.tasklet
+    def get_window_count_async(self, window=None, now=None, force=False):
+        """Asynchronous version of get_window_count"""
+        num_slots = self.slots if window is None else min(self.slots, max(1, -(-window // self.slot_time)))
+        last = self._epoch(now)
+
+        cache_key = '%s%s:%d:%d' % (ROLLING_KEY_PREFIX, self.name, num_slots, last)
+        if not force:
+            count = memcache.get(cache_key)
+            if count is not None:
+                raise ndb.Return(count)
+
+        epochs = []
+        keys = []
+        for epoch in range(last - num_slots + 1, last + 1):
+            for shard in range(self.num_shards):
+                epochs.append(epoch)
+                keys.append(self._shard_key(epoch, shard))
+
+        shards = yield ndb.get_multi_async(keys)
+
+        count = sum(shard.count for shard, epoch in zip(shards, epochs) if shard is not None and shard.epoch == epoch)
+
+        memcache.set(cache_key, count, time=ROLLING_CACHE_TIME)
+        raise ndb.Return(count)
+
+
+def put_multi_with_actions(entities, **ctx_options):
+    """Put many entities and get their counter actions
+
+        Counter actions of all the entities are aggregated into one
+        dictionary while they are put. The actions are not kept in the
+        entities so get_counter_actions() called on them returns empty
+        dictionary.
+
+        Arguments:
+            entities - list of gcounter.Model instances
+            ctx_options - context options passed to ndb.put_multi
+
+        Returns: dictionary of aggregated counter actions
+    """
+    return put_multi_with_actions_async(entities, **ctx_options).get_result()
+
+
+@ndb.tasklet
+def put_multi_with_actions_async(entities, **ctx_options):
+    """Asynchronous version of put_multi_with_actions
+
+        The same entity must not be put by two batches running in the
+        same time.
+
+        Returns: future resolving to the dictionary of aggregated counter actions
+    """
+    actions = {}
+    for entity in entities:
+        entity._actions_sink = actions
+
+    try:
+        yield ndb.put_multi_async(entities, **ctx_options)
+    finally:
+        for entity in entities:
+            entity._actions_sink = None
+
+    raise ndb.Return(dict((counter_name, delta) for counter_name, delta in actions.items() if delta != 0))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Request handlers for periodic Global Counter tasks
+
+Add them to your app.yaml:
+
+    - url: /admin/scr/.*
+      script: gcounter_tasks.app
+      login: admin
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+import json
+
+# GAE imports
+import webapp2
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+# Global Counter imports
+import gcounter
+
+
+class FlushCountersHandler(webapp2.RequestHandler):
+    """Write counter changes accumulated in write-behind buffers to the Datastore
+
+        Run it from cron when gcounter.WRITE_BEHIND is enabled.
+    """
+
+    def get(self):
+        stats = gcounter.Counter.flush_buffers()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats))
+
+
+class AutoscaleShardsHandler(webapp2.RequestHandler):
+    """Increase the number of shards of contended counters
+
+        Run it from cron. Responds with the new number of shards of scaled
+        counters.
+    """
+
+    def get(self):
+        scaled = gcounter.Counter.autoscale_shards()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(scaled))
+
+
+class ConsolidateShardsHandler(webapp2.RequestHandler):
+    """Consolidate shards of cold counters
+
+        GET (run it from cron) starts the consolidation task. The task
+        re-enqueues itself until all the shard configs are processed.
+    """
+
+    def get(self):
+        add_paged_task(gcounter.CONSOLIDATION_URL, gcounter.CONSOLIDATION_QUEUE)
+
+    def post(self):
+        cursor = decode_cursor(self.request.get('cursor'))
+        stats, cursor = gcounter.Counter.consolidate_cold_shards(cursor=cursor)
+
+        if cursor is not None:
+            add_paged_task(gcounter.CONSOLIDATION_URL, gcounter.CONSOLIDATION_QUEUE, cursor)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats))
+
+
+class IndexCounterNamesHandler(webapp2.RequestHandler):
+    """Add counters created before the prefix index existed to the index
+
+        GET starts the indexing task. The task re-enqueues itself until all
+        the shard configs are processed. It has to be run only once.
+    """
+
+    def get(self):
+        add_paged_task(gcounter.NAME_INDEX_URL, gcounter.NAME_INDEX_QUEUE)
+
+    def post(self):
+        cursor = decode_cursor(self.request.get('cursor'))
+        stats, cursor = gcounter.Counter.index_counter_names(cursor=cursor)
+
+        if cursor is not None:
+            add_paged_task(gcounter.NAME_INDEX_URL, gcounter.NAME_INDEX_QUEUE, cursor)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats))
+
+
+class MigrateShardsHandler(webapp2.RequestHandler):
+    """Migrate counters from gcounter.SHARD_SCHEME_PREVIOUS to gcounter.SHARD_SCHEME
+
+        GET starts the migration task. The task re-enqueues itself until all
+        the shard configs are processed.
+    """
+
+    def get(self):
+        add_paged_task(gcounter.SHARD_MIGRATION_URL, gcounter.SHARD_MIGRATION_QUEUE)
+
+    def post(self):
+        cursor = decode_cursor(self.request.get('cursor'))
+        stats, cursor = gcounter.Counter.migrate_shards(cursor=cursor)
+
+        if cursor is not None:
+            add_paged_task(gcounter.SHARD_MIGRATION_URL, gcounter.SHARD_MIGRATION_QUEUE, cursor)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats))
+
+
+class RollupTimeBucketsHandler(webapp2.RequestHandler):
+    """Compact fine time bucket counters into coarse ones
+
+        GET (run it from cron) starts the rollup task. The task re-enqueues
+        itself until there are no more buckets to compact.
+    """
+
+    def get(self):
+        taskqueue.add(url=gcounter.TIME_BUCKET_ROLLUP_URL, queue_name=gcounter.TIME_BUCKET_ROLLUP_QUEUE)
+
+    def post(self):
+        stats, more = gcounter.Counter.rollup_time_buckets()
+
+        if more:
+            taskqueue.add(url=gcounter.TIME_BUCKET_ROLLUP_URL, queue_name=gcounter.TIME_BUCKET_ROLLUP_QUEUE)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats))
+
+
+class AggregateCountersHandler(webapp2.RequestHandler):
+    """Aggregate counter actions stored as gcounter.CounterActions
+
+        GET (run it from cron) starts the aggregation task. The task
+        re-enqueues itself until all the stored actions are processed.
+
+        When gcounter.AGGREGATION_PARTITIONS is greater than 1 the first
+        task splits not partitioned records by partitions and then starts
+        one aggregation task per partition.
+    """
+
+    def get(self):
+        add_aggregation_task()
+
+    def post(self):
+        partition = self.request.get('partition')
+        cursor = decode_cursor(self.request.get('cursor'))
+
+        if not partition and gcounter.AGGREGATION_PARTITIONS > 1:
+            stats, cursor = gcounter.Counter.partition_stored_actions(cursor=cursor)
+
+            if cursor is not None:
+                add_aggregation_task(cursor)
+            else:
+                for partition in range(gcounter.AGGREGATION_PARTITIONS):
+                    add_aggregation_task(partition=partition)
+        else:
+            partition = int(partition) if partition else None
+            stats, cursor = gcounter.Counter.aggregate_stored_actions(cursor=cursor, partition=partition)
+
+            if cursor is not None:
+                add_aggregation_task(cursor, partition)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats))
+
+
+def add_aggregation_task(cursor=None, partition=None):
+    """Add aggregation task to the queue"""
+    params = {}
+    if cursor is not None:
+        params['cursor'] = encode_cursor(cursor)
+    if partition is not None:
+        params['partition'] = partition
+
+    taskqueue.add(url=gcounter.AGGREGATION_URL, params=params, queue_name=gcounter.AGGREGATION_QUEUE)
+
+
+def add_paged_task(url, queue_name, cursor=None):
+    """Add task processing query results page by page to the queue"""
+    params = {}
+    if cursor is not None:
+        params['cursor'] = encode_cursor(cursor)
+
+    taskqueue.add(url=url, params=params, queue_name=queue_name)
+
+
+def encode_cursor(cursor):
+    """Encode query cursor as task parameter"""
+    return cursor.urlsafe().rstrip('=')
+
+
+def decode_cursor(value):
+    """Decode query cursor encoded with encode_cursor"""
+    if not value:
+        return None
+    return ndb.Cursor(urlsafe=str(value) + '=' * (-len(value) % 4))
+
+
+app = webapp2.WSGIApplication([
+    ('/admin/scr/flush-counters', FlushCountersHandler),
+    ('/admin/scr/autoscale-shards', AutoscaleShardsHandler),
+    (gcounter.AGGREGATION_URL, AggregateCountersHandler),
+    (gcounter.CONSOLIDATION_URL, ConsolidateShardsHandler),
+    (gcounter.NAME_INDEX_URL, IndexCounterNamesHandler),
+    (gcounter.SHARD_MIGRATION_URL, MigrateShardsHandler),
+    (gcounter.TIME_BUCKET_ROLLUP_URL, RollupTimeBucketsHandler),
+])
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for gcounter.HistogramProperty
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+
+# Global Counter imports
+import gcounter
+
+# Global Counter tests imports
+from tests import helper_models
+from tests.base_test import TestCountersMain
+
+
+class TestHistogramCounters(TestCountersMain):
+    """Global counters tracking histogram of integer properties should behave in the following way:
+
+        For new models:
+         - generate +1 counter action for the bucket of the tracked value.
+         - models persisted with tracked value set to None should not
+           generate any counter actions.
+
+        For models that are retrieved from the Datastore:
+         - changing tracked value within the bucket should not generate
+           any counter actions.
+         - changing tracked value to another bucket should generate -1
+           for the old and +1 for the new bucket.
+    """
+
+    def testBucketLabel(self):
+
+        boundaries = (18, 25, 50)
+
+        self.assertEqual('lt18', gcounter.HistogramProperty.bucket_label(boundaries, -3))
+        self.assertEqual('lt18', gcounter.HistogramProperty.bucket_label(boundaries, 17))
+        self.assertEqual('18', gcounter.HistogramProperty.bucket_label(boundaries, 18))
+        self.assertEqual('25', gcounter.HistogramProperty.bucket_label(boundaries, 49))
+        self.assertEqual('50', gcounter.HistogramProperty.bucket_label(boundaries, 1000))
+        self.assertEqual(['lt18', '18', '25', '50'], gcounter.HistogramProperty.bucket_labels(boundaries))
+
+    def testInitHI1(self):
+
+        model = helper_models.TestHI1(hi1=20)
+        model.put()
+
+        self.assertEquals({'hi1n:18': 1}, model.get_counter_actions())
+
+    def testInitHI1None(self):
+
+        model = helper_models.TestHI1()
+        model.put()
+
+        self.assertEquals({}, model.get_counter_actions())
+
+    def testSameBucket(self):
+
+        model = helper_models.TestHI1(hi1=20)
+        model.put()
+
+        model.hi1 = 24
+        model.put()
+
+        self.assertEquals({}, model.get_counter_actions())
+
+    def testMoveBucket(self):
+
+        model = helper_models.TestHI1(hi1=20)
+        model.put()
+        self.clearContext()
+
+        model = model.key.get()
+        model.hi1 = 10
+        model.put()
+        self.assertEquals({'hi1n:18': -1, 'hi1n:lt18': 1}, model.get_counter_actions())
+
+        model.hi1 = None
+        model.put()
+        self.assertEquals({'hi1n:lt18': -1}, model.get_counter_actions())
+
+    def testGetHistogram(self):
+
+        models = [helper_models.TestHI1(hi1=value) for value in (5, 18, 20, 30, 70, None)]
+        gcounter.Counter.apply_actions(gcounter.put_multi_with_actions(models))
+
+        self.assertEqual([(None, 1), (18, 2), (25, 1), (50, 1)], gcounter.Counter.get_histogram('hi1n:%s', (18, 25, 50)))
+
+    def testValidation(self):
+
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.HistogramProperty, counter_name='age', boundaries=[1])
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.HistogramProperty, counter_name='age:<co>:%s', boundaries=[1])
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.HistogramProperty, counter_name='age:%s', boundaries=[])
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.HistogramProperty, counter_name='age:%s', boundaries=[5, 1])
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.HistogramProperty, counter_name='age:%s', boundaries=[1],
+                          repeated=True)
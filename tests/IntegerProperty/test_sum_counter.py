@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for gcounter.SumProperty
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+
+# Global Counter imports
+import gcounter
+
+# Global Counter tests imports
+from tests import helper_models
+from tests.base_test import TestCountersMain
+
+
+class TestSumCounters(TestCountersMain):
+    """Global counters tracking sum of integer properties should behave in the following way:
+
+        For new models:
+         - generate counter action equal to the tracked value.
+         - models persisted with tracked value set to 0 or None should not
+           generate any counter actions.
+
+        For models that are retrieved from the Datastore:
+         - changing tracked value should generate counter action equal to
+           the new value minus the old value.
+         - None is treated as 0.
+    """
+
+    def testInitSI1(self):
+
+        model = helper_models.TestSI1(si1=123)
+        model.put()
+
+        self.assertEquals({'si1n': 123}, model.get_counter_actions())
+
+    def testSetSI1Negative(self):
+
+        model = helper_models.TestSI1()
+        model.si1 = -5
+        model.put()
+
+        self.assertEquals({'si1n': -5}, model.get_counter_actions())
+
+    def testInitSI1None(self):
+
+        model = helper_models.TestSI1(si1=None)
+        model.put()
+
+        self.assertEquals({}, model.get_counter_actions())
+
+    def testDefaultSI2(self):
+
+        model = helper_models.TestSI2()
+        model.put()
+
+        self.assertEquals({'si2n': 10}, model.get_counter_actions())
+
+    def testChangeSI1(self):
+
+        model = helper_models.TestSI1(si1=10)
+        model.put()
+
+        model.si1 = 25
+        model.put()
+        self.assertEquals({'si1n': 15}, model.get_counter_actions())
+
+        model.si1 = 5
+        model.put()
+        self.assertEquals({'si1n': -20}, model.get_counter_actions())
+
+        model.si1 = None
+        model.put()
+        self.assertEquals({'si1n': -5}, model.get_counter_actions())
+
+    def testChangeAfterGet(self):
+
+        model = helper_models.TestSI1(si1=10)
+        model.put()
+        self.clearContext()
+
+        model = model.key.get()
+        model.si1 = 7
+        model.put()
+
+        self.assertEquals({'si1n': -3}, model.get_counter_actions())
+
+    def testSameValue(self):
+
+        model = helper_models.TestSI1(si1=10)
+        model.put()
+
+        model.si1 = 10
+        model.put()
+
+        self.assertEquals({}, model.get_counter_actions())
+
+    def testTotal(self):
+
+        models = [helper_models.TestSI1(si1=value) for value in (3, 4, 5)]
+        gcounter.Counter.apply_actions(gcounter.put_multi_with_actions(models))
+
+        models[0].si1 = 10
+        models[0].put()
+        gcounter.Counter.apply_actions(models[0].get_counter_actions())
+
+        self.assertEqual(19, gcounter.Counter.get_count('si1n'))
+
+    def testComputed(self):
+
+        model = helper_models.TestCP4(name='Rafal')
+        model.put()
+        self.assertEquals({'cp4n': 5}, model.get_counter_actions())
+
+        model.name = 'Raf'
+        model.put()
+        self.assertEquals({'cp4n': -2}, model.get_counter_actions())
+
+    def testMustBeSimpleCounter(self):
+
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.SumProperty, counter_name='sum:%s')
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.SumProperty, counter_name='sum', repeated=True)
@@ -31,6 +31,7 @@ class TestCountersMain(BaseTestCase):
         self.setup_testbed()
         self.init_datastore_stub()
         self.init_memcache_stub()
+        gcounter.Counter.flush_local_cache()
 
     def tearDown(self):
         self.teardown_testbed()
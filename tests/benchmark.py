@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro benchmarks for Global Counter module.
+
+Example usage:
+
+  To run all benchmarks
+
+    $ benchmark.py /sdk/path
+
+  To run one benchmark
+
+    $ benchmark.py /sdk/path instantiation
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+import os
+import sys
+import timeit
+
+USAGE = """Usage: benchmark.py SDK_PATH [BENCHMARK_NAME]
+
+Run Global Counter micro benchmarks.
+
+SDK_PATH        Path to the AppEngine SDK
+BENCHMARK_NAME  The name of the benchmark to run (all by default)
+"""
+
+# Number of times each benchmark is repeated. The best result is reported.
+REPEAT = 3
+
+# Registered benchmarks: name -> function
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Decorator registering benchmark function"""
+    BENCHMARKS[func.__name__.replace('bench_', '')] = func
+    return func
+
+
+def report(name, number, seconds):
+    """Print benchmark result"""
+    print '%-40s %10d ops %10.3f s %12.0f ops/s' % (name, number, seconds, number / seconds)
+
+
+def best_of(func, number):
+    """Run func number times REPEAT times and return the best time"""
+    return min(timeit.repeat(func, repeat=REPEAT, number=number))
+
+
+@benchmark
+def bench_instantiation():
+    """Model instantiation throughput
+
+        Simulates iterating over query results where every entity creates
+        new model instance.
+    """
+    from tests import helper_models
+
+    number = 20000
+
+    report('instantiation TestModel()', number, best_of(helper_models.TestModel, number))
+    report('instantiation TestDC1()', number, best_of(helper_models.TestDC1, number))
+
+
+def deep_size(value):
+    """Approximate memory used by value and everything it references"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(k) + deep_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(v) for v in value)
+    return size
+
+
+@benchmark
+def bench_snapshot():
+    """Baseline snapshot cost for wide models
+
+        Compares deep copy of all the values with capturing only tracked
+        properties and their dependencies.
+    """
+    import copy
+    from google.appengine.ext import ndb
+    import gcounter
+
+    attrs = {
+        'co': gcounter.StringProperty(default=None, counter_name='loc:%s'),
+        'reg': gcounter.StringProperty(default=None, counter_name='loc:<co>:%s'),
+        'tags': gcounter.StringProperty(repeated=True, counter_name='tag:%s'),
+    }
+    for idx in range(30):
+        attrs['nt%d' % idx] = ndb.StringProperty(default='value %d' % idx, indexed=False)
+    for idx in range(5):
+        attrs['ntr%d' % idx] = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    wide_model = type('BenchWideModel', (gcounter.Model,), attrs)
+
+    model = wide_model(co='us', reg='ca', tags=['tag%d' % idx for idx in range(20)])
+    for idx in range(5):
+        setattr(model, 'ntr%d' % idx, range(200))
+
+    number = 2000
+
+    report('snapshot deepcopy(to_dict())', number, best_of(lambda: copy.deepcopy(model.to_dict()), number))
+    report('snapshot _snapshot_values()', number, best_of(model._snapshot_values, number))
+
+    print '%-40s %10d bytes' % ('memory deepcopy(to_dict())', deep_size(copy.deepcopy(model.to_dict())))
+    print '%-40s %10d bytes' % ('memory _snapshot_values()', deep_size(model._snapshot_values()))
+
+
+@benchmark
+def bench_counter_names():
+    """Dependent counter name rendering"""
+    from tests import helper_models
+
+    prop = helper_models.TestDC1.ci
+    deps = {'co': 'us', 'reg': 'ca'}
+
+    number = 20000
+
+    report('counter name loc:<co>:<reg>:%s', number, best_of(lambda: prop._get_counter('Costa Mesa', deps), number))
+
+
+# Words used to build slugify corpus
+SLUG_WORDS = [
+    u'Bob', u'Dylan', u'Costa', u'Mesa', u'Newport', u'Beach', u'rock', u'jazz',
+    u'Cr\xe8me', u'Br\xfbl\xe9e', u'M\xfcnchen', u'K\xf8benhavn', u'\u0141\xf3d\u017a',
+    u'Krak\xf3w', u'S\xe3o', u'Paulo', u'Z\xfcrich', u'\u6771\u4eac', u'Beyonc\xe9', u'Mot\xf6rhead']
+
+
+@benchmark
+def bench_slugify():
+    """Slugify on mixed ASCII and unicode corpus
+
+        Values are picked with skewed distribution the way artist and city
+        names usually are.
+    """
+    import random
+    import gcounter
+
+    rnd = random.Random(1)
+    unique = [u' '.join(rnd.sample(SLUG_WORDS, rnd.randint(1, 3))) for _ in range(2000)]
+    corpus = [unique[int(rnd.paretovariate(1.2)) % len(unique)] for _ in range(20000)]
+
+    def run(func):
+        for value in corpus:
+            func(value)
+
+    gcounter.TextTools.slug_cache.clear()
+
+    not_memoized = best_of(lambda: run(gcounter.TextTools._slugify), 1)
+    memoized = best_of(lambda: run(gcounter.TextTools.slugify), 1)
+
+    report('slugify not memoized', len(corpus), not_memoized)
+    report('slugify memoized', len(corpus), memoized)
+    print '%-40s %10.3f' % ('slugify cache hit rate', gcounter.TextTools.slug_cache_info()['hit_rate'])
+    print '%-40s %10.1fx' % ('slugify memoization speedup', not_memoized / memoized)
+
+
+def write_ops(entity):
+    """Datastore write operations needed to create the entity
+
+        Two for the entity and two for every indexed property value.
+    """
+    return 2 + 2 * len(entity._to_pb().property_list())
+
+
+@benchmark
+def bench_shard_writes():
+    """Datastore write operations of the first change of a counter
+
+        The first change creates shard config and one shard. Next changes
+        update the shard only.
+    """
+    import gcounter
+
+    name = 'song_title:' + 'a-very-long-song-title-' * 4
+
+    for scheme_name in ('name', 'hash', 'v2'):
+        scheme = gcounter.SHARD_SCHEMES[scheme_name]
+        config = scheme.config_model(key=scheme.config_key(name), name=name)
+        shard_key = scheme.shard_keys(name, [0])[0]
+        shard = scheme.new_shard(shard_key, name)
+
+        print '%-40s %10d ops %10d bytes key' % ('shard writes %s config' % scheme_name, write_ops(config), len(config.key.urlsafe()))
+        print '%-40s %10d ops %10d bytes key' % ('shard writes %s shard' % scheme_name, write_ops(shard), len(shard_key.urlsafe()))
+
+
+@benchmark
+def bench_hyperloglog():
+    """HyperLogLog sketch storage and error compared with exact set of values
+
+        Stored size is the size of all the shard entities of one counter
+        when every shard got enough values to be written.
+    """
+    import gcounter
+
+    values = ['visitor%d' % idx for idx in range(100000)]
+
+    print '%-40s %10d bytes' % ('memory set()', deep_size(set(values)))
+
+    for precision in (10, 12, 14):
+        sketch = gcounter.HyperLogLogSketch(precision)
+        for value in values:
+            sketch.add(value)
+
+        shard = gcounter.HyperLogLogShard(id='visitors:0', precision=precision, registers=str(sketch.registers))
+        stored = gcounter.HLL_NUM_SHARDS * len(shard._to_pb().Encode())
+
+        error = abs(sketch.estimate() - len(values)) / float(len(values))
+        print '%-40s %10d bytes %9.4f err %9.4f std' % (
+            'memory sketch p=%d' % precision, len(sketch.registers), error, sketch.error())
+        print '%-40s %10d bytes %4d shards' % ('stored sketch p=%d' % precision, stored, gcounter.HLL_NUM_SHARDS)
+
+    sketch = gcounter.HyperLogLogSketch()
+    report('hyperloglog add()', len(values), best_of(lambda: [sketch.add(value) for value in values], 1))
+
+
+def main(sdk_path, name=None):
+
+    sys.path.insert(0, sdk_path)
+
+    # Find RF GAE project root path
+    gaeapp_path = os.path.dirname(os.path.realpath(__file__)) + '/..'
+    gaeapp_path = os.path.realpath(gaeapp_path)
+
+    sys.path.insert(0, gaeapp_path)
+
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+    from google.appengine.ext import testbed
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.setup_env(app_id='test-app')
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+
+    try:
+        if name is None:
+            for bench_name in sorted(BENCHMARKS.keys()):
+                BENCHMARKS[bench_name]()
+        elif name in BENCHMARKS:
+            BENCHMARKS[name]()
+        else:
+            print "Benchmark '%s' not found." % name
+    finally:
+        tb.deactivate()
+
+
+if __name__ == '__main__':
+    args = sys.argv
+    arguments_length = len(args)
+
+    if arguments_length > 3 or arguments_length < 2:
+        print USAGE
+        sys.exit(1)
+
+    main(args[1], args[2] if arguments_length == 3 else None)
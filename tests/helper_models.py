@@ -127,6 +127,27 @@ class TestIC4(gcounter.Model):
     ic4 = gcounter.IntegerProperty(default=0, counter_name='ic4n')
 
 
+class TestSI1(gcounter.Model):
+    """Test model gcounter.SumProperty"""
+
+    # SumProperty with simple counter and default value set to None
+    si1 = gcounter.SumProperty(default=None, counter_name='si1n')
+
+
+class TestSI2(gcounter.Model):
+    """Test model gcounter.SumProperty"""
+
+    # SumProperty with simple counter and default value set to 10
+    si2 = gcounter.SumProperty(default=10, counter_name='si2n')
+
+
+class TestHI1(gcounter.Model):
+    """Test model gcounter.HistogramProperty"""
+
+    # HistogramProperty with buckets: < 18, 18 - 24, 25 - 49, 50 and more
+    hi1 = gcounter.HistogramProperty(default=None, counter_name='hi1n:%s', boundaries=[18, 25, 50])
+
+
 class TestDC1(gcounter.Model):
     """Test model for dependent counters"""
 
@@ -163,3 +184,12 @@ class TestCP3(gcounter.Model):
     # Global counter will behave as gcounter.BooleanProperty
     cp3 = gcounter.ComputedProperty(lambda self: not self.my_value, counter_name='cp3n', behaviour='BooleanProperty')
     my_value = ndb.BooleanProperty(default=False)
+
+
+class TestCP4(gcounter.Model):
+    """Test model for computed sum counters"""
+
+    # The value of the cp4 is the length of value of name.
+    # Global counter will behave as gcounter.SumProperty
+    cp4 = gcounter.ComputedProperty(lambda self: len(self.name) if self.name else 0, counter_name='cp4n', behaviour='SumProperty')
+    name = ndb.StringProperty(default=None)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for aggregation of stored counter actions
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+import datetime
+
+# GAE imports
+from google.appengine.api import datastore_errors
+
+# Global Counter imports
+import gcounter
+import gcounter_tasks
+
+# Global Counter tests imports
+from tests import helper_models
+from tests.base_test import TestCountersMain
+
+
+class LegacyCounterActions(gcounter.ndb.Model):
+    """CounterActions record stored before actions were partitioned"""
+
+    actions = gcounter.ndb.JsonProperty(required=True)
+    processed = gcounter.ndb.BooleanProperty(default=False)
+    created = gcounter.ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def _get_kind(cls):
+        return 'CounterActions'
+
+
+class AggregationTestCase(TestCountersMain):
+    """Base class for aggregation tests"""
+
+    def setUp(self):
+        super(AggregationTestCase, self).setUp()
+        self.init_taskqueue_stub()
+        self.set_application(gcounter_tasks.app)
+
+    def tearDown(self):
+        gcounter.AGGREGATION_BATCH_SIZE = 500
+        gcounter.AGGREGATION_TIME_BUDGET = 60
+        gcounter.AGGREGATION_DELETE_PROCESSED = False
+        gcounter.AGGREGATION_PARTITIONS = 1
+        self.clear_application()
+        super(AggregationTestCase, self).tearDown()
+
+    def _storePlaces(self, store=None):
+        """Put places and store their counter actions
+
+            Returns: expected counter values
+        """
+        store = store or (lambda actions: gcounter.CounterActions(actions=actions).put())
+        expected = {}
+
+        for co, reg, ci in [('us', 'ca', 'Costa Mesa'), ('us', 'ca', 'Irvine'), ('pl', None, None), ('us', 'nv', None)]:
+            model = helper_models.TestDC1(co=co, reg=reg, ci=ci)
+            model.put()
+
+            actions = model.get_counter_actions()
+            store(actions)
+
+            for name, delta in actions.items():
+                self.inc_counter(expected, name, delta)
+
+        return expected
+
+
+class TestAggregation(AggregationTestCase):
+
+    def testAggregate(self):
+
+        expected = self._storePlaces()
+
+        self.run_aggr_counters()
+
+        self.compare_counters(expected, self.get_db_counters())
+        self.assertEqual(0, gcounter.CounterActions.query(gcounter.CounterActions.processed == False).count())
+        self.assertEqual(4, gcounter.CounterActions.query().count())
+
+    def testAggregateOnlyOnce(self):
+
+        expected = self._storePlaces()
+
+        self.run_aggr_counters()
+        self.run_aggr_counters()
+
+        self.compare_counters(expected, self.get_db_counters())
+
+    def testAggregateDelete(self):
+
+        gcounter.AGGREGATION_DELETE_PROCESSED = True
+        expected = self._storePlaces()
+
+        self.run_aggr_counters()
+
+        self.compare_counters(expected, self.get_db_counters())
+        self.assertEqual(0, gcounter.CounterActions.query().count())
+
+    def testAggregateReenqueue(self):
+
+        gcounter.AGGREGATION_BATCH_SIZE = 1
+        gcounter.AGGREGATION_TIME_BUDGET = 0
+        expected = self._storePlaces()
+
+        self.run_aggr_counters()
+
+        self.compare_counters(expected, self.get_db_counters())
+
+    def testAggregateBatch(self):
+
+        self._storePlaces()
+
+        stats, cursor = gcounter.Counter.aggregate_stored_actions(batch_size=3, time_budget=0)
+        self.assertEqual(3, stats['records'])
+        self.assertTrue(cursor is not None)
+
+        stats, cursor = gcounter.Counter.aggregate_stored_actions(cursor=cursor, batch_size=3, time_budget=0)
+        self.assertEqual(1, stats['records'])
+        self.assertEqual(None, cursor)
+
+    def testApplyFailureKeepsPending(self):
+
+        expected = self._storePlaces()
+
+        def fail(actions, written=None):
+            raise datastore_errors.TransactionFailedError('too much contention')
+
+        def fail_put(entities):
+            raise datastore_errors.Timeout('datastore timeout')
+
+        apply_actions, put_multi = gcounter.Counter._apply_actions_async, gcounter.ndb.put_multi
+        gcounter.Counter._apply_actions_async = staticmethod(fail)
+        gcounter.ndb.put_multi = fail_put
+        try:
+            self.assertRaises(datastore_errors.Timeout, gcounter.Counter.aggregate_stored_actions)
+        finally:
+            gcounter.Counter._apply_actions_async = apply_actions
+            gcounter.ndb.put_multi = put_multi
+
+        records = gcounter.CounterActions.query().fetch()
+        self.assertEqual(4, len(records))
+        self.assertTrue(all(not record.processed and record.lease is None for record in records))
+
+        self.run_aggr_counters()
+        self.compare_counters(expected, self.get_db_counters())
+
+    def testPartialApplyFailure(self):
+
+        expected = self._storePlaces()
+
+        change_shard = gcounter.Counter._change_shard_async
+
+        def fail_one(name, delta, num_shards, attempts=None):
+            if name != 'loc:us':
+                return change_shard(name, delta, num_shards, attempts)
+            if attempts is not None:
+                attempts[name] = (1, True)
+            future = gcounter.ndb.Future()
+            future.set_exception(datastore_errors.TransactionFailedError('too much contention'))
+            return future
+
+        gcounter.Counter._change_shard_async = staticmethod(fail_one)
+        try:
+            stats, cursor = gcounter.Counter.aggregate_stored_actions()
+        finally:
+            gcounter.Counter._change_shard_async = change_shard
+
+        self.assertEqual(4, stats['records'])
+        self.assertEqual(0, self.get_db_counters().get('loc:us', 0))
+
+        # Only the failed counter is left for the next aggregation
+        records = gcounter.CounterActions.query(gcounter.CounterActions.processed == False).fetch()
+        self.assertEqual([{'loc:us': expected['loc:us']}], [record.actions for record in records])
+
+        self.run_aggr_counters()
+        self.compare_counters(expected, self.get_db_counters())
+
+    def testExpiredLeaseReclaimed(self):
+
+        key = gcounter.CounterActions(actions={'c1': 2}).put()
+        self.assertTrue(gcounter.Counter._lease_actions_async(key, 'dead-task').get_result() is not None)
+
+        stats, cursor = gcounter.Counter.aggregate_stored_actions()
+        self.assertEqual(0, stats['records'])
+
+        record = key.get()
+        record.leased_until = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        record.put()
+
+        stats, cursor = gcounter.Counter.aggregate_stored_actions()
+        self.assertEqual(1, stats['records'])
+        self.assertEqual(2, gcounter.Counter.get_count('c1'))
+
+
+class TestPartitionedAggregation(AggregationTestCase):
+
+    def setUp(self):
+        super(TestPartitionedAggregation, self).setUp()
+        gcounter.AGGREGATION_PARTITIONS = 3
+
+    def testStorePartitioned(self):
+
+        actions = {'loc:us': 1, 'loc:us:ca': 1, 'loc:us:ca:costa-mesa': 1, 'loc:pl': -1}
+        gcounter.CounterActions.store(actions)
+
+        records = gcounter.CounterActions.query().fetch()
+        self.assertEqual(actions, gcounter.Counter.aggregate_counters(record.actions for record in records))
+
+        for record in records:
+            for name in record.actions:
+                self.assertEqual(record.partition, gcounter.Counter.partition_for(name, 3))
+
+    def testAggregateStored(self):
+
+        expected = self._storePlaces(gcounter.CounterActions.store)
+
+        self.run_aggr_counters()
+
+        self.compare_counters(expected, self.get_db_counters())
+        self.assertEqual(0, gcounter.CounterActions.query(gcounter.CounterActions.processed == False).count())
+
+    def testSplitNotPartitioned(self):
+
+        self._storePlaces()
+
+        stats, cursor = gcounter.Counter.partition_stored_actions()
+
+        self.assertEqual(4, stats['records'])
+        self.assertEqual(None, cursor)
+        self.assertEqual(0, gcounter.CounterActions.query(gcounter.CounterActions.partition == None).count())
+
+    def testSplitLegacy(self):
+
+        # Record stored before CounterActions had the partition property
+        LegacyCounterActions(actions={'loc:us': 2, 'loc:pl': 1}).put()
+        gcounter.CounterActions.store({'loc:us': 1})
+
+        stats, cursor = gcounter.Counter.partition_stored_actions()
+
+        self.assertEqual(1, stats['records'])
+        records = gcounter.CounterActions.query(gcounter.CounterActions.processed == False).fetch()
+        self.assertEqual([], [record for record in records if record.partition is None])
+
+        self.run_aggr_counters()
+
+        self.assertEqual(3, gcounter.Counter.get_count('loc:us'))
+        self.assertEqual(1, gcounter.Counter.get_count('loc:pl'))
+
+    def testFanOut(self):
+
+        self._storePlaces()
+
+        self.get(gcounter.AGGREGATION_URL)
+        self.execute_tasks()
+
+        tasks = self.get_tasks()
+        self.assertEqual(['0', '1', '2'], sorted(task['params']['partition'] for task in tasks))
+
+    def testAggregateNotPartitioned(self):
+
+        expected = self._storePlaces()
+
+        self.run_aggr_counters()
+
+        self.compare_counters(expected, self.get_db_counters())
+        self.assertEqual(0, gcounter.CounterActions.query(gcounter.CounterActions.processed == False).count())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for contention telemetry and automatic shard scaling
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+from google.appengine.api import memcache
+
+# Global Counter imports
+import gcounter
+
+# Global Counter tests imports
+from tests.base_test import TestCountersMain
+
+
+class TestAutoscale(TestCountersMain):
+
+    def record(self, name, writes, retries=0, failures=0):
+        """Simulate contention telemetry of writes"""
+        for idx in range(writes):
+            tries = 1 + (1 if idx < retries else 0)
+            gcounter.Counter._record_contention({name: (tries, idx < failures)})
+
+    def testWritesRecorded(self):
+
+        gcounter.Counter.incr('c1')
+        gcounter.Counter.apply_actions({'c1': 2, 'c2': -1})
+
+        telemetry = gcounter.Counter.get_contention(['c1', 'c2', 'c3'])
+
+        self.assertEqual({'writes': 2, 'retries': 0, 'failures': 0, 'rate': 0.0}, telemetry['c1'])
+        self.assertEqual(1, telemetry['c2']['writes'])
+        self.assertEqual(0, telemetry['c3']['writes'])
+
+    def testNotContendedNotRegistered(self):
+
+        gcounter.Counter.incr('c1')
+        self.assertEqual({}, gcounter.Counter.get_contention())
+
+    def testContendedRegistered(self):
+
+        self.record('c1', 10, retries=2, failures=1)
+        self.record('c2', 10)
+
+        telemetry = gcounter.Counter.get_contention()
+
+        self.assertEqual(['c1'], telemetry.keys())
+        self.assertEqual({'writes': 10, 'retries': 2, 'failures': 1, 'rate': 0.3}, telemetry['c1'])
+
+    def testAutoscale(self):
+
+        self.record('c1', 40, retries=10)
+        self.record('c2', 40, retries=1)
+
+        scaled = gcounter.Counter.autoscale_shards()
+
+        self.assertEqual({'c1': 40}, scaled)
+        self.assertEqual(40, gcounter.GeneralCounterShardConfig.get_by_id('c1').num_shards)
+        self.assertEqual(20, gcounter.GeneralCounterShardConfig.get_by_id('c2').num_shards)
+
+    def testAutoscaleMinWrites(self):
+
+        self.record('c1', 5, retries=5)
+
+        self.assertEqual({}, gcounter.Counter.autoscale_shards())
+
+        self.record('c1', 5, retries=5)
+        self.assertEqual({'c1': 40}, gcounter.Counter.autoscale_shards(min_writes=1))
+
+    def testAutoscaleMaxShards(self):
+
+        self.record('c1', 40, retries=40)
+
+        self.assertEqual({'c1': 30}, gcounter.Counter.autoscale_shards(max_shards=30))
+
+        self.record('c1', 40, retries=40)
+        self.assertEqual({}, gcounter.Counter.autoscale_shards(max_shards=30))
+
+    def testAutoscaleResetsTelemetry(self):
+
+        self.record('c1', 40, retries=10)
+        gcounter.Counter.autoscale_shards()
+
+        self.assertEqual({}, gcounter.Counter.get_contention())
+        self.assertEqual(0, gcounter.Counter.get_contention(['c1'])['c1']['writes'])
+
+        self.record('c1', 40, retries=10)
+        self.assertEqual({'c1': 80}, gcounter.Counter.autoscale_shards())
+
+    def testOldSlotIgnored(self):
+
+        # Telemetry of writes made more than two windows ago
+        slot = gcounter.Counter._contention_slot()
+        key = gcounter.Counter._contention_key('c1', 'writes', slot - 2)
+        memcache.set(gcounter.CONTENTION_KEY_PREFIX + key, 1000)
+
+        self.record('c1', 10, retries=5)
+
+        self.assertEqual({'writes': 10, 'retries': 5, 'failures': 0, 'rate': 0.5},
+                         gcounter.Counter.get_contention(['c1'])['c1'])
+
+    def testCountsAfterAutoscale(self):
+
+        for _ in range(5):
+            gcounter.Counter.incr('c1')
+
+        self.record('c1', 40, retries=10)
+        gcounter.Counter.autoscale_shards()
+
+        for _ in range(5):
+            gcounter.Counter.incr('c1')
+
+        self.assertEqual(10, gcounter.Counter.get_count('c1', force=True))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for consolidation of counter shards
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+from google.appengine.api import memcache
+
+# Global Counter imports
+import gcounter
+import gcounter_tasks
+
+# Global Counter tests imports
+from tests.base_test import TestCountersMain
+
+
+class TestConsolidation(TestCountersMain):
+
+    def setUp(self):
+        super(TestConsolidation, self).setUp()
+        self.init_taskqueue_stub()
+        self.set_application(gcounter_tasks.app)
+
+    def tearDown(self):
+        gcounter.CONSOLIDATION_GRACE_TIME = 2 * gcounter.SHARD_CONFIG_LOCAL_TIME
+        gcounter.CONSOLIDATION_BATCH_SIZE = 100
+        self.clear_application()
+        super(TestConsolidation, self).tearDown()
+
+    def _spreadCounter(self, name, num_shards=20):
+        """Put counter with value 1 in every shard"""
+        gcounter.GeneralCounterShardConfig(id=name, name=name, num_shards=num_shards).put()
+        for index in range(num_shards):
+            gcounter.GeneralCounterShard(id=name + str(index), name=name, count=1).put()
+
+    def _shardIndexes(self, name):
+        return sorted(int(shard.key.id()[len(name):]) for shard in gcounter.GeneralCounterShard.query())
+
+    def testConsolidateLowersNumShards(self):
+
+        self._spreadCounter('cnt')
+
+        self.assertTrue(gcounter.Counter.consolidate_shards('cnt', 2))
+
+        config = gcounter.GeneralCounterShardConfig.get_by_id('cnt')
+        self.assertEqual(2, config.num_shards)
+        self.assertEqual(20, config.max_shards)
+        self.assertEqual(2, gcounter.Counter._get_num_shards_async(['cnt']).get_result()['cnt'])
+
+    def testConsolidateNeverIncreases(self):
+
+        self._spreadCounter('cnt', 2)
+
+        self.assertFalse(gcounter.Counter.consolidate_shards('cnt', 5))
+        self.assertFalse(gcounter.Counter.consolidate_shards('none', 5))
+        self.assertRaises(ValueError, gcounter.Counter.consolidate_shards, 'cnt', 0)
+
+    def testReadsAllShardsBeforeFold(self):
+
+        self._spreadCounter('cnt')
+        gcounter.Counter.consolidate_shards('cnt', 2)
+
+        self.assertEqual(20, gcounter.Counter.get_count('cnt', force=True))
+
+        memcache.flush_all()
+        gcounter.Counter.flush_local_cache()
+        self.assertEqual(20, gcounter.Counter.get_count('cnt', force=True))
+
+    def testWritesToUsedShards(self):
+
+        self._spreadCounter('cnt')
+        gcounter.Counter.consolidate_shards('cnt', 2)
+
+        for _ in range(10):
+            gcounter.Counter.incr('cnt')
+
+        self.assertEqual(range(20), self._shardIndexes('cnt'))
+        self.assertEqual(12, sum(gcounter.GeneralCounterShard.get_by_id('cnt' + str(index)).count for index in range(2)))
+        self.assertEqual(30, gcounter.Counter.get_count('cnt', force=True))
+
+    def testFoldWaitsForGraceTime(self):
+
+        self._spreadCounter('cnt')
+        gcounter.Counter.consolidate_shards('cnt', 2)
+
+        self.assertFalse(gcounter.Counter.fold_shards('cnt'))
+        self.assertEqual(range(20), self._shardIndexes('cnt'))
+
+    def testFold(self):
+
+        self._spreadCounter('cnt')
+        gcounter.Counter.consolidate_shards('cnt', 3)
+
+        self.assertTrue(gcounter.Counter.fold_shards('cnt', grace_time=0))
+
+        self.assertEqual([0, 1, 2], self._shardIndexes('cnt'))
+        self.assertEqual({'cnt': 20}, self.get_db_counters())
+        self.assertEqual(7, gcounter.GeneralCounterShard.get_by_id('cnt0').count)
+
+        config = gcounter.GeneralCounterShardConfig.get_by_id('cnt')
+        self.assertEqual(None, config.max_shards)
+        self.assertEqual(3, memcache.get(gcounter.SHARD_CONFIG_KEY_PREFIX + 'cnt'))
+        self.assertEqual(20, gcounter.Counter.get_count('cnt', force=True))
+
+    def testFoldMissingShards(self):
+
+        gcounter.GeneralCounterShardConfig(id='cnt', name='cnt', num_shards=20).put()
+        gcounter.GeneralCounterShard(id='cnt15', name='cnt', count=4).put()
+
+        gcounter.Counter.consolidate_shards('cnt', 2)
+        gcounter.Counter.fold_shards('cnt', grace_time=0)
+
+        self.assertEqual([1], self._shardIndexes('cnt'))
+        self.assertEqual(4, gcounter.Counter.get_count('cnt', force=True))
+
+    def testFoldManySourceShards(self):
+
+        self._spreadCounter('cnt', 60)
+        gcounter.Counter.consolidate_shards('cnt', 1)
+        gcounter.Counter.fold_shards('cnt', grace_time=0)
+
+        self.assertEqual([0], self._shardIndexes('cnt'))
+        self.assertEqual(60, gcounter.GeneralCounterShard.get_by_id('cnt0').count)
+
+    def testIncreaseDuringConsolidation(self):
+
+        self._spreadCounter('cnt')
+        gcounter.Counter.consolidate_shards('cnt', 2)
+        gcounter.Counter.increase_shards('cnt', 4)
+
+        self.assertEqual(20, gcounter.Counter.get_count('cnt', force=True))
+
+        gcounter.Counter.fold_shards('cnt', grace_time=0)
+
+        self.assertEqual([0, 1, 2, 3], self._shardIndexes('cnt'))
+        self.assertEqual(20, gcounter.Counter.get_count('cnt', force=True))
+
+    def testConsolidateColdShards(self):
+
+        gcounter.CONSOLIDATION_GRACE_TIME = 0
+        self._spreadCounter('cold')
+        self._spreadCounter('hot')
+        self._spreadCounter('small', 2)
+        for _ in range(20):
+            gcounter.Counter._record_contention({'hot': (1, False)})
+
+        stats, cursor = gcounter.Counter.consolidate_cold_shards()
+
+        self.assertEqual(None, cursor)
+        self.assertEqual({'configs': 3, 'consolidated': 1, 'folded': 0}, stats)
+        self.assertEqual(5, gcounter.GeneralCounterShardConfig.get_by_id('cold').num_shards)
+        self.assertEqual(20, gcounter.GeneralCounterShardConfig.get_by_id('hot').num_shards)
+
+        stats, cursor = gcounter.Counter.consolidate_cold_shards()
+        self.assertEqual(1, stats['folded'])
+        self.assertEqual({'cold': 20, 'hot': 20, 'small': 2}, self.get_db_counters())
+
+    def testConsolidationResetsTelemetry(self):
+
+        self._spreadCounter('hot')
+        for _ in range(20):
+            gcounter.Counter._record_contention({'hot': (1, False)})
+
+        stats, cursor = gcounter.Counter.consolidate_cold_shards()
+
+        self.assertEqual(0, stats['consolidated'])
+        self.assertEqual(0, gcounter.Counter.get_contention(['hot'])['hot']['writes'])
+
+    def testConsolidationTask(self):
+
+        for name in ['c', 'cn', 'cnt']:
+            self._spreadCounter(name)
+        gcounter.CONSOLIDATION_BATCH_SIZE = 2
+
+        self.get(gcounter.CONSOLIDATION_URL)
+        self.execute_tasks_until_empty()
+
+        for name in ['c', 'cn', 'cnt']:
+            self.assertEqual(5, gcounter.GeneralCounterShardConfig.get_by_id(name).num_shards)
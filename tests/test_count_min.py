@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for count-min sketch counters
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+# Global Counter imports
+import gcounter
+
+# Global Counter tests imports
+from tests.base_test import TestCountersMain
+
+
+class TestCMS1(gcounter.Model):
+    """Model with count-min sketch counter property"""
+
+    tags = gcounter.CountMinProperty(counter_name='cms1n:%s', width=300, depth=3, repeated=True)
+
+
+def put_and_apply(model):
+    """Put the model and apply its counter actions"""
+    model.put()
+    gcounter.Counter.apply_actions(model.get_counter_actions())
+
+
+class TestCountMinSketch(TestCountersMain):
+
+    def tearDown(self):
+        gcounter.Counter._count_min_families.clear()
+        super(TestCountMinSketch, self).tearDown()
+
+    def testActionName(self):
+
+        name = gcounter.CountMinSketch.action_name('tag:%s', 300, 3, 'python')
+
+        self.assertEqual('cms|300|3|tag:%s|python', name)
+        self.assertEqual(('tag:%s', 300, 3, 'python'), gcounter.CountMinSketch.parse_action_name(name))
+        self.assertEqual(None, gcounter.CountMinSketch.parse_cell_action_name(name))
+
+        name = gcounter.CountMinSketch.cell_action_name('tag:%s', 2, 120)
+        self.assertEqual(('tag:%s', 2, 120), gcounter.CountMinSketch.parse_cell_action_name(name))
+
+    def testCells(self):
+
+        cells = gcounter.CountMinSketch.cells(300, 3, 'python')
+
+        self.assertEqual(3, len(cells))
+        self.assertTrue(all(0 <= column < 300 for column in cells))
+        self.assertEqual(cells, gcounter.CountMinSketch.cells(300, 3, u'python'))
+
+    def testErrorBound(self):
+
+        self.assertEqual(0, gcounter.CountMinSketch.error_bound(300, 0))
+        self.assertEqual(91, gcounter.CountMinSketch.error_bound(300, 10000))
+
+
+class TestCountMinProperty(TestCountersMain):
+
+    def tearDown(self):
+        gcounter.Counter._count_min_families.clear()
+        super(TestCountMinProperty, self).tearDown()
+
+    def testRegistered(self):
+
+        self.assertEqual((300, 3), gcounter.COUNT_MIN_FAMILIES['cms1n:%s'])
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.CountMinProperty, counter_name='cms1n:%s', width=10)
+
+    def testValidation(self):
+
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.CountMinProperty, counter_name='cms')
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.CountMinProperty, counter_name='cms2n:%s', depth=20)
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.CountMinProperty, counter_name='cms2n:%s', time_bucket='day')
+
+    def testActions(self):
+
+        model = TestCMS1(tags=['Python', 'Go'])
+        model.put()
+
+        self.assertEqual({'cms|300|3|cms1n:%s|python': 1, 'cms|300|3|cms1n:%s|go': 1}, model.get_counter_actions())
+
+        model.tags = ['Go']
+        model.put()
+        self.assertEqual({'cms|300|3|cms1n:%s|python': -1}, model.get_counter_actions())
+
+    def testEstimates(self):
+
+        for tags in (['Python', 'Go'], ['Python'], ['Python', 'Rust']):
+            put_and_apply(TestCMS1(tags=tags))
+
+        estimates = gcounter.Counter.get_estimates('cms1n:%s', ['Python', 'Go', 'Haskell'])
+
+        self.assertEqual(5, gcounter.Counter.get_count('cms-total|cms1n:%s'))
+        self.assertEqual((3, 1), estimates['Python'])
+        self.assertEqual((1, 1), estimates['Go'])
+        self.assertEqual(0, estimates['Haskell'][0])
+
+    def testRemoved(self):
+
+        model = TestCMS1(tags=['Python'])
+        put_and_apply(model)
+
+        model.tags = []
+        put_and_apply(model)
+
+        self.assertEqual((0, 0), gcounter.Counter.get_estimate('cms1n:%s', 'Python'))
+
+    def testBoundedStorage(self):
+
+        for idx in range(50):
+            put_and_apply(TestCMS1(tags=['tag%d' % idx, 'other%d' % idx]))
+
+        # 300 cells per row are stored in two blocks
+        self.assertTrue(gcounter.CountMinBlock.query().count() <= 3 * 2 * gcounter.CMS_NUM_SHARDS)
+        self.assertEqual(0, gcounter.GeneralCounterShardConfig.query(
+            gcounter.GeneralCounterShardConfig.name == 'cms1n:tag0').count())
+
+        for idx in range(50):
+            estimate, bound = gcounter.Counter.get_estimate('cms1n:%s', 'tag%d' % idx)
+            self.assertTrue(1 <= estimate <= 1 + bound)
+
+    def testFamilyStored(self):
+
+        gcounter.Counter.apply_actions({gcounter.CountMinSketch.action_name('cms9n:%s', 50, 2, 'python'): 2})
+        gcounter.Counter._count_min_families.clear()
+
+        self.assertEqual((50, 2), (gcounter.CountMinFamily.get_by_id('cms9n:%s').width,
+                                   gcounter.CountMinFamily.get_by_id('cms9n:%s').depth))
+        self.assertEqual((2, 1), gcounter.Counter.get_estimate('cms9n:%s', 'Python'))
+        self.assertEqual((0, 0), gcounter.Counter.get_estimate('cms8n:%s', 'Python'))
+
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.Counter.apply_actions,
+                          {gcounter.CountMinSketch.action_name('cms9n:%s', 60, 2, 'python'): 1})
+
+    def testFailedRowPending(self):
+
+        change = gcounter.Counter._change_count_min_block_async
+
+        def fail_row(key, deltas):
+            if key.id().rsplit('|', 3)[1] == '1':
+                future = ndb.Future()
+                future.set_exception(datastore_errors.TransactionFailedError('too much contention'))
+                return future
+            return change(key, deltas)
+
+        gcounter.Counter._change_count_min_block_async = staticmethod(fail_row)
+        try:
+            put_and_apply(TestCMS1(tags=['Python']))
+        finally:
+            gcounter.Counter._change_count_min_block_async = staticmethod(change)
+
+        records = gcounter.CounterActions.query().fetch()
+        self.assertEqual(1, len(records))
+        self.assertEqual(1, len(records[0].actions))
+        self.assertEqual(1, gcounter.Counter.get_count('cms-total|cms1n:%s'))
+
+        gcounter.Counter.aggregate_stored_actions()
+        self.assertEqual((1, 1), gcounter.Counter.get_estimate('cms1n:%s', 'Python'))
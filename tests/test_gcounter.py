@@ -13,6 +13,7 @@ Code downloaded from: http://github.com/rzajac/gcounter
 # Python imports
 
 # GAE imports
+from google.appengine.api import memcache
 
 # Global Counter imports
 import gcounter
@@ -94,3 +95,117 @@ class TestCounter(TestCountersMain):
         gcounter.Counter.change_counter('test', -10)
         c = gcounter.Counter.get_count('test')
         self.assertEqual(-9, c)
+
+    def testApplyActions(self):
+
+        gcounter.Counter.apply_actions({'loc:us': 1, 'loc:us:ca': 2, 'loc:us:ca:costa-mesa': -1})
+
+        self.assertEqual(1, gcounter.Counter.get_count('loc:us'))
+        self.assertEqual(2, gcounter.Counter.get_count('loc:us:ca'))
+        self.assertEqual(-1, gcounter.Counter.get_count('loc:us:ca:costa-mesa'))
+
+    def testApplyActionsSkipZero(self):
+
+        gcounter.Counter.apply_actions({'c1': 0, 'c2': 1})
+
+        self.assertEqual(None, gcounter.GeneralCounterShardConfig.get_by_id('c1'))
+        self.assertEqual(1, gcounter.Counter.get_count('c2'))
+
+    def testApplyActionsClearsCache(self):
+
+        gcounter.Counter.incr('c1')
+        self.assertEqual(1, gcounter.Counter.get_count('c1'))
+
+        gcounter.Counter.apply_actions({'c1': 5})
+        self.assertEqual(6, gcounter.Counter.get_count('c1'))
+
+    def testApplyActionsExistingConfig(self):
+
+        gcounter.GeneralCounterShardConfig(id='c1', name='c1', num_shards=1).put()
+        gcounter.Counter.apply_actions({'c1': 2, 'c2': 3})
+        gcounter.Counter.apply_actions({'c1': 2})
+
+        self.assertEqual(4, gcounter.GeneralCounterShard.get_by_id('c10').count)
+        self.assertEqual(3, gcounter.Counter.get_count('c2'))
+
+    def _getNumShards(self, name):
+        return gcounter.Counter._get_num_shards_async([name]).get_result()[name]
+
+    def testNumShardsDefault(self):
+
+        self.assertEqual(20, self._getNumShards('c1'))
+        self.assertEqual(20, gcounter.GeneralCounterShardConfig.get_by_id('c1').num_shards)
+
+    def testNumShardsCached(self):
+
+        self.assertEqual(20, self._getNumShards('c1'))
+        gcounter.GeneralCounterShardConfig(id='c1', name='c1', num_shards=5).put()
+
+        # Instance memory
+        self.assertEqual(20, self._getNumShards('c1'))
+
+        # Memcache
+        gcounter.Counter.flush_local_cache()
+        self.assertEqual(20, self._getNumShards('c1'))
+
+        # Datastore
+        gcounter.Counter.flush_local_cache()
+        memcache.flush_all()
+        self.assertEqual(5, self._getNumShards('c1'))
+
+    def testNumShardsIncrease(self):
+
+        self.assertEqual(20, self._getNumShards('c1'))
+        gcounter.Counter.increase_shards('c1', 30)
+        self.assertEqual(30, self._getNumShards('c1'))
+
+        gcounter.Counter.flush_local_cache()
+        self.assertEqual(30, self._getNumShards('c1'))
+
+    def testNumShardsNeverDecrease(self):
+
+        gcounter.Counter.increase_shards('c1', 30)
+        gcounter.Counter.increase_shards('c1', 10)
+        self.assertEqual(30, self._getNumShards('c1'))
+
+    def testGetCounts(self):
+
+        gcounter.Counter.apply_actions({'c1': 1, 'c2': 2})
+        counts = gcounter.Counter.get_counts(['c1', 'c2', 'c3'])
+
+        self.assertEqual({'c1': 1, 'c2': 2, 'c3': 0}, counts)
+
+    def testGetCountsNoConfigCreated(self):
+
+        self.assertEqual({'c1': 0}, gcounter.Counter.get_counts(['c1']))
+        self.assertEqual(None, gcounter.GeneralCounterShardConfig.get_by_id('c1'))
+
+    def testGetCountsCached(self):
+
+        gcounter.Counter.incr('c1')
+        self.assertEqual({'c1': 1}, gcounter.Counter.get_counts(['c1']))
+
+        shard = gcounter.GeneralCounterShard.query().get()
+        shard.count = 10
+        shard.put()
+
+        self.assertEqual({'c1': 1}, gcounter.Counter.get_counts(['c1']))
+        self.assertEqual({'c1': 10}, gcounter.Counter.get_counts(['c1'], force=True))
+
+    def testGetCountsShardIdCollision(self):
+
+        gcounter.GeneralCounterShardConfig(id='c', name='c', num_shards=11).put()
+        gcounter.GeneralCounterShard(id='c10', name='c1', count=5).put()
+        gcounter.GeneralCounterShard(id='c0', name='c', count=1).put()
+
+        self.assertEqual({'c': 1, 'c1': 5}, gcounter.Counter.get_counts(['c', 'c1']))
+
+    def testGetCountsSharedShardKey(self):
+
+        # Shard 'c10' is read both as shard 10 of 'c' and shard 0 of 'c1'
+        gcounter.GeneralCounterShardConfig(id='c', name='c', num_shards=11).put()
+        gcounter.GeneralCounterShardConfig(id='c1', name='c1', num_shards=1).put()
+        gcounter.GeneralCounterShard(id='c10', name='c1', count=5).put()
+        gcounter.GeneralCounterShard(id='c0', name='c', count=1).put()
+
+        self.assertEqual({'c': 1, 'c1': 5}, gcounter.Counter.get_counts(['c', 'c1'], force=True))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for HyperLogLog distinct counters
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+from google.appengine.api import memcache
+
+# Global Counter imports
+import gcounter
+
+# Global Counter tests imports
+from tests.base_test import TestCountersMain
+
+
+class TestHLL1(gcounter.Model):
+    """Model with distinct counter properties"""
+
+    visitor = gcounter.HyperLogLogProperty(counter_name='visitors', precision=10)
+    tags = gcounter.HyperLogLogProperty(counter_name='tags', repeated=True)
+
+
+def put_and_apply(model):
+    """Put the model and apply its counter actions"""
+    model.put()
+    gcounter.Counter.apply_actions(model.get_counter_actions())
+
+
+class TestHyperLogLogSketch(TestCountersMain):
+
+    def testEmpty(self):
+
+        sketch = gcounter.HyperLogLogSketch(10)
+        self.assertEqual(1024, len(sketch.registers))
+        self.assertEqual(0, sketch.estimate())
+
+    def testDuplicates(self):
+
+        sketch = gcounter.HyperLogLogSketch(10)
+        self.assertTrue(sketch.add('a'))
+        self.assertFalse(sketch.add('a'))
+        self.assertEqual(1, sketch.estimate())
+
+    def testEstimate(self):
+
+        sketch = gcounter.HyperLogLogSketch(12)
+        for idx in range(10000):
+            sketch.add('value%d' % idx)
+
+        self.assertTrue(abs(sketch.estimate() - 10000) < 10000 * 3 * sketch.error())
+
+    def testMerge(self):
+
+        sketch1 = gcounter.HyperLogLogSketch(10)
+        sketch2 = gcounter.HyperLogLogSketch(10)
+        for idx in range(500):
+            sketch1.add('value%d' % idx)
+            sketch2.add('value%d' % (idx + 250))
+
+        sketch1.merge(sketch2)
+        self.assertTrue(abs(sketch1.estimate() - 750) < 750 * 3 * sketch1.error())
+
+        self.assertRaises(ValueError, sketch1.merge, gcounter.HyperLogLogSketch(11))
+
+    def testActionName(self):
+
+        name = gcounter.HyperLogLogSketch.action_name('visitors', 10, 'bob')
+        counter_name, precision, hashed = gcounter.HyperLogLogSketch.parse_action_name(name)
+
+        self.assertEqual('visitors', counter_name)
+        self.assertEqual(10, precision)
+        self.assertEqual(gcounter.HyperLogLogSketch.hash('bob'), hashed)
+
+
+class TestHyperLogLogProperty(TestCountersMain):
+
+    def testComplexCounterRejected(self):
+
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.HyperLogLogProperty, counter_name='v:%s')
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.HyperLogLogProperty, counter_name='v', precision=20)
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.HyperLogLogProperty, counter_name='v', time_bucket='day')
+
+    def testActions(self):
+
+        model = TestHLL1(visitor='bob')
+        model.put()
+
+        self.assertEqual({gcounter.HyperLogLogSketch.action_name('visitors', 10, 'bob'): 1}, model.get_counter_actions())
+
+        model.visitor = 'alice'
+        model.put()
+        self.assertEqual({gcounter.HyperLogLogSketch.action_name('visitors', 10, 'alice'): 1}, model.get_counter_actions())
+
+        model.visitor = None
+        model.put()
+        self.assertEqual({}, model.get_counter_actions())
+
+    def testRepeatedActions(self):
+
+        model = TestHLL1(tags=['a', 'b'])
+        model.put()
+        self.assertEqual(2, len(model.get_counter_actions()))
+
+        model.tags = ['b', 'c']
+        model.put()
+        self.assertEqual({gcounter.HyperLogLogSketch.action_name('tags', gcounter.HLL_PRECISION, 'c'): 1},
+                         model.get_counter_actions())
+
+    def testDistinctCount(self):
+
+        for idx in range(30):
+            put_and_apply(TestHLL1(visitor='visitor%d' % (idx % 10)))
+
+        self.assertEqual(10, gcounter.Counter.get_distinct_count('visitors'))
+        self.assertEqual({'visitors': 10, 'tags': 0}, gcounter.Counter.get_distinct_counts(['visitors', 'tags']))
+
+    def testCacheCleared(self):
+
+        put_and_apply(TestHLL1(visitor='bob'))
+        self.assertEqual(1, gcounter.Counter.get_distinct_count('visitors'))
+
+        put_and_apply(TestHLL1(visitor='alice'))
+        self.assertEqual(2, gcounter.Counter.get_distinct_count('visitors'))
+
+    def testSketchMergedFromShards(self):
+
+        for idx in range(100):
+            put_and_apply(TestHLL1(visitor='visitor%d' % idx))
+
+        shards = gcounter.HyperLogLogShard.query().fetch()
+        self.assertTrue(1 < len(shards) <= gcounter.HLL_NUM_SHARDS)
+
+        sketch = gcounter.Counter.get_sketch('visitors')
+        self.assertEqual(10, sketch.precision)
+        self.assertTrue(abs(sketch.estimate() - 100) < 100 * 3 * sketch.error())
+
+    def testNotCountedAsCounter(self):
+
+        put_and_apply(TestHLL1(visitor='bob'))
+        self.assertEqual(0, gcounter.GeneralCounterShard.query().count())
+
+    def testChangeCounter(self):
+
+        model = TestHLL1(visitor='bob')
+        model.put()
+
+        for name, delta in model.get_counter_actions().items():
+            gcounter.Counter.change_counter(name, delta)
+
+        self.assertEqual(1, gcounter.Counter.get_distinct_count('visitors'))
+        self.assertEqual(0, gcounter.GeneralCounterShardConfig.query().count())
+
+
+class TestHyperLogLogWriteBehind(TestCountersMain):
+
+    def setUp(self):
+        super(TestHyperLogLogWriteBehind, self).setUp()
+        gcounter.WRITE_BEHIND = True
+
+    def tearDown(self):
+        gcounter.WRITE_BEHIND = False
+        super(TestHyperLogLogWriteBehind, self).tearDown()
+
+    def testNotBuffered(self):
+
+        model = TestHLL1(visitor='bob')
+        model.put()
+
+        for name, delta in model.get_counter_actions().items():
+            gcounter.Counter.change_counter(name, delta)
+        put_and_apply(TestHLL1(visitor='alice'))
+
+        self.assertEqual(2, gcounter.Counter.get_distinct_count('visitors'))
+
+        gcounter.Counter.flush_buffers()
+        self.assertEqual(0, gcounter.GeneralCounterShardConfig.query().count())
+
+    def testBufferedByOlderVersion(self):
+
+        name = gcounter.HyperLogLogSketch.action_name('visitors', 10, 'bob')
+        gcounter.Counter._buffer_index.add(name)
+        memcache.set(gcounter.WRITE_BEHIND_KEY_PREFIX + 'buf:' + name, gcounter.WRITE_BEHIND_BASE + 1)
+
+        gcounter.Counter.flush_buffers()
+
+        self.assertEqual(1, gcounter.Counter.get_distinct_count('visitors'))
+        self.assertEqual(0, gcounter.GeneralCounterShardConfig.query().count())
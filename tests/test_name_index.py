@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for prefix index of counter names
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+
+# Global Counter imports
+import gcounter
+import gcounter_tasks
+
+# Global Counter tests imports
+from tests import helper_models
+from tests.base_test import TestCountersMain
+
+
+class TestNameIndex(TestCountersMain):
+
+    def setUp(self):
+        super(TestNameIndex, self).setUp()
+        self.init_taskqueue_stub()
+        self.set_application(gcounter_tasks.app)
+
+    def tearDown(self):
+        gcounter.NAME_INDEX_BATCH_SIZE = 500
+        self.clear_application()
+        super(TestNameIndex, self).tearDown()
+
+    def _putPlaces(self):
+        for co, reg, ci in [('us', 'ca', 'Costa Mesa'), ('us', 'ca', 'Irvine'), ('pl', None, None), ('us', 'nv', 'Reno')]:
+            model = helper_models.TestDC1(co=co, reg=reg, ci=ci)
+            model.put()
+            gcounter.Counter.apply_actions(model.get_counter_actions())
+
+    def testBuild(self):
+
+        entry = gcounter.CounterNameIndex.build('loc:us:ca')
+
+        self.assertEqual('loc:us', entry.parent_name)
+        self.assertEqual(['loc', 'loc:us'], entry.ancestors)
+        self.assertEqual(None, gcounter.CounterNameIndex.build('total'))
+
+    def testGetChildren(self):
+
+        self._putPlaces()
+
+        self.assertEqual({'loc:us': 3, 'loc:pl': 1}, gcounter.Counter.get_children('loc'))
+        self.assertEqual({'loc:us:ca': 2, 'loc:us:nv': 1}, gcounter.Counter.get_children('loc:us'))
+        self.assertEqual({}, gcounter.Counter.get_children('loc:pl'))
+
+    def testGetSubtree(self):
+
+        self._putPlaces()
+
+        expected = {'loc:us:ca': 2, 'loc:us:nv': 1, 'loc:us:ca:costa-mesa': 1, 'loc:us:ca:irvine': 1, 'loc:us:nv:reno': 1}
+        self.assertEqual(expected, gcounter.Counter.get_subtree('loc:us'))
+
+    def testGetChildrenLimit(self):
+
+        self._putPlaces()
+
+        self.assertEqual(1, len(gcounter.Counter.get_children('loc:us', limit=1)))
+
+    def testSimpleCounterNotIndexed(self):
+
+        gcounter.Counter.incr('total')
+
+        self.assertEqual(0, gcounter.CounterNameIndex.query().count())
+
+    def testIndexCounterNames(self):
+
+        for name in ['total', 'loc:us', 'loc:us:ca']:
+            gcounter.GeneralCounterShardConfig(id=name, name=name).put()
+
+        stats, cursor = gcounter.Counter.index_counter_names()
+
+        self.assertEqual({'configs': 3, 'indexed': 2}, stats)
+        self.assertEqual(None, cursor)
+        self.assertEqual(['loc:us:ca'], gcounter.Counter.get_children('loc:us').keys())
+
+    def testIndexCounterNamesTask(self):
+
+        for name in ['loc:pl', 'loc:us', 'loc:us:ca']:
+            gcounter.GeneralCounterShardConfig(id=name, name=name).put()
+        gcounter.NAME_INDEX_BATCH_SIZE = 1
+
+        self.get(gcounter.NAME_INDEX_URL)
+        self.execute_tasks_until_empty()
+
+        self.assertEqual(3, gcounter.CounterNameIndex.query().count())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for putting many models at once
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+from google.appengine.ext import ndb
+
+# Global Counter imports
+import gcounter
+
+# Global Counter tests imports
+from tests import helper_models
+from tests.base_test import TestCountersMain
+
+
+class TestPutMulti(TestCountersMain):
+
+    def _createPlaces(self):
+
+        return [
+            helper_models.TestDC1(co='us', reg='ca', ci='Costa Mesa'),
+            helper_models.TestDC1(co='us', reg='ca', ci='Newport Beach'),
+            helper_models.TestDC1(co='pl')]
+
+    def testNew(self):
+
+        models = self._createPlaces()
+        ca = gcounter.put_multi_with_actions(models)
+
+        self.assertEqual({
+            'loc:us': 2,
+            'loc:pl': 1,
+            'loc:us:ca': 2,
+            'loc:us:ca:costa-mesa': 1,
+            'loc:us:ca:newport-beach': 1}, ca)
+
+        for model in models:
+            self.assertFalse(model.is_new)
+            self.assertTrue(model.key is not None)
+            self.assertEqual({}, model.get_counter_actions())
+
+    def testChanged(self):
+
+        models = self._createPlaces()
+        gcounter.put_multi_with_actions(models)
+
+        models[0].ci = 'Newport Beach'
+        models[2].co = 'us'
+
+        ca = gcounter.put_multi_with_actions(models)
+
+        self.assertEqual({
+            'loc:pl': -1,
+            'loc:us': 1,
+            'loc:us:ca:costa-mesa': -1,
+            'loc:us:ca:newport-beach': 1}, ca)
+
+    def testZeroRemoved(self):
+
+        models = self._createPlaces()
+        gcounter.put_multi_with_actions(models)
+
+        models[0].ci = 'Newport Beach'
+        models[1].ci = 'Costa Mesa'
+
+        self.assertEqual({}, gcounter.put_multi_with_actions(models))
+
+    def testSinglePutNotAffected(self):
+
+        models = self._createPlaces()
+        gcounter.put_multi_with_actions(models)
+
+        models[2].co = 'us'
+        models[2].put()
+
+        self.assertEqual({'loc:pl': -1, 'loc:us': 1}, models[2].get_counter_actions())
+
+    def testPutMultiAsync(self):
+
+        models = self._createPlaces()
+        future = gcounter.put_multi_with_actions_async(models[:2])
+
+        self.assertEqual({
+            'loc:us': 2,
+            'loc:us:ca': 2,
+            'loc:us:ca:costa-mesa': 1,
+            'loc:us:ca:newport-beach': 1}, future.get_result())
+
+
+class TestPutAsync(TestCountersMain):
+
+    def testPutActionsAsync(self):
+
+        model = helper_models.TestDC1(co='us', reg='ca')
+        future = model.put_actions_async()
+
+        self.assertEqual({'loc:us': 1, 'loc:us:ca': 1}, future.get_result())
+        self.assertFalse(model.is_new)
+        self.assertEqual({}, model.get_counter_actions())
+
+    def testPutActionsInTasklet(self):
+
+        models = [helper_models.TestBC1(bc1=True), helper_models.TestIC1(ic1=5), helper_models.TestSC2()]
+
+        @ndb.tasklet
+        def put_all():
+            actions = yield [model.put_actions_async() for model in models]
+            raise ndb.Return(gcounter.Counter.aggregate_counters(actions))
+
+        self.assertEqual({'bc1n': 1, 'ic1n': 1}, put_all().get_result())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for rolling window counters
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+
+# Global Counter imports
+import gcounter
+
+# Global Counter tests imports
+from tests.base_test import TestCountersMain
+
+
+# Start of the 60 second slot
+T0 = 1382100000
+
+
+class TestRollingCounter(TestCountersMain):
+
+    def setUp(self):
+        super(TestRollingCounter, self).setUp()
+        self.counter = gcounter.RollingCounter('active', slot_time=60, slots=15, num_shards=3)
+
+    def testWindowCount(self):
+
+        for offset in (0, 10, 70, 130):
+            self.counter.incr(now=T0 + offset)
+
+        self.assertEqual(4, self.counter.get_window_count(now=T0 + 130))
+        self.assertEqual(1, self.counter.get_window_count(60, now=T0 + 130))
+        self.assertEqual(2, self.counter.get_window_count(120, now=T0 + 130, force=True))
+
+    def testDecr(self):
+
+        self.counter.incr(now=T0)
+        self.counter.incr(now=T0)
+        self.counter.decr(now=T0)
+
+        self.assertEqual(1, self.counter.get_window_count(now=T0))
+
+    def testExpired(self):
+
+        self.counter.incr(now=T0)
+
+        self.assertEqual(1, self.counter.get_window_count(now=T0 + 14 * 60))
+        self.assertEqual(0, self.counter.get_window_count(now=T0 + 15 * 60))
+
+    def testSlotZeroedOnWrap(self):
+
+        for _ in range(10):
+            self.counter.incr(now=T0)
+
+        # Same slot in the next turn of the ring
+        for _ in range(10):
+            self.counter.incr(now=T0 + 15 * 60)
+
+        self.assertEqual(10, self.counter.get_window_count(now=T0 + 15 * 60))
+        self.assertTrue(gcounter.RollingCounterShard.query().count() <= 3)
+
+    def testBoundedStorage(self):
+
+        for minute in range(100):
+            self.counter.incr(now=T0 + minute * 60)
+
+        self.assertTrue(gcounter.RollingCounterShard.query().count() <= 15 * 3)
+        self.assertEqual(15, self.counter.get_window_count(now=T0 + 99 * 60))
+
+    def testWindowLongerThanRing(self):
+
+        for minute in range(20):
+            self.counter.incr(now=T0 + minute * 60)
+
+        self.assertEqual(15, self.counter.get_window_count(3600, now=T0 + 19 * 60))
+
+    def testRegistry(self):
+
+        self.counter.incr()
+
+        self.assertTrue(gcounter.RollingCounter.get('active') is self.counter)
+        self.assertEqual(1, gcounter.Counter.get_window_count('active', 60))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for per model class tracking schema
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+
+# Global Counter imports
+import gcounter
+
+# Global Counter tests imports
+from tests import helper_models
+from tests.base_test import TestCountersMain
+
+
+class TestDC1Child(helper_models.TestDC1):
+    """Model extending dependent counter model"""
+
+    st = gcounter.StringProperty(default=None, counter_name='st:<co>:%s')
+
+
+class TestSchema(TestCountersMain):
+
+    def testSharedBetweenInstances(self):
+
+        model1 = helper_models.TestDC1()
+        model2 = helper_models.TestDC1(co='us')
+
+        self.assertTrue(model1._get_tracking_schema() is model2._get_tracking_schema())
+        self.assertTrue(model1._prop_def is model2._prop_def)
+
+    def testNotInInstanceDict(self):
+
+        model = helper_models.TestDC1()
+
+        self.assertFalse('_prop_def' in model.__dict__)
+        self.assertFalse('_rev_deps' in model.__dict__)
+        self.assertFalse('_prop_names' in model.__dict__)
+
+    def testPropNames(self):
+
+        model = helper_models.TestDC1()
+        self.assertEqual(frozenset(['co', 'reg', 'ci']), model._prop_names)
+
+    def testReverseDependencies(self):
+
+        model = helper_models.TestDC1()
+
+        self.assertEqual(['ci', 'reg'], sorted(model._rev_deps['co']))
+        self.assertEqual(('ci',), model._rev_deps['reg'])
+        self.assertFalse('ci' in model._rev_deps)
+
+    def testSubclassHasOwnSchema(self):
+
+        parent = helper_models.TestDC1()
+        child = TestDC1Child()
+
+        self.assertFalse(parent._get_tracking_schema() is child._get_tracking_schema())
+        self.assertFalse('st' in parent._prop_names)
+        self.assertTrue('st' in child._prop_names)
+        self.assertEqual(['ci', 'reg', 'st'], sorted(child._rev_deps['co']))
+
+    def testSnapshotTrackedOnly(self):
+
+        model = helper_models.TestModel(nt1=5)
+        self.assertEqual(['ic1', 'sc1', 'scr1'], sorted(model._snapshot_values().keys()))
+
+    def testSnapshotRepeatedFrozen(self):
+
+        model = helper_models.TestCCR1()
+        model.ccr1 = ['mp3', 'aac']
+        model.put()
+
+        model.ccr1.remove('aac')
+        self.assertEqual(('mp3', 'aac'), model._init_values['ccr1'])
+
+        model.put()
+        self.assertEqual({'ccr1n:aac': -1}, model.get_counter_actions())
+
+    def testLazyBaselineAfterPut(self):
+
+        model = helper_models.TestDC1(co='us')
+        model.put()
+
+        self.assertTrue(model._baseline_pending)
+        self.assertEqual(None, model._init_values)
+
+        model.reg = 'ca'
+
+        self.assertFalse(model._baseline_pending)
+        self.assertEqual({'co': 'us', 'reg': None, 'ci': None}, model._init_values)
+
+    def testLazyBaselineReadOnly(self):
+
+        model = helper_models.TestDC1(co='us', reg='ca')
+        model.put()
+        self.clearContext()
+
+        model = model.key.get()
+        self.assertEqual('us', model.co)
+        self.assertTrue(model._baseline_pending)
+
+        model.put()
+        self.assertEqual({}, model.get_counter_actions())
+
+    def testLazyBaselineChangeAfterGet(self):
+
+        model = helper_models.TestDC1(co='us', reg='ca')
+        model.put()
+        self.clearContext()
+
+        model = model.key.get()
+        model.co = 'pl'
+        model.put()
+
+        self.assertEqual({'loc:us': -1, 'loc:pl': 1, 'loc:us:ca': -1, 'loc:pl:ca': 1}, model.get_counter_actions())
+
+    def testLazyBaselineRepeatedInPlace(self):
+
+        model = helper_models.TestCCR1()
+        model.ccr1 = ['mp3', 'aac']
+        model.put()
+        self.clearContext()
+
+        model = model.key.get()
+        self.assertTrue(model._baseline_pending)
+
+        model.ccr1.append('ogg')
+        model.put()
+
+        self.assertEqual({'ccr1n:ogg': 1}, model.get_counter_actions())
+
+    def testNotLazyForComputed(self):
+
+        model = helper_models.TestCP1()
+        self.assertFalse(model._baseline_pending)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for counter shard storage schemes and migration between them
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+from google.appengine.api import memcache
+
+# Global Counter imports
+import gcounter
+import gcounter_tasks
+
+# Global Counter tests imports
+from tests.base_test import TestCountersMain
+
+
+LONG_NAME = 'song_title:' + 'a-very-long-song-title-' * 10
+
+
+class ShardSchemeTestCase(TestCountersMain):
+    """Base class for shard scheme tests"""
+
+    def setUp(self):
+        super(ShardSchemeTestCase, self).setUp()
+        self.init_taskqueue_stub()
+        self.set_application(gcounter_tasks.app)
+
+    def tearDown(self):
+        gcounter.SHARD_SCHEME = 'name'
+        gcounter.SHARD_SCHEME_PREVIOUS = None
+        gcounter.SHARD_MIGRATION_BATCH_SIZE = 100
+        self.clear_application()
+        super(ShardSchemeTestCase, self).tearDown()
+
+    def switchScheme(self, scheme):
+        """Start migration to the scheme"""
+        gcounter.SHARD_SCHEME_PREVIOUS = gcounter.SHARD_SCHEME
+        gcounter.SHARD_SCHEME = scheme
+        gcounter.Counter.flush_local_cache()
+        memcache.flush_all()
+
+
+class TestHashScheme(ShardSchemeTestCase):
+
+    def setUp(self):
+        super(TestHashScheme, self).setUp()
+        gcounter.SHARD_SCHEME = 'hash'
+
+    def testCounterId(self):
+
+        scheme = gcounter.SHARD_SCHEMES['hash']
+
+        self.assertEqual(16, len(scheme.counter_id(LONG_NAME)))
+        self.assertEqual(scheme.counter_id(u'loc:z\xfcrich'), scheme.counter_id(u'loc:z\xfcrich'.encode('utf-8')))
+        self.assertNotEqual(scheme.counter_id('c1'), scheme.counter_id('c2'))
+
+    def testShardKeys(self):
+
+        gcounter.Counter.incr(LONG_NAME)
+
+        counter_id = gcounter.SHARD_SCHEMES['hash'].counter_id(LONG_NAME)
+        shard = gcounter.GeneralCounterShard.query().get()
+
+        self.assertEqual(counter_id, shard.name)
+        self.assertTrue(shard.key.id().startswith(counter_id + ':'))
+
+        config = gcounter.GeneralCounterShardConfig.get_by_id(counter_id)
+        self.assertEqual(LONG_NAME, config.name)
+
+    def testCounts(self):
+
+        gcounter.Counter.incr(LONG_NAME)
+        gcounter.Counter.apply_actions({LONG_NAME: 2, 'c1': 1})
+
+        self.assertEqual({LONG_NAME: 3, 'c1': 1, 'c2': 0}, gcounter.Counter.get_counts([LONG_NAME, 'c1', 'c2']))
+        self.assertEqual(3, gcounter.Counter.get_count(LONG_NAME, force=True))
+
+    def testNoShardIdCollision(self):
+
+        gcounter.Counter.increase_shards('c', 11)
+        gcounter.Counter.increase_shards('c1', 1)
+        for _ in range(20):
+            gcounter.Counter.incr('c')
+        gcounter.Counter.incr('c1')
+
+        self.assertEqual({'c': 20, 'c1': 1}, gcounter.Counter.get_counts(['c', 'c1'], force=True))
+
+    def testConsolidate(self):
+
+        gcounter.Counter.increase_shards('c1', 30)
+        for _ in range(30):
+            gcounter.Counter.incr('c1')
+
+        gcounter.Counter.consolidate_shards('c1', 2)
+        gcounter.Counter.fold_shards('c1', grace_time=0)
+
+        self.assertEqual(2, gcounter.GeneralCounterShard.query().count())
+        self.assertEqual(30, gcounter.Counter.get_count('c1', force=True))
+
+
+class TestMigration(ShardSchemeTestCase):
+
+    def _putLegacy(self):
+        gcounter.Counter.increase_shards('cnt', 11)
+        gcounter.Counter.increase_shards('c1', 1)
+        for _ in range(20):
+            gcounter.Counter.incr('cnt')
+        gcounter.Counter.incr('c1')
+        gcounter.Counter.incr(LONG_NAME)
+
+    def testDualRead(self):
+
+        self._putLegacy()
+        self.switchScheme('hash')
+
+        self.assertEqual({'cnt': 20, 'c1': 1, LONG_NAME: 1}, gcounter.Counter.get_counts(['cnt', 'c1', LONG_NAME]))
+
+        gcounter.Counter.incr('cnt')
+        gcounter.Counter.incr(LONG_NAME)
+
+        self.assertEqual({'cnt': 21, 'c1': 1, LONG_NAME: 2}, gcounter.Counter.get_counts(['cnt', 'c1', LONG_NAME], force=True))
+
+    def testConfigCopied(self):
+
+        self._putLegacy()
+        self.switchScheme('hash')
+
+        gcounter.Counter.incr('cnt')
+
+        config = gcounter.SHARD_SCHEMES['hash'].config_key('cnt').get()
+        self.assertEqual(11, config.num_shards)
+
+    def testMigrate(self):
+
+        self._putLegacy()
+        self.switchScheme('hash')
+        gcounter.Counter.incr('cnt')
+
+        stats, cursor = gcounter.Counter.migrate_shards()
+
+        self.assertEqual(None, cursor)
+        self.assertEqual(3, stats['counters'])
+
+        scheme = gcounter.SHARD_SCHEMES['hash']
+        for shard in gcounter.GeneralCounterShard.query():
+            self.assertTrue(':' in shard.key.id())
+        for config in gcounter.GeneralCounterShardConfig.query():
+            self.assertTrue(scheme.is_own_config(config))
+
+        gcounter.SHARD_SCHEME_PREVIOUS = None
+        self.assertEqual({'cnt': 21, 'c1': 1, LONG_NAME: 1}, gcounter.Counter.get_counts(['cnt', 'c1', LONG_NAME], force=True))
+
+    def testMigrateIndexesNames(self):
+
+        # Config created before the prefix index existed
+        gcounter.GeneralCounterShardConfig(id='loc:us', name='loc:us', num_shards=3).put()
+        self.switchScheme('hash')
+
+        gcounter.Counter.migrate_shards()
+
+        self.assertEqual('loc', gcounter.CounterNameIndex.get_by_id('loc:us').parent_name)
+        self.assertEqual(3, gcounter.SHARD_SCHEMES['hash'].config_key('loc:us').get().num_shards)
+
+    def testMigrateTwice(self):
+
+        self._putLegacy()
+        self.switchScheme('hash')
+
+        gcounter.Counter.migrate_shards()
+        stats, cursor = gcounter.Counter.migrate_shards()
+
+        self.assertEqual(0, stats['counters'])
+        self.assertEqual({'cnt': 20, 'c1': 1}, gcounter.Counter.get_counts(['cnt', 'c1'], force=True))
+
+    def testMigrateNotStarted(self):
+
+        self.assertRaises(gcounter.NotSupportedError, gcounter.Counter.migrate_shards)
+
+    def testMigrationTask(self):
+
+        self._putLegacy()
+        self.switchScheme('hash')
+        gcounter.SHARD_MIGRATION_BATCH_SIZE = 1
+
+        self.get(gcounter.SHARD_MIGRATION_URL)
+        self.execute_tasks_until_empty()
+
+        gcounter.SHARD_SCHEME_PREVIOUS = None
+        self.assertEqual({'cnt': 20, 'c1': 1, LONG_NAME: 1}, gcounter.Counter.get_counts(['cnt', 'c1', LONG_NAME], force=True))
+
+
+class TestV2Scheme(ShardSchemeTestCase):
+
+    def testNoIndexedProperties(self):
+
+        for model in (gcounter.GeneralCounterShardV2, gcounter.GeneralCounterShardConfigV2):
+            for prop in model._properties.values():
+                self.assertFalse(prop._indexed, '%s.%s is indexed' % (model.__name__, prop._name))
+
+    def testUnnamedShardsMustBeHashed(self):
+
+        self.assertRaises(ValueError, gcounter.ShardScheme,
+                          gcounter.GeneralCounterShardConfigV2, gcounter.GeneralCounterShardV2, False)
+
+    def testCounts(self):
+
+        gcounter.SHARD_SCHEME = 'v2'
+
+        gcounter.Counter.incr(LONG_NAME)
+        gcounter.Counter.apply_actions({LONG_NAME: 2, 'c1': 1})
+
+        self.assertEqual(0, gcounter.GeneralCounterShard.query().count())
+        self.assertEqual(2, gcounter.GeneralCounterShardConfigV2.query().count())
+        self.assertEqual({LONG_NAME: 3, 'c1': 1}, gcounter.Counter.get_counts([LONG_NAME, 'c1'], force=True))
+
+    def testMigrate(self):
+
+        gcounter.Counter.increase_shards('cnt', 11)
+        for _ in range(20):
+            gcounter.Counter.incr('cnt')
+        gcounter.Counter.incr(LONG_NAME)
+
+        self.switchScheme('v2')
+
+        gcounter.Counter.incr('cnt')
+        self.assertEqual({'cnt': 21, LONG_NAME: 1}, gcounter.Counter.get_counts(['cnt', LONG_NAME]))
+
+        stats, cursor = gcounter.Counter.migrate_shards()
+        self.assertEqual(2, stats['counters'])
+
+        self.assertEqual(0, gcounter.GeneralCounterShard.query().count())
+        self.assertEqual(0, gcounter.GeneralCounterShardConfig.query().count())
+        self.assertEqual(11, gcounter.SHARD_SCHEMES['v2'].config_key('cnt').get().num_shards)
+
+        gcounter.SHARD_SCHEME_PREVIOUS = None
+        self.assertEqual({'cnt': 21, LONG_NAME: 1}, gcounter.Counter.get_counts(['cnt', LONG_NAME], force=True))
+
+    def testMigrateRepeated(self):
+
+        gcounter.Counter.increase_shards('cnt', 11)
+        for _ in range(20):
+            gcounter.Counter.incr('cnt')
+
+        self.switchScheme('v2')
+
+        gcounter.Counter.migrate_shards()
+        stats, cursor = gcounter.Counter.migrate_shards()
+
+        self.assertEqual(0, stats['counters'])
+        self.assertEqual(20, gcounter.Counter.get_count('cnt', force=True))
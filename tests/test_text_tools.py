@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for counter name helpers
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+
+# Global Counter imports
+import gcounter
+
+# Global Counter tests imports
+from tests.base_test import TestCountersMain
+
+
+class TestCounterNameTemplate(TestCountersMain):
+
+    def testSimple(self):
+
+        template = gcounter.CounterNameTemplate('sc1n')
+
+        self.assertEqual((), template.fields)
+        self.assertEqual((), template.dependencies)
+        self.assertEqual('sc1n', template.render(()))
+
+    def testComplex(self):
+
+        template = gcounter.CounterNameTemplate('song_author:%s')
+
+        self.assertEqual((None,), template.fields)
+        self.assertEqual((), template.dependencies)
+        self.assertEqual('song_author:bob-dylan', template.render(('bob-dylan',)))
+
+    def testDependent(self):
+
+        template = gcounter.CounterNameTemplate('loc:<co>:<reg>:%s')
+
+        self.assertEqual(('co', 'reg', None), template.fields)
+        self.assertEqual(('co', 'reg'), template.dependencies)
+        self.assertEqual('loc:us:ca:costa-mesa', template.render(('us', 'ca', 'costa-mesa')))
+
+    def testDependentEmpty(self):
+
+        template = gcounter.CounterNameTemplate('loc:<co>:%s')
+        self.assertEqual('loc::ca', template.render(('', 'ca')))
+
+    def testPercentSign(self):
+
+        self.assertEqual('a%b:x', gcounter.CounterNameTemplate('a%%b:%s').render(('x',)))
+        self.assertEqual('a%:us', gcounter.CounterNameTemplate('a%:<co>').render(('us',)))
+
+
+class TestTextTools(TestCountersMain):
+
+    def setUp(self):
+        super(TestTextTools, self).setUp()
+        gcounter.TextTools.slug_cache.clear()
+
+    def testSlugifyAscii(self):
+
+        self.assertEqual(u'costa-mesa', gcounter.TextTools.slugify('Costa Mesa'))
+        self.assertEqual(u'bob-dylan', gcounter.TextTools.slugify(u' Bob  -- Dylan! '))
+
+    def testSlugifyUnicode(self):
+
+        self.assertEqual(u'creme-brulee', gcounter.TextTools.slugify(u'Cr\xe8me Br\xfbl\xe9e'))
+
+    def testSlugifyNotString(self):
+
+        self.assertEqual(u'123', gcounter.TextTools.slugify(123))
+        self.assertEqual(u'true', gcounter.TextTools.slugify(True))
+        self.assertEqual(u'1', gcounter.TextTools.slugify(1))
+
+    def testSlugifyCacheInfo(self):
+
+        gcounter.TextTools.slugify(u'Costa Mesa')
+        gcounter.TextTools.slugify(u'Costa Mesa')
+        gcounter.TextTools.slugify('Costa Mesa')
+        gcounter.TextTools.slugify(u'Newport Beach')
+
+        info = gcounter.TextTools.slug_cache_info()
+
+        self.assertEqual(2, info['hits'])
+        self.assertEqual(2, info['misses'])
+        self.assertEqual(2, info['size'])
+        self.assertEqual(0.5, info['hit_rate'])
+
+
+class TestLRUCache(TestCountersMain):
+
+    def testEvictLeastRecentlyUsed(self):
+
+        cache = gcounter.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+
+class TestBoundedCache(TestCountersMain):
+
+    def testClearedWhenFull(self):
+
+        cache = gcounter.BoundedCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        self.assertEqual(1, cache.get('a'))
+
+        cache.set('c', 3)
+
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual({'hits': 2, 'misses': 1, 'size': 1, 'maxsize': 2, 'hit_rate': 2.0 / 3}, cache.info())
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for time bucketed counters
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+import datetime
+
+# GAE imports
+from google.appengine.api import datastore_errors
+
+# Global Counter imports
+import gcounter
+import gcounter_tasks
+
+# Global Counter tests imports
+from tests.base_test import TestCountersMain
+
+
+class TestTB1(gcounter.Model):
+    """Model with time bucketed counters"""
+
+    confirmed = gcounter.BooleanProperty(default=False, counter_name='confirmed', time_bucket='hour')
+    co = gcounter.StringProperty(default=None, counter_name='loc:%s', time_bucket='day')
+
+
+class TestTimeBucket(TestCountersMain):
+
+    def testName(self):
+
+        when = datetime.datetime(2013, 10, 18, 13, 45)
+
+        self.assertEqual('users@hour:2013101813', gcounter.TimeBucket.name('users', 'hour', when))
+        self.assertEqual('users@day:20131018', gcounter.TimeBucket.name('users', 'day', when))
+        self.assertEqual('loc:us@month:201310', gcounter.TimeBucket.name('loc:us', 'month', when))
+
+    def testParse(self):
+
+        self.assertEqual(('loc:us', 'day', datetime.datetime(2013, 10, 18)), gcounter.TimeBucket.parse('loc:us@day:20131018'))
+        self.assertEqual(None, gcounter.TimeBucket.parse('loc:us'))
+
+    def testParseNotBucket(self):
+
+        self.assertEqual(None, gcounter.TimeBucket.parse('users@active'))
+        self.assertEqual(None, gcounter.TimeBucket.parse('users@week:2013'))
+        self.assertEqual(None, gcounter.TimeBucket.parse('users@day:2013'))
+        self.assertEqual(None, gcounter.TimeBucket.parse('users@day:201310181'))
+        self.assertEqual(None, gcounter.TimeBucket.parse('a@b'))
+
+    def testPeriods(self):
+
+        periods = gcounter.TimeBucket.periods(datetime.datetime(2013, 11, 15, 8), datetime.datetime(2014, 1, 1), 'month')
+
+        self.assertEqual([datetime.datetime(2013, 11, 1), datetime.datetime(2013, 12, 1), datetime.datetime(2014, 1, 1)], periods)
+        self.assertEqual(25, len(gcounter.TimeBucket.periods(datetime.datetime(2013, 10, 18), datetime.datetime(2013, 10, 19), 'hour')))
+
+    def testUnknownGranularity(self):
+
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.IntegerProperty, counter_name='c', time_bucket='week')
+
+
+class TestTimeBucketedCounters(TestCountersMain):
+
+    def setUp(self):
+        super(TestTimeBucketedCounters, self).setUp()
+        self.init_taskqueue_stub()
+        self.set_application(gcounter_tasks.app)
+
+    def tearDown(self):
+        gcounter.TIME_BUCKET_ROLLUP_BATCH_SIZE = 100
+        self.clear_application()
+        super(TestTimeBucketedCounters, self).tearDown()
+
+    def testActions(self):
+
+        model = TestTB1(confirmed=True, co='us')
+        model.put()
+
+        now = datetime.datetime.utcnow()
+        expected = {
+            'confirmed': 1,
+            gcounter.TimeBucket.name('confirmed', 'hour', now): 1,
+            'loc:us': 1,
+            gcounter.TimeBucket.name('loc:us', 'day', now): 1}
+
+        self.assertEqual(expected, model.get_counter_actions())
+
+    def testChangeActions(self):
+
+        model = TestTB1(co='us')
+        model.put()
+        model.co = 'pl'
+        model.put()
+
+        day = gcounter.TimeBucket.name('loc:%s', 'day', datetime.datetime.utcnow())
+        self.assertEqual({'loc:us': -1, day % 'us': -1, 'loc:pl': 1, day % 'pl': 1}, model.get_counter_actions())
+
+    def testBucketShards(self):
+
+        name = gcounter.TimeBucket.name('confirmed', 'hour', datetime.datetime.utcnow())
+        gcounter.Counter.incr(name)
+
+        self.assertEqual(gcounter.TIME_BUCKET_NUM_SHARDS, gcounter.GeneralCounterShardConfig.get_by_id(name).num_shards)
+
+    def testNotInPrefixIndex(self):
+
+        gcounter.Counter.apply_actions({'loc:us': 1, 'loc:us@day:20131018': 1})
+
+        self.assertEqual({'loc:us': 1}, gcounter.Counter.get_children('loc'))
+
+    def testNotBucketCounter(self):
+
+        gcounter.Counter.incr('a@b')
+        gcounter.Counter.incr('loc:a@b')
+
+        self.assertEqual(1, gcounter.Counter.get_count('a@b', force=True))
+        self.assertEqual(20, gcounter.GeneralCounterShardConfig.get_by_id('a@b').num_shards)
+        self.assertEqual(0, gcounter.TimeBucketIndex.query().count())
+        self.assertEqual({'loc:a@b': 1}, gcounter.Counter.get_children('loc'))
+
+    def testGetSeries(self):
+
+        gcounter.Counter.apply_actions({'users@day:20131018': 3, 'users@day:20131020': 1, 'users@day:20131021': 5})
+
+        series = gcounter.Counter.get_series('users', datetime.datetime(2013, 10, 18), datetime.datetime(2013, 10, 20, 12), 'day')
+
+        expected = [
+            (datetime.datetime(2013, 10, 18), 3),
+            (datetime.datetime(2013, 10, 19), 0),
+            (datetime.datetime(2013, 10, 20), 1)]
+        self.assertEqual(expected, series)
+
+    def testGetSeriesRecentHours(self):
+
+        now = datetime.datetime.utcnow()
+        today = gcounter.TimeBucket.truncate(now, 'day')
+
+        gcounter.Counter.apply_actions({
+            gcounter.TimeBucket.name('users', 'day', today): 10,
+            gcounter.TimeBucket.name('users', 'hour', now): 2})
+
+        self.assertEqual([(today, 12)], gcounter.Counter.get_series('users', now, now, 'day'))
+
+    def testRollup(self):
+
+        gcounter.Counter.apply_actions({'users@hour:2013101813': 3, 'users@hour:2013101814': 2, 'users@day:20131018': 1})
+
+        stats, more = gcounter.Counter.rollup_time_buckets()
+
+        self.assertEqual({'buckets': 2, 'delta': 5}, stats)
+        self.assertFalse(more)
+
+        self.assertEqual({'users@day:20131018': 6}, self.get_db_counters())
+        self.assertEqual(None, gcounter.GeneralCounterShardConfig.get_by_id('users@hour:2013101813'))
+        self.assertEqual(0, gcounter.TimeBucketIndex.query().count())
+        self.assertEqual(0, gcounter.CounterActions.query(gcounter.CounterActions.processed == False).count())
+
+        series = gcounter.Counter.get_series('users', datetime.datetime(2013, 10, 18), datetime.datetime(2013, 10, 18), 'day')
+        self.assertEqual([(datetime.datetime(2013, 10, 18), 6)], series)
+
+    def testRollupWaitsForDelay(self):
+
+        now = datetime.datetime.utcnow()
+        gcounter.Counter.incr(gcounter.TimeBucket.name('users', 'hour', now))
+
+        stats, more = gcounter.Counter.rollup_time_buckets()
+
+        self.assertEqual(0, stats['buckets'])
+        self.assertEqual(1, gcounter.TimeBucketIndex.query().count())
+
+    def testRollupLateAction(self):
+
+        gcounter.Counter.incr('users@hour:2013101813')
+        gcounter.Counter.rollup_time_buckets()
+
+        gcounter.Counter.incr('users@hour:2013101813')
+        gcounter.Counter.rollup_time_buckets()
+
+        self.assertEqual({'users@day:20131018': 2}, self.get_db_counters())
+
+    def testRollupApplyFailure(self):
+
+        gcounter.Counter.apply_actions({'users@hour:2013101813': 3})
+
+        def fail(actions):
+            raise datastore_errors.TransactionFailedError('too much contention')
+
+        apply_actions = gcounter.Counter.apply_actions
+        gcounter.Counter.apply_actions = staticmethod(fail)
+        try:
+            stats, more = gcounter.Counter.rollup_time_buckets()
+        finally:
+            gcounter.Counter.apply_actions = apply_actions
+
+        self.assertEqual(1, stats['buckets'])
+        self.assertEqual(1, gcounter.CounterActions.query(gcounter.CounterActions.processed == False).count())
+
+        gcounter.Counter.aggregate_stored_actions()
+        self.assertEqual({'users@day:20131018': 3}, self.get_db_counters())
+
+    def testRollupTask(self):
+
+        for hour in range(10):
+            gcounter.Counter.incr('users@hour:20131018%02d' % hour)
+        gcounter.TIME_BUCKET_ROLLUP_BATCH_SIZE = 3
+
+        self.get(gcounter.TIME_BUCKET_ROLLUP_URL)
+        self.execute_tasks_until_empty()
+
+        self.assertEqual({'users@day:20131018': 10}, self.get_db_counters())
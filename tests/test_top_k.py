@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for heavy hitters of complex counter families
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+
+# Global Counter imports
+import gcounter
+
+# Global Counter tests imports
+from tests.base_test import TestCountersMain
+
+
+class TestTK1(gcounter.Model):
+    """Model tracking the biggest counters of complex counter family"""
+
+    author = gcounter.StringProperty(default=None, counter_name='tk1n:%s', top_k=3)
+
+
+class TestTopCounterShard(TestCountersMain):
+
+    def testChange(self):
+
+        shard = gcounter.TopCounterShard()
+
+        self.assertTrue(shard.change('a', 5, 2))
+        self.assertTrue(shard.change('b', 2, 2))
+        self.assertTrue(shard.change('a', 1, 2))
+        self.assertEqual((['a', 'b'], [6, 2], [0, 0]), (shard.names, shard.counts, shard.errors))
+
+    def testReplaceSmallest(self):
+
+        shard = gcounter.TopCounterShard(names=['a', 'b'], counts=[6, 2], errors=[0, 0])
+
+        self.assertTrue(shard.change('c', 1, 2))
+        self.assertEqual((['a', 'c'], [6, 3], [0, 2]), (shard.names, shard.counts, shard.errors))
+
+    def testDecrement(self):
+
+        shard = gcounter.TopCounterShard(names=['a', 'b'], counts=[6, 2], errors=[0, 0])
+
+        self.assertFalse(shard.change('c', -1, 2))
+        self.assertTrue(shard.change('b', -2, 2))
+        self.assertEqual((['a'], [6], [0]), (shard.names, shard.counts, shard.errors))
+
+
+class TestTopCounters(TestCountersMain):
+
+    def setUp(self):
+        super(TestTopCounters, self).setUp()
+        gcounter.Counter._top_k_families = None
+
+    def tearDown(self):
+        gcounter.WRITE_BEHIND = False
+        gcounter.Counter._top_k_families = None
+        super(TestTopCounters, self).tearDown()
+
+    def testRegistered(self):
+
+        families = gcounter.Counter._get_top_k_families_async().get_result()
+
+        self.assertEqual(3, gcounter.TOP_K_FAMILIES['tk1n:%s'])
+        self.assertEqual(3, families['tk1n:%s'])
+        self.assertEqual(3, gcounter.TopCounterFamily.get_by_id('tk1n:%s').top_k)
+        self.assertEqual('tk1n:%s', gcounter.Counter._top_k_family('tk1n:bob', families))
+        self.assertEqual(None, gcounter.Counter._top_k_family('tk1n:bob:dylan', families))
+        self.assertEqual(None, gcounter.Counter._top_k_family('tk1n:bob@day:20131018', families))
+        self.assertEqual(None, gcounter.Counter._top_k_family('tk2n:bob', families))
+
+    def testStoredFamily(self):
+
+        gcounter.Counter._get_top_k_families_async().get_result()
+
+        # Simulate process which didn't import the models, like gcounter_tasks
+        declared = dict(gcounter.TOP_K_FAMILIES)
+        gcounter.TOP_K_FAMILIES.clear()
+        gcounter.Counter._top_k_families = None
+        try:
+            gcounter.Counter.change_counter('tk1n:bob-dylan', 2)
+        finally:
+            gcounter.TOP_K_FAMILIES.update(declared)
+
+        self.assertEqual([('tk1n:bob-dylan', 2)], gcounter.Counter.get_top('tk1n:%s'))
+
+    def testExact(self):
+
+        # Counter value from before the family got top_k
+        gcounter.TOP_K_FAMILIES.pop('tk1n:%s')
+        try:
+            gcounter.Counter.change_counter('tk1n:bob-dylan', 3)
+        finally:
+            gcounter.TOP_K_FAMILIES['tk1n:%s'] = 3
+            gcounter.Counter._top_k_families = None
+
+        gcounter.Counter.change_counter('tk1n:bob-dylan', 2)
+
+        self.assertEqual([('tk1n:bob-dylan', 2)], gcounter.Counter.get_top('tk1n:%s'))
+        self.assertEqual([('tk1n:bob-dylan', 5)], gcounter.Counter.get_top('tk1n:%s', exact=True))
+
+    def testValidation(self):
+
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.StringProperty, counter_name='tk', top_k=3)
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.StringProperty, counter_name='tk:<co>:%s', top_k=3)
+        self.assertRaises(gcounter.ModelTrackingError, gcounter.StringProperty, counter_name='tk:%s', top_k=0)
+
+    def testGetTop(self):
+
+        authors = ['Bob Dylan'] * 5 + ['Tom Waits'] * 3 + ['Nick Cave'] * 2 + ['Leonard Cohen']
+        models = [TestTK1(author=author) for author in authors]
+        gcounter.Counter.apply_actions(gcounter.put_multi_with_actions(models))
+
+        self.assertEqual([('tk1n:bob-dylan', 5), ('tk1n:tom-waits', 3)], gcounter.Counter.get_top('tk1n:%s', 2))
+        self.assertEqual(4, len(gcounter.Counter.get_top('tk1n:%s')))
+
+    def testChangedValue(self):
+
+        models = [TestTK1(author='Bob Dylan'), TestTK1(author='Bob Dylan')]
+        gcounter.Counter.apply_actions(gcounter.put_multi_with_actions(models))
+
+        models[0].author = 'Tom Waits'
+        models[0].put()
+        gcounter.Counter.apply_actions(models[0].get_counter_actions())
+
+        self.assertEqual([('tk1n:bob-dylan', 1), ('tk1n:tom-waits', 1)], gcounter.Counter.get_top('tk1n:%s'))
+
+    def testWriteBehind(self):
+
+        gcounter.WRITE_BEHIND = True
+
+        gcounter.Counter.apply_actions({'tk1n:bob-dylan': 2})
+        self.assertEqual([], gcounter.Counter.get_top('tk1n:%s'))
+
+        gcounter.Counter.flush_buffers()
+        self.assertEqual([('tk1n:bob-dylan', 2)], gcounter.Counter.get_top('tk1n:%s'))
+
+    def testIncr(self):
+
+        gcounter.Counter.incr('tk1n:bob-dylan')
+        gcounter.Counter.incr('tk1n:bob-dylan')
+        gcounter.Counter.decr('tk1n:bob-dylan')
+
+        self.assertEqual([('tk1n:bob-dylan', 1)], gcounter.Counter.get_top('tk1n:%s'))
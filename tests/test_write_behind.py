@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for write-behind counter buffers
+
+Code downloaded from: http://github.com/rzajac/gcounter
+@author: Rafal Zajac rzajac<at>gmail<dot>com
+@copyright: Copyright 2007-2013 Rafal Zajac rzajac<at>gmail<dot>com. All rights reserved.
+@license: Licensed under the MIT license
+"""
+
+# Python imports
+
+# GAE imports
+from google.appengine.api import memcache, datastore_errors
+
+# Global Counter imports
+import gcounter
+import gcounter_tasks
+
+# Global Counter tests imports
+from tests.base_test import TestCountersMain
+
+
+class TestWriteBehind(TestCountersMain):
+
+    def setUp(self):
+        super(TestWriteBehind, self).setUp()
+        gcounter.WRITE_BEHIND = True
+
+    def tearDown(self):
+        gcounter.WRITE_BEHIND = False
+        super(TestWriteBehind, self).tearDown()
+
+    def testNotWrittenBeforeFlush(self):
+
+        gcounter.Counter.incr('c1')
+        gcounter.Counter.apply_actions({'c1': 2, 'c2': -1})
+
+        self.assertEqual({}, self.get_db_counters())
+        self.assertEqual(0, gcounter.Counter.get_count('c1'))
+
+    def testFlush(self):
+
+        gcounter.Counter.incr('c1')
+        gcounter.Counter.apply_actions({'c1': 2, 'c2': -1})
+
+        stats = gcounter.Counter.flush_buffers()
+
+        self.assertEqual({'c1': 3, 'c2': -1}, self.get_db_counters())
+        self.assertEqual(3, gcounter.Counter.get_count('c1'))
+        self.assertEqual(2, stats['counters'])
+        self.assertEqual(4, stats['delta'])
+        self.assertEqual(0, stats['evicted'])
+        self.assertEqual(stats, gcounter.Counter.get_flush_stats())
+
+    def testFlushTwice(self):
+
+        gcounter.Counter.incr('c1')
+        gcounter.Counter.flush_buffers()
+        stats = gcounter.Counter.flush_buffers()
+
+        self.assertEqual({'c1': 1}, self.get_db_counters())
+        self.assertEqual(0, stats['counters'])
+
+    def testChangeAfterFlush(self):
+
+        gcounter.Counter.incr('c1')
+        gcounter.Counter.flush_buffers()
+        gcounter.Counter.decr('c1')
+        gcounter.Counter.decr('c1')
+        gcounter.Counter.flush_buffers()
+
+        self.assertEqual({'c1': -1}, self.get_db_counters())
+
+    def testEvictedBuffer(self):
+
+        gcounter.Counter.incr('c1')
+        gcounter.Counter.incr('c2')
+        memcache.delete(gcounter.WRITE_BEHIND_KEY_PREFIX + 'buf:c1')
+
+        stats = gcounter.Counter.flush_buffers()
+
+        self.assertEqual({'c2': 1}, self.get_db_counters())
+        self.assertEqual(1, stats['evicted'])
+
+    def testEvictedMarker(self):
+
+        gcounter.Counter.incr('c1')
+        memcache.delete(gcounter.WRITE_BEHIND_KEY_PREFIX + 'marker:c1')
+        gcounter.Counter.incr('c1')
+
+        gcounter.Counter.flush_buffers()
+
+        self.assertEqual({'c1': 2}, self.get_db_counters())
+
+    def testChangeDuringUnregister(self):
+
+        gcounter.Counter.incr('c1')
+
+        index = gcounter.Counter._buffer_index
+        remove_multi = index.remove_multi
+
+        def change_and_remove(names):
+            gcounter.Counter.incr('c1')
+            return remove_multi(names)
+
+        index.remove_multi = change_and_remove
+        try:
+            gcounter.Counter.flush_buffers()
+        finally:
+            index.remove_multi = remove_multi
+
+        self.assertEqual(['c1'], index.get_all())
+
+        gcounter.Counter.flush_buffers()
+        self.assertEqual({'c1': 2}, self.get_db_counters())
+
+    def testPartialFlushFailure(self):
+
+        for name in ['c1', 'c2', 'c3']:
+            gcounter.Counter.incr(name)
+
+        change_shard = gcounter.Counter._change_shard_async
+
+        def fail_one(name, delta, num_shards, attempts=None):
+            if name != 'c2':
+                return change_shard(name, delta, num_shards, attempts)
+            future = gcounter.ndb.Future()
+            future.set_exception(datastore_errors.TransactionFailedError('too much contention'))
+            return future
+
+        gcounter.Counter._change_shard_async = staticmethod(fail_one)
+        try:
+            self.assertRaises(datastore_errors.TransactionFailedError, gcounter.Counter.flush_buffers)
+        finally:
+            gcounter.Counter._change_shard_async = change_shard
+
+        self.assertEqual({'c1': 1, 'c3': 1}, self.get_db_counters())
+
+        gcounter.Counter.flush_buffers()
+        self.assertEqual({'c1': 1, 'c2': 1, 'c3': 1}, self.get_db_counters())
+
+    def testHandler(self):
+
+        self.set_application(gcounter_tasks.app)
+
+        gcounter.Counter.incr('c1')
+        response = self.get('/admin/scr/flush-counters')
+
+        self.assertOK(response)
+        self.assertEqual(1, response.json['counters'])
+        self.assertEqual({'c1': 1}, self.get_db_counters())
+
+
+class TestMemcacheNameSet(TestCountersMain):
+
+    def testAddRemove(self):
+
+        names = gcounter.MemcacheNameSet('test:', buckets=4)
+
+        self.assertTrue(names.add('c1'))
+        self.assertTrue(names.add('c2'))
+        self.assertTrue(names.add('c1'))
+        self.assertEqual(['c1', 'c2'], sorted(names.get_all()))
+
+        self.assertTrue(names.remove_multi(['c1']))
+        self.assertEqual(['c2'], names.get_all())